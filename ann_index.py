@@ -0,0 +1,327 @@
+import numpy as np
+import scipy.sparse as sp
+import argparse
+import json
+import os
+import time
+from factor_export import load_factors
+from topk import blocked_top_k
+
+# the arrays of an index; every array is one .npy file which is opened as a memory map
+INDEX_ARRAYS = ["centroids", "centroid_norms", "codebooks", "list_indptr", "list_items", "codes"]
+
+
+def augment_items(item_factors, max_norm):
+    '''
+    This function is to turn maximum inner product search into nearest neighbour search: every
+    item gets one more dimension sqrt(max_norm^2 - |x|^2), so all items have the norm max_norm,
+    and a query (with 0 in the new dimension) is closest in L2 to the items of the largest
+    inner product: |q - x|^2 = |q|^2 + max_norm^2 - 2 <q, x>.
+    '''
+    item_factors = np.asarray(item_factors, dtype=np.float32)
+    norms = np.einsum("ij,ij->i", item_factors, item_factors)
+    extra = np.sqrt(np.maximum(max_norm ** 2 - norms, 0))
+    return np.hstack([item_factors, extra[:, None]]).astype(np.float32)
+
+
+def pad_dimensions(vectors, dimensions):
+    '''
+    This function is to pad the vectors with zeros to the given number of dimensions.
+    '''
+    if vectors.shape[1] == dimensions:
+        return vectors
+    return np.hstack([vectors, np.zeros((vectors.shape[0], dimensions - vectors.shape[1]), dtype=vectors.dtype)])
+
+
+def nearest_centroids(data, centroids, block_size=4096):
+    '''
+    This function is to assign every vector to its nearest centroid (L2), one block at a time.
+    '''
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    assignment = np.zeros(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        distances = centroid_norms - 2 * np.asarray(data[start:start + block_size]).dot(centroids.T)
+        assignment[start:start + block_size] = np.argmin(distances, axis=1)
+    return assignment
+
+
+def kmeans(data, n_clusters, n_iter=10, seed=123):
+    '''
+    This function is to cluster the vectors with Lloyd's k-means; an empty cluster gets a random vector.
+    Output:
+    1. centroids: (n_clusters x dimensions) array
+    '''
+    rng = np.random.RandomState(seed)
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].astype(np.float32)
+    for _ in range(n_iter):
+        assignment = nearest_centroids(data, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # the sums of the clusters as one sparse (clusters x vectors) product
+        sums = sp.csr_matrix((np.ones(len(data), dtype=np.float32), (assignment, np.arange(len(data)))),
+                             shape=(n_clusters, len(data))).dot(data)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def build_ivf_pq(item_factors, n_lists=1024, n_subspaces=8, n_codes=256, sample_size=100000, n_iter=10, seed=123):
+    '''
+    This function is to build an IVF-PQ index for maximum inner product search over the item factors.
+    The augmented items (see augment_items) are clustered into n_lists inverted lists by k-means,
+    and the residual of every item to its list centroid is compressed by product quantization:
+    the dimensions are split into n_subspaces parts and every part is stored as the id (uint8) of
+    its nearest of n_codes sub-centroids. The centroids are trained on a sample of the items.
+    Input:
+    1. item_factors: (n_items x rank) array
+    2. n_lists: number of inverted lists, e.g. about sqrt(n_items)
+    3. n_subspaces: number of PQ parts; the code of an item takes n_subspaces bytes
+    4. n_codes: number of sub-centroids per part (at most 256)
+    5. sample_size, n_iter, seed: the training of k-means
+    Output:
+    1. a dictionary of {name: array}, see INDEX_ARRAYS, plus meta
+    '''
+    item_factors = np.asarray(item_factors, dtype=np.float32)
+    max_norm = float(np.sqrt(np.einsum("ij,ij->i", item_factors, item_factors).max()))
+    dimensions = -(-(item_factors.shape[1] + 1) // n_subspaces) * n_subspaces
+    data = pad_dimensions(augment_items(item_factors, max_norm), dimensions)
+    rng = np.random.RandomState(seed)
+    sample = data[np.sort(rng.choice(len(data), min(sample_size, len(data)), replace=False))]
+    # coarse quantizer
+    centroids = kmeans(sample, n_lists, n_iter=n_iter, seed=seed)
+    assignment = nearest_centroids(data, centroids)
+    list_items = np.argsort(assignment, kind="stable")
+    list_indptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=list_indptr[1:])
+    # product quantizer of the residuals, stored in the order of the lists
+    residuals = data[list_items] - centroids[assignment[list_items]]
+    sub_dimensions = dimensions // n_subspaces
+    sample_residuals = sample - centroids[nearest_centroids(sample, centroids)]
+    codebooks = np.zeros((n_subspaces, min(n_codes, len(sample)), sub_dimensions), dtype=np.float32)
+    codes = np.zeros((len(data), n_subspaces), dtype=np.uint8)
+    for part in range(n_subspaces):
+        columns = slice(part * sub_dimensions, (part + 1) * sub_dimensions)
+        codebooks[part] = kmeans(np.ascontiguousarray(sample_residuals[:, columns]), n_codes,
+                                 n_iter=n_iter, seed=seed + part + 1)
+        codes[:, part] = nearest_centroids(np.ascontiguousarray(residuals[:, columns]), codebooks[part])
+    return {"centroids": centroids,
+            "centroid_norms": np.einsum("ij,ij->i", centroids, centroids),
+            "codebooks": codebooks,
+            "list_indptr": list_indptr,
+            "list_items": list_items,
+            "codes": codes,
+            "meta": {"n_lists": len(centroids), "n_subspaces": n_subspaces, "n_codes": codebooks.shape[1],
+                     "dimensions": dimensions, "max_norm": max_norm, "n_items": len(data)}}
+
+
+def write_index(arrays, index_path):
+    '''
+    This function is to write the arrays of an index as .npy files and the metadata as meta.json.
+    '''
+    if not os.path.exists(index_path):
+        os.makedirs(index_path)
+    for name in INDEX_ARRAYS:
+        np.save(os.path.join(index_path, name + ".npy"), arrays[name])
+    with open(os.path.join(index_path, "meta.json"), "w") as file:
+        json.dump(arrays["meta"], file, indent=2)
+
+
+class ANNIndex(object):
+    '''
+    An IVF-PQ index over the item factors of one exported version (see factor_export.FactorModel).
+    A query only scores the items of the n_probe lists closest to it, from their PQ codes
+    (asymmetric distance: one lookup table of (n_subspaces x n_codes) inner products per query),
+    and the rerank best candidates are rescored exactly with the float32 factors.
+    '''
+
+    def __init__(self, model, arrays):
+        self.model = model
+        self.meta = arrays["meta"]
+        self.centroids = arrays["centroids"]
+        self.centroid_norms = arrays["centroid_norms"]
+        self.codebooks = arrays["codebooks"]
+        self.list_indptr = arrays["list_indptr"]
+        self.list_items = arrays["list_items"]
+        self.codes = arrays["codes"]
+
+    def search(self, queries, k=10, n_probe=8, rerank=100, exclude=None):
+        '''
+        This function is to find the k items with the (approximately) highest inner product for every query.
+        Input:
+        1. queries: (n_queries x rank) array, e.g. user factors or item factors
+        2. k: number of items per query
+        3. n_probe: number of inverted lists scanned per query; more lists give a higher recall
+        4. rerank: number of candidates rescored exactly; 0 to keep the PQ scores
+        5. exclude: None, or a list of item position arrays (one per query) which are skipped
+        Output:
+        1. top_items: (n_queries x k) item positions sorted by score (-1 if there are fewer than k items)
+        2. top_scores: (n_queries x k) scores
+        '''
+        queries = np.asarray(queries, dtype=np.float32)
+        n_subspaces, dimensions = self.meta["n_subspaces"], self.meta["dimensions"]
+        sub_queries = pad_dimensions(queries, dimensions).reshape(len(queries), n_subspaces, -1)
+        n_probe = min(n_probe, len(self.centroids))
+        top_items = np.full((len(queries), k), -1, dtype=np.int64)
+        top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i in range(len(queries)):
+            query = sub_queries[i].reshape(-1)
+            # the closest lists in the augmented space
+            centroid_scores = self.centroids.dot(query)
+            distances = self.centroid_norms - 2 * centroid_scores
+            lists = np.argpartition(distances, n_probe - 1)[:n_probe] if n_probe < len(distances) else np.arange(len(distances))
+            starts, ends = self.list_indptr[lists], self.list_indptr[lists + 1]
+            positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+            if len(positions) == 0:
+                continue
+            items = np.asarray(self.list_items[positions])
+            # asymmetric distance: <q, centroid> + sum of the inner products of the parts with their codes
+            table = np.einsum("pcd,pd->pc", self.codebooks, sub_queries[i])
+            scores = np.repeat(centroid_scores[lists], ends - starts) + \
+                table[np.arange(n_subspaces), np.asarray(self.codes[positions])].sum(axis=1)
+            if exclude is not None and len(exclude[i]) > 0:
+                scores[np.isin(items, exclude[i])] = -np.inf
+            if rerank > 0:
+                n_candidates = min(max(rerank, k), len(items))
+                candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+                items = items[candidates]
+                keep = ~np.isneginf(scores[candidates])
+                items = items[keep]
+                order = np.sort(items)
+                scores = np.asarray(self.model.item_factors[order]).dot(queries[i])
+                items = order
+            n_top = min(k, len(items))
+            if n_top == 0:
+                continue
+            top = np.argpartition(-scores, n_top - 1)[:n_top]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            top = top[~np.isneginf(scores[top])]
+            top_items[i, :len(top)] = items[top]
+            top_scores[i, :len(top)] = scores[top]
+        return top_items, top_scores
+
+    def recommend(self, users, n=10, n_probe=8, rerank=100, raw=False):
+        '''
+        This function is to recommend the n items of (approximately) highest score to every user,
+        like FactorModel.recommend (with raw, the user and item ids are the raw ids).
+        Output:
+        1. known: whether the user has factors; the other users get no recommendation
+        2. items: (users x n) item ids, -1 where there are fewer than n items
+        3. scores: (users x n) scores
+        '''
+        rows, known = self.model.user_rows(users, raw=raw)
+        top_items, top_scores = self.search(self.model.user_factors[rows[known]], k=n, n_probe=n_probe, rerank=rerank)
+        return (known,) + self.item_results(known, top_items, top_scores, n, raw=raw)
+
+    def similar_items(self, items, n=10, n_probe=8, rerank=100, raw=False):
+        '''
+        This function is to find the n books of (approximately) highest inner product with every
+        given book ("books similar to X"), without the book itself (with raw, the ids are the raw ids).
+        Output:
+        1. known: whether the book has factors
+        2. items: (books x n) item ids, -1 where there are fewer than n items
+        3. scores: (books x n) scores
+        '''
+        rows, known = self.model.item_rows(items, raw=raw)
+        top_items, top_scores = self.search(self.model.item_factors[rows[known]], k=n, n_probe=n_probe, rerank=rerank,
+                                            exclude=[[row] for row in rows[known]])
+        return (known,) + self.item_results(known, top_items, top_scores, n, raw=raw)
+
+    def item_results(self, known, top_items, top_scores, n, raw=False):
+        '''
+        This function is to turn the item positions of search into item ids, with one row per query.
+        '''
+        items = np.full((len(known), n), -1, dtype=np.int64)
+        scores = np.full((len(known), n), -np.inf, dtype=np.float32)
+        items[known] = np.where(top_items >= 0, self.model.item_ids[np.maximum(top_items, 0)], -1)
+        scores[known] = top_scores
+        return (self.model.raw_ids("item", items) if raw else items), scores
+
+
+def load_index(model, index_path=None):
+    '''
+    This function is to open the index of an exported version (the folder ann of the version by default).
+    Input:
+    1. model: the output of factor_export.load_factors
+    2. index_path: the folder of the index
+    Output:
+    1. ANNIndex
+    '''
+    if index_path is None:
+        index_path = os.path.join(model.path, "ann")
+    arrays = dict((name, np.load(os.path.join(index_path, name + ".npy"), mmap_mode="r")) for name in INDEX_ARRAYS)
+    with open(os.path.join(index_path, "meta.json")) as file:
+        arrays["meta"] = json.load(file)
+    return ANNIndex(model, arrays)
+
+
+def benchmark(index, queries, k=10, n_probe_list=[1, 4, 16, 64], rerank=100):
+    '''
+    This function is to measure the recall and the latency of the index against the exact search
+    (topk.blocked_top_k over every item), one query at a time like at request time.
+    Input:
+    1. index: ANNIndex
+    2. queries: (n_queries x rank) array
+    3. k: number of items per query
+    4. n_probe_list: the numbers of lists to measure
+    5. rerank: number of candidates rescored exactly
+    Output:
+    1. a list of dictionaries of {method, n_probe, recall, ms_per_query}
+    '''
+    queries = np.asarray(queries, dtype=np.float32)
+    item_factors = np.asarray(index.model.item_factors)
+    start_time = time.time()
+    exact = [blocked_top_k(query[None, :], item_factors, k=k)[0][0] for query in queries]
+    results = [{"method": "exact", "n_probe": None, "recall": 1.0,
+                "ms_per_query": 1000 * (time.time() - start_time) / len(queries)}]
+    for n_probe in n_probe_list:
+        start_time = time.time()
+        found = [index.search(query[None, :], k=k, n_probe=n_probe, rerank=rerank)[0][0] for query in queries]
+        elapsed = time.time() - start_time
+        recall = np.mean([len(np.intersect1d(approximate[approximate >= 0], truth[truth >= 0])) / float(max((truth >= 0).sum(), 1))
+                          for approximate, truth in zip(found, exact)])
+        results.append({"method": "ivf-pq", "n_probe": n_probe, "recall": float(recall),
+                        "ms_per_query": 1000 * elapsed / len(queries)})
+    return results
+
+
+def set_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export_path", help="Local folder of a factor export (factor_export.py).")
+    parser.add_argument("--version", default=None, help="The version of the export; the LATEST one by default.")
+    parser.add_argument("--n_lists", default="1024", help="Number of inverted lists, e.g. about sqrt(number of books).")
+    parser.add_argument("--n_subspaces", default="8", help="Number of parts of the product quantization.")
+    parser.add_argument("--sample_size", default="100000", help="Number of books used to train the quantizers.")
+    parser.add_argument("--top_k", default="10", help="Number of books per query in the benchmark.")
+    parser.add_argument("--n_queries", default="200", help="Number of users queried in the benchmark.")
+    parser.add_argument("--n_probe_list", default="[1,4,16,64]", help="A list of numbers of scanned lists for the benchmark.")
+    parser.add_argument("--rerank", default="100", help="Number of candidates rescored with the exact factors.")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+
+    ### input arguments ###
+    args = set_arguments()
+    version = None if args.version is None else int(args.version)
+    model = load_factors(args.export_path, version)
+
+    ### 1. build and write the index next to the factors ###
+    print("Building the index of {0} books.".format(len(model.item_ids)))
+    start_time = time.time()
+    arrays = build_ivf_pq(model.item_factors, n_lists=int(args.n_lists), n_subspaces=int(args.n_subspaces),
+                          sample_size=int(args.sample_size))
+    write_index(arrays, os.path.join(model.path, "ann"))
+    print("It takes {0} seconds to build the index.".format(str(round(time.time() - start_time, 2))))
+
+    ### 2. recall vs latency against the exact search ###
+    print("Benchmarking the index.")
+    index = load_index(model)
+    rng = np.random.RandomState(123)
+    users = rng.choice(len(model.user_ids), min(int(args.n_queries), len(model.user_ids)), replace=False)
+    for result in benchmark(index, model.user_factors[np.sort(users)], k=int(args.top_k),
+                            n_probe_list=eval(args.n_probe_list), rerank=int(args.rerank)):
+        print("{0} n_probe={1}: recall@{2} {3}, {4} ms per query".format(
+            result["method"], result["n_probe"], args.top_k, round(result["recall"], 4),
+            round(result["ms_per_query"], 3)))
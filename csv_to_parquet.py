@@ -2,19 +2,9 @@ import pyspark
 from pyspark.sql import SparkSession
 from pyspark.sql.types import StructType, StructField, IntegerType, StringType
 import argparse
-
-
-def settings(memory):
-    ### setting ###
-    conf = pyspark.SparkConf() \
-        .setAll([('spark.app.name', 'downsampling code'),
-                 ('spark.master', 'local'),
-                 ('spark.executor.memory', memory),
-                 ('spark.driver.memory', memory)])
-    spark = SparkSession.builder \
-        .config(conf=conf) \
-        .getOrCreate()
-    return spark
+import time
+from spark_config import spark_session, add_spark_arguments, path_bytes
+from instrumentation import RunLog
 
 
 def create_schema_with_index():
@@ -28,13 +18,62 @@ def create_schema_with_index():
     return data_schema
 
 
+def write_parquet(data, path, layout="none", partitions=None, row_group_size=None,
+                  compression="snappy", table_name=None, user="user_id", item="book_id"):
+    '''
+    This function is to write the DataFrame as parquet with a layout that suits the user-based reads.
+    Input:
+    1. data
+    2. path: the output path
+    3. layout: none: default partitioning
+               sort: range partition and sort by user, so every file (and row group) covers
+                     a narrow user_id range and the min/max statistics can skip data
+               bucket: hash bucket and sort by user into a table (needs table_name)
+    4. partitions: number of output files (or buckets)
+    5. row_group_size: parquet row group size in bytes
+    6. compression: parquet compression codec
+    7. table_name: the table name of the bucket layout
+    '''
+    if layout == "bucket" and table_name is None:
+        raise ValueError("The bucket layout needs a table name.")
+    if layout == "sort":
+        if partitions is not None:
+            data = data.repartitionByRange(partitions, user)
+        else:
+            data = data.repartitionByRange(user)
+        data = data.sortWithinPartitions(user, item)
+    elif layout == "none" and partitions is not None:
+        data = data.repartition(partitions)
+    writer = data.write.option("compression", compression)
+    if row_group_size is not None:
+        writer = writer.option("parquet.block.size", row_group_size)
+    if layout == "bucket":
+        writer.bucketBy(partitions or 200, user) \
+            .sortBy(user, item) \
+            .option("path", path) \
+            .saveAsTable(table_name, format="parquet", mode="overwrite")
+    else:
+        writer.parquet(path, mode="overwrite")
+
+
 def set_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--net_id", help="Inputing the netID for saving models")
     parser.add_argument("--csv_path", help="Specifying the path of the csv file.")
     parser.add_argument("--parquet_path", help="Specifying the path of the parquet file.")
-    parser.add_argument("--set_memory", help="Specifying the memory.")
+    parser.add_argument("--layout", default="none", help="Output layout: none, sort or bucket (by user_id).")
+    parser.add_argument("--partitions", default=None, help="Number of output files (or buckets).")
+    parser.add_argument("--row_group_size", default=None, help="Parquet row group size in bytes.")
+    parser.add_argument("--compression", default="snappy", help="Parquet compression codec.")
+    parser.add_argument("--table_name", default=None, help="Table name for the bucket layout.")
+    parser.add_argument("--run_log", default=None, help="Local JSON-lines file of the wall time and the Spark metrics of every step.")
+    add_spark_arguments(parser)
     args = parser.parse_args()
+    # check the layout before the session starts, so a bad combination writes nothing
+    if args.layout not in ["none", "sort", "bucket"]:
+        parser.error("--layout must be none, sort or bucket.")
+    if args.layout == "bucket" and args.table_name is None:
+        parser.error("the bucket layout needs --table_name.")
     return args
 
 
@@ -43,17 +82,37 @@ if __name__ == "__main__":
     # input arguments
     args = set_arguments()
 
-    # setting
-    spark = settings(args.set_memory)
-
     # path
     hdfs_teachers_path = "hdfs:///user/bm106/pub/goodreads/"
     to_hdfs_path = "hdfs:///user/" + args.net_id + "/goodreads/"
     # hdfs_path = "" # for local testing
 
+    # setting
+    spark = spark_session(args.profile, args.set_memory, args.cores,
+                          input_path=hdfs_teachers_path + args.csv_path, app_name="csv_to_parquet")
+    run_log = RunLog(spark, args.run_log, script="csv_to_parquet")
+
     ### 1. from csv to parquet ###
     # mypath = "hdfs:///user/kll482/goodreads/poetry_interactions.csv"
     data_schema = create_schema_with_index()
     data = spark.read.csv(hdfs_teachers_path + args.csv_path, header=True, schema=data_schema)
     print("Start writing out the parquet dataset.")
-    data.write.option("schema", data_schema).parquet(to_hdfs_path + "data/" + args.parquet_path, mode="overwrite")
+    output_path = to_hdfs_path + "data/" + args.parquet_path
+    start_time = time.time()
+    # the csv is read by the write, so its scan is recorded in this step
+    with run_log.stage("write", layout=args.layout, compression=args.compression):
+        write_parquet(data, output_path,
+                      layout=args.layout,
+                      partitions=None if args.partitions is None else int(args.partitions),
+                      row_group_size=args.row_group_size,
+                      compression=args.compression,
+                      table_name=args.table_name)
+    elapsed = time.time() - start_time
+
+    ### 2. report the layout ###
+    # count() on parquet only reads the footers
+    n_rows = spark.read.parquet(output_path).count()
+    n_bytes = path_bytes(spark, output_path)
+    print("Layout: {0}; compression: {1}. It takes {2} seconds to write {3} rows ({4} rows per second), "
+          "and the output has {5} bytes.".format(args.layout, args.compression, str(round(elapsed, 2)),
+                                                 n_rows, int(n_rows / max(elapsed, 1e-9)), n_bytes))
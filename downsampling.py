@@ -1,5 +1,6 @@
 import pyspark
-from pyspark.sql import SparkSession
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Row
 from pyspark.sql.types import StructType, StructField, IntegerType, StringType
 from pyspark.sql.functions import monotonically_increasing_id, col, create_map, lit, row_number
 from pyspark.sql.window import Window
@@ -7,59 +8,118 @@ from pyspark.sql.functions import rand
 import pyspark.sql.functions as F
 from itertools import chain
 import argparse
+from id_dictionary import assign_dense_ids, update_id_dictionary, index_with_dictionary
+from spark_config import spark_session, add_spark_arguments
+from instrumentation import RunLog, log_step
 
+# resolution of the hash sampling: a user falls into one of HASH_BUCKETS buckets
+HASH_BUCKETS = 1000000
 
-def settings(memory):
-    # setting
-    conf = pyspark.SparkConf() \
-        .setAll([('spark.app.name', 'downsampling code'),
-                 ('spark.master', 'local'),
-                 ('spark.executor.memory', memory),
-                 ('spark.driver.memory', memory)])
-    spark = SparkSession.builder \
-        .config(conf=conf) \
-        .getOrCreate()
-    return spark
+
+def count_user_interactions(data, user="user_id"):
+    '''
+    This function is to count the interactions of every user. This is the only
+    aggregation over the whole table; every statistic is derived from this small result.
+    Input:
+    1. data
+    2. user: the user column
+    '''
+    return data.groupBy(user).count()
 
 
-def get_frequent_user(data, user="user_id", threshold=20):
+def user_hash_condition(user="user_id", percentage=0.01, seed=123):
+    '''
+    This function is to create the sampling predicate which keeps a user when the hash
+    of user_id falls below the percentage. It only depends on user_id, so it can filter
+    the aggregate and the interaction table alike without any join or shuffle, and the
+    result is the same for any partitioning. With the same seed the subsets are nested:
+    the 1% users are also in the 10% sample, which are also in the 25% sample.
+    Input:
+    1. user: the user column
+    2. percentage: keep x percent of the users
+    3. seed: the salt of the hash; another seed gives another (nested) family of samples
+    '''
+    return user_hash_bucket(user=user, seed=seed) < int(round(float(percentage) * HASH_BUCKETS))
+
+
+def user_hash_bucket(user="user_id", seed=123):
+    '''
+    This function is to map user_id to a stable bucket in [0, HASH_BUCKETS).
+    '''
+    return F.pmod(F.xxhash64(col(user), lit(seed)), lit(HASH_BUCKETS))
+
+
+def get_frequent_user(user_counts, threshold=20):
     '''
     This function is to remove those users who have low interactions
     (less than the threshold)
     Input:
-    1. data
+    1. user_counts: the output of count_user_interactions
+    2. threshold: remove the users who have interactions lower than this threshold
+    '''
+    return user_counts.filter(col("count") >= int(threshold))
+
+
+def sample_user(user_df, user="user_id", percentage=0.01, sampling="hash", seed=123):
+    '''
+    This function is to keep k% of the users in a per-user DataFrame
+    Input:
+    1. user_df: a DataFrame of the frequent users which contains user_id
     2. user: the user column
-    3. threshold: remove the users who have interactions lower than this threshold
+    3. percentage: keep x percent of the users
+    4. sampling: hash: deterministic hash of user_id (see user_hash_condition)
+                 random: the former user_df.sample, which depends on the partitioning
+    5. seed: the seed of the sampling
     '''
-    # 1. initialize n_users and n_samples
-    n_users = data.select(user).distinct().count()
-    n_samples = data.count()
-    # 2. count the interaction and filter the users
-    user_id_frequent = data.groupBy(user).count().filter("count>=" + str(threshold)).select(user)
-    # print the percentage of the user_id which is removed
-    print("I remove {0}% of the total users who have less than {1} iteractions.".
-          format(str(round((1 - user_id_frequent.count() / n_users) * 100, 2)), threshold))
-    # 3. then delete the users with less count (by joining on the user_id which was not removed from the last step)
-    #data_freq = data.join(user_id_frequent, user, how='inner').select(data.schema.names)
-    # print("I remove {}% of the total rows by deleting the users which have less than {} iteractions.".\
-    #	  format(str(round((1-data_freq.count()/n_samples)*100, 2)), threshold))
-    return user_id_frequent
+    if sampling == "hash":
+        return user_df.filter(user_hash_condition(user=user, percentage=percentage, seed=seed))
+    elif sampling == "random":
+        return user_df.sample(False, float(percentage), seed=seed)
 
 
-def downsampling(data, user_df, user="user_id", percentage=0.01):
+def get_subset_stats(user_counts, sampled_user, threshold=20):
+    '''
+    This function is to compute the statistics of the subset from the per-user counts only.
+    Input:
+    1. user_counts: the output of count_user_interactions
+    2. sampled_user: the sampled frequent users (with the count column)
+    3. threshold: users with less than k interactions are removed
+    Output:
+    1. a dictionary with n_users, n_samples, n_frequent_users, n_frequent_rows, n_sampled_users, n_sampled_rows
+    '''
+    frequent = col("count") >= int(threshold)
+    stats = user_counts.agg(
+        F.count(lit(1)).alias("n_users"),
+        F.sum("count").alias("n_samples"),
+        F.sum(F.when(frequent, 1).otherwise(0)).alias("n_frequent_users"),
+        F.sum(F.when(frequent, col("count")).otherwise(0)).alias("n_frequent_rows")
+    ).first().asDict()
+    sampled_stats = sampled_user.agg(
+        F.count(lit(1)).alias("n_sampled_users"),
+        F.coalesce(F.sum("count"), lit(0)).alias("n_sampled_rows")
+    ).first().asDict()
+    stats.update(sampled_stats)
+    return stats
+
+
+def downsampling(data, user_df, user="user_id", percentage=0.01, sampling="hash", seed=123):
     '''
     This function is to keep k% of the users in the data
     Input:
     1. data
-    2. user_df: a one-column DataFrame which only contains user_id
+    2. user_df: the sampled users (output of sample_user)
     3. user: the user column
     4. percentage: keep x percent of the users
+    5. sampling: hash or random, as in sample_user
+    6. seed: the seed of the sampling
     '''
-    user_id_1_perc = user_df.sample(False, float(percentage), seed=123)
-    downsample_data = data.join(user_id_1_perc, user, how='inner').select(data.schema.names)
-    print("After downsampling, we only keep {0}% of the high-interation users. Now, we have {1} rows and {2} users.".
-          format(float(percentage) * 100, downsample_data.count(), downsample_data.select(user).distinct().count()))
-    return downsample_data
+    if sampling == "hash":
+        # the hash predicate runs in the scan; the semi join only checks the (small) frequent users
+        downsample_data = data.filter(user_hash_condition(user=user, percentage=percentage, seed=seed)) \
+            .join(F.broadcast(user_df.select(user)), user, how='left_semi')
+    else:
+        downsample_data = data.join(user_df.select(user), user, how='inner')
+    return downsample_data.select(data.schema.names)
 
 
 def create_repeated_index(data, col_name):
@@ -69,14 +129,8 @@ def create_repeated_index(data, col_name):
     1. data
     2. col_name: the column which would become an index column
     '''
-    indexer = data.select(col_name).distinct() \
-        .withColumn(col_name + "_index",
-                    row_number()
-                    .over(
-                        Window.orderBy(
-                            monotonically_increasing_id())
-                    )
-                    )
+    # zipWithIndex instead of row_number over a global window, which moved everything into one partition
+    indexer = assign_dense_ids(data.select(col_name).distinct(), col_name, offset=1)
     data = data.join(indexer, col_name)
     return data
 
@@ -94,7 +148,8 @@ def create_row_index(data):
     return data
 
 
-def create_subset(data, threshold=500, percentage=0.01, user="user_id", item="book_id"):
+def create_subset(data, threshold=500, percentage=0.01, user="user_id", item="book_id", sampling="hash", seed=123,
+                  run_log=None):
     '''
     This function is to remove some users with low-frequent interactions and
     downsample the dataframe since 100% of the data is too big for the system
@@ -102,15 +157,97 @@ def create_subset(data, threshold=500, percentage=0.01, user="user_id", item="bo
     1. data
     2. threshold: users with less than k interactions would be removed
     3. percentage: the percentage of the users we are going to keep by sampling
+    4. sampling: hash (deterministic and nested) or random
+    5. seed: the seed of the sampling
+    6. run_log: an instrumentation.RunLog recording the filter and the sampling as two steps
+    Output:
+    1. final_data: the subset
+    2. user_counts: the cached per-user counts the subset is filtered with (unpersist it after writing the subset)
     '''
+    # 0. count the interactions per user once; it is reused by the statistics and the filter
+    with log_step(run_log, "filter", threshold=threshold):
+        user_counts = count_user_interactions(data=data, user=user).cache()
+        # the aggregation over the whole table runs here; the sampling reads its cache
+        user_counts.count()
     # 1. remove users with lower interactions
     print("Removing lower-interaction users.")
-    freq_user = get_frequent_user(data=data, user=user, threshold=threshold)
+    freq_user = get_frequent_user(user_counts, threshold=threshold)
+    with log_step(run_log, "sample", threshold=threshold, percentage=percentage):
+        sampled_user = sample_user(freq_user, user=user, percentage=percentage, sampling=sampling, seed=seed)
+        stats = get_subset_stats(user_counts, sampled_user, threshold=threshold)
+    # print the percentage of the user_id which is removed
+    print("I remove {0}% of the total users who have less than {1} iteractions.".
+          format(str(round((1 - stats["n_frequent_users"] / stats["n_users"]) * 100, 2)), threshold))
     # 2. downsampling with x% of the users from data_freq table
     print("Downsampling the users. Only keeping " + str(int(percentage * 100)) + "%.")
-    final_data = downsampling(data=data, user_df=freq_user, user=user, percentage=percentage)
+    final_data = downsampling(data=data, user_df=sampled_user, user=user, percentage=percentage,
+                              sampling=sampling, seed=seed)
+    print("After downsampling, we only keep {0}% of the high-interation users. Now, we have {1} rows and {2} users.".
+          format(float(percentage) * 100, stats["n_sampled_rows"], stats["n_sampled_users"]))
     # 3. add user_id_index, book_id_index, row_id to the dataset
-    return final_data
+    return final_data, user_counts
+
+
+def create_subset_ladder(data, thresholds=(500,), percentages=(0.01, 0.1, 0.25, 1.0),
+                         user="user_id", item="book_id", seed=123, run_log=None):
+    '''
+    This function is to create every (threshold, percentage) subset from one pass over the data.
+    The rows of the loosest subset are tagged once with their user count and hash bucket
+    and kept in memory (or disk); every subset is then a filter on the tagged rows.
+    Only the hash sampling can be used, because it makes the subsets nested.
+    Input:
+    1. data
+    2. thresholds: a list of thresholds (users with less than k interactions would be removed)
+    3. percentages: a list of percentages of the users we are going to keep
+    4. seed: the seed of the hash sampling
+    5. run_log: an instrumentation.RunLog recording the filter and the sampling as two steps
+    Output:
+    1. tagged_data: the persisted tagged rows (unpersist it after writing the subsets)
+    2. ladder: a dictionary of {(threshold, percentage): (subset DataFrame, stats dictionary)}
+    '''
+    thresholds = [int(threshold) for threshold in thresholds]
+    percentages = [float(percentage) for percentage in percentages]
+    # 0. count the interactions per user once
+    with log_step(run_log, "filter", threshold=thresholds):
+        user_counts = count_user_interactions(data=data, user=user).cache()
+        user_counts.count()
+    # 1. tag the rows of the loosest subset (lowest threshold, highest percentage) in one pass
+    with log_step(run_log, "sample", threshold=thresholds, percentage=percentages):
+        loosest_user = get_frequent_user(user_counts, threshold=min(thresholds))
+        loosest_user = sample_user(loosest_user, user=user, percentage=max(percentages), sampling="hash", seed=seed)
+        tagged_data = data.filter(user_hash_condition(user=user, percentage=max(percentages), seed=seed)) \
+            .join(F.broadcast(loosest_user.select(user, col("count").alias("user_count"))), user, how='inner') \
+            .withColumn("user_bucket", user_hash_bucket(user=user, seed=seed)) \
+            .persist(StorageLevel.MEMORY_AND_DISK)
+        # fill the cache of the tagged rows now, so that user_counts is only needed by the statistics below
+        tagged_data.count()
+        # 2. every subset is a filter on the tagged rows; the statistics come from user_counts
+        ladder = {}
+        for threshold in thresholds:
+            freq_user = get_frequent_user(user_counts, threshold=threshold)
+            for percentage in percentages:
+                sampled_user = sample_user(freq_user, user=user, percentage=percentage, sampling="hash", seed=seed)
+                stats = get_subset_stats(user_counts, sampled_user, threshold=threshold)
+                stats["threshold"], stats["percentage"] = threshold, percentage
+                print("Threshold {0}: I remove {1}% of the total users who have less than {0} iteractions.".
+                      format(threshold, str(round((1 - stats["n_frequent_users"] / stats["n_users"]) * 100, 2))))
+                print("After downsampling, we only keep {0}% of the high-interation users. Now, we have {1} rows and {2} users.".
+                      format(percentage * 100, stats["n_sampled_rows"], stats["n_sampled_users"]))
+                subset = tagged_data.filter((col("user_count") >= threshold) &
+                                            (col("user_bucket") < int(round(percentage * HASH_BUCKETS)))) \
+                    .select(data.schema.names)
+                ladder[(threshold, percentage)] = (subset, stats)
+    user_counts.unpersist()
+    return tagged_data, ladder
+
+
+def ladder_path(write_parquet_path, threshold, percentage):
+    '''
+    This function is to name the output of one subset of the ladder,
+    e.g. subset.parquet -> subset_1perc_500.parquet
+    '''
+    base = write_parquet_path[:-len(".parquet")] if write_parquet_path.endswith(".parquet") else write_parquet_path
+    return "{0}_{1:g}perc_{2}.parquet".format(base, percentage * 100, threshold)
 
 
 def create_schema():
@@ -133,8 +270,20 @@ def set_arguments():
     parser.add_argument("--write_parquet_path", help="Specifying the path of the parquet file you want to write.")
     parser.add_argument("--thres", help="Delete the users with less than thres (k) interactions.")
     parser.add_argument("--percentage", help="Downsampling the table with only k% of the user left.")
-    parser.add_argument("--set_memory", help="Specifying the memory.")
+    parser.add_argument("--thres_list", default=None, help="A list of thresholds, e.g. [20,500]; writes every subset of the ladder in one job.")
+    parser.add_argument("--percentage_list", default=None, help="A list of percentages for the ladder, e.g. [0.01,0.1,0.25,1.0].")
+    parser.add_argument("--sampling", default="hash", choices=["hash", "random"], help="hash: deterministic and nested user samples; random: the former sample().")
+    parser.add_argument("--sample_seed", default="123", help="The seed of the user sampling.")
+    parser.add_argument("--id_dict_path", default=None, help="Folder name of the id dictionaries; adds user_id_index and book_id_index.")
+    parser.add_argument("--run_log", default=None, help="Local JSON-lines file of the wall time and the Spark metrics of every step.")
+    add_spark_arguments(parser)
     args = parser.parse_args()
+    if (args.thres_list is None) != (args.percentage_list is None):
+        parser.error("--thres_list and --percentage_list go together.")
+    if args.thres_list is None and (args.thres is None or args.percentage is None):
+        parser.error("--thres and --percentage are required without --thres_list.")
+    if args.thres_list is not None and args.sampling != "hash":
+        parser.error("The ladder (--thres_list) only uses the hash sampling, since its subsets must be nested.")
     return args
 
 
@@ -143,13 +292,15 @@ if __name__ == "__main__":
     ### input arguments ###
     args = set_arguments()
 
-    ### setting ###
-    spark = settings(args.set_memory)
-
     # path
     from_hdfs_path = "hdfs:///user/" + args.from_net_id + "/goodreads/"
     to_hdfs_path = "hdfs:///user/" + args.to_net_id + "/goodreads/"
 
+    ### setting ###
+    spark = spark_session(args.profile, args.set_memory, args.cores,
+                          input_path=from_hdfs_path + "data/" + args.read_parquet_path, app_name="downsampling")
+    run_log = RunLog(spark, args.run_log, script="downsampling")
+
     # hdfs_path = "" # for local testing
 
     ### 1. read the parquet file ###
@@ -157,23 +308,50 @@ if __name__ == "__main__":
     print("Reading the file.")
     data_schema = create_schema()
 
-    data = spark.read.schema(data_schema).parquet(from_hdfs_path + "data/" + args.read_parquet_path)
+    data = run_log.run("read", lambda: spark.read.schema(data_schema).parquet(from_hdfs_path + "data/" + args.read_parquet_path))
     # repartition data
     #data = data.repartition(40)
 
     ### 2. downsampling ###
-    print("Downsampling the dataframe.")
-    downsample_data = create_subset(data=data, threshold=args.thres, percentage=float(args.percentage))
+    # the cached DataFrame the subsets are filtered from, unpersisted after writing
+    cached_data = None
+    if args.thres_list is None:
+        print("Downsampling the dataframe.")
+        downsample_data, cached_data = create_subset(data=data, threshold=args.thres, percentage=float(args.percentage),
+                                                     sampling=args.sampling, seed=int(args.sample_seed), run_log=run_log)
+        subsets = {args.write_parquet_path: downsample_data}
+    else:
+        print("Downsampling the dataframe into every subset of the ladder.")
+        cached_data, ladder = create_subset_ladder(data=data,
+                                                   thresholds=eval(args.thres_list),
+                                                   percentages=eval(args.percentage_list),
+                                                   seed=int(args.sample_seed),
+                                                   run_log=run_log)
+        subsets = {}
+        for (threshold, percentage), (subset, stats) in ladder.items():
+            write_path = ladder_path(args.write_parquet_path, threshold, percentage)
+            subsets[write_path] = subset
+            # the statistics of each subset are saved next to it
+            spark.createDataFrame([Row(**stats)]).coalesce(1) \
+                .write.json(to_hdfs_path + "data/" + write_path[:-len(".parquet")] + "_stats", mode="overwrite")
     #downsample_data = create_subset_with_index(data=data, threshold=500, percentage=float(0.01))
     ### 3. create user_id_index and book_id_index (IntegerType) ###
     # index columns will be useful during training
-    #print("Creating index columns.")
-    #downsample_data = index_func(data=downsample_data, col_name="user_id")
-    #downsample_data = index_func(data=downsample_data, col_name="book_id")
+    # the dictionaries are updated from the whole table, so every subset shares the same ids
+    if args.id_dict_path is not None:
+        print("Creating index columns.")
+        dict_path = to_hdfs_path + "data/" + args.id_dict_path
+        for col_name in ["user_id", "book_id"]:
+            run_log.run("index", lambda: update_id_dictionary(spark, data, col_name, dict_path), column=col_name)
+        for write_path in subsets:
+            subsets[write_path] = index_with_dictionary(spark, subsets[write_path], dict_path, update=False)
 
     ### 4. write out downsample_data ###
     print("Writing the downsampling file.")
     data_schema = create_schema()
     #downsample_data.write.option("schema", data_schema).parquet(to_hdfs_path+"data/"+args.write_parquet_path, mode="overwrite")
-    downsample_data.write.parquet(to_hdfs_path + "data/" + args.write_parquet_path, mode="overwrite")
-    print("Finish outputing the subset.")
+    for write_path, downsample_data in subsets.items():
+        run_log.run("write", lambda: downsample_data.write.parquet(to_hdfs_path + "data/" + write_path, mode="overwrite"),
+                    path=write_path)
+        print("Finish outputing the subset " + write_path + ".")
+    cached_data.unpersist()
@@ -0,0 +1,310 @@
+import numpy as np
+import scipy.sparse as sp
+import json
+import os
+import time
+from local_als import lookup_index, solve_factors, solve_implicit_factors
+from topk import blocked_top_k, exclusion_matrix
+
+# the arrays of an export; every array is one .npy file which is opened as a memory map
+EXPORT_ARRAYS = ["user_ids", "user_factors", "item_ids", "item_factors"]
+# the id dictionaries of an export (raw ids sorted, and their dense ids), when the factors are indexed
+DICTIONARY_ARRAYS = ["raw_ids", "raw_index"]
+
+
+def json_value(value):
+    '''
+    This function is to write the NumPy scalars of the manifest (e.g. the metrics) as JSON numbers.
+    '''
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def version_path(export_root, version):
+    '''
+    This function is to get the folder of one version of an export.
+    '''
+    return os.path.join(export_root, "v{0}".format(version))
+
+
+def latest_version(export_root):
+    '''
+    This function is to get the version in the LATEST file of an export; None if nothing was exported.
+    '''
+    latest = os.path.join(export_root, "LATEST")
+    if not os.path.exists(latest):
+        return None
+    with open(latest) as file:
+        return int(file.read().strip())
+
+
+def dictionary_arrays(raw_ids, index_ids):
+    '''
+    This function is to sort an id dictionary by its raw ids, so that a raw id is found by a
+    binary search. The raw ids of the strings are written as fixed-width unicode (memory-mappable).
+    '''
+    raw_ids = np.asarray(raw_ids)
+    if raw_ids.dtype == object:
+        raw_ids = raw_ids.astype(str)
+    order = np.argsort(raw_ids, kind="stable")
+    return {"raw_ids": raw_ids[order], "raw_index": np.asarray(index_ids)[order]}
+
+
+def export_factors(export_root, user_ids, user_factors, item_ids, item_factors, manifest, dictionaries=None):
+    '''
+    This function is to write a new version of the factors for serving, without Spark:
+    the factors are contiguous float32 arrays sorted by id (memory-mappable .npy files),
+    the ids are the mapping tables (row i of user_factors is user_ids[i]), and the manifest
+    carries the configuration, the data version and the metrics.
+    The version is published by rewriting LATEST only after every file is written, so a
+    reader never sees a half-written version.
+    Input:
+    1. export_root: a local folder; the versions are its subfolders v1, v2, ...
+    2. user_ids, user_factors: the ids and the factors of the users
+    3. item_ids, item_factors: the ids and the factors of the items
+    4. manifest: a dictionary, e.g. rank, regParam, maxIter, data_version, metrics
+    5. dictionaries: None, or {"user": (raw ids, dense ids), "item": (raw ids, dense ids)} when the
+       factors are indexed by the id dictionaries, so that the loader can serve the raw ids
+    Output:
+    1. the new version
+    '''
+    if not os.path.exists(export_root):
+        os.makedirs(export_root)
+    versions = [int(name[1:]) for name in os.listdir(export_root) if name.startswith("v") and name[1:].isdigit()]
+    version = max(versions) + 1 if versions else 1
+    path = version_path(export_root, version)
+    os.makedirs(path)
+    user_order, item_order = np.argsort(user_ids, kind="stable"), np.argsort(item_ids, kind="stable")
+    arrays = {"user_ids": np.asarray(user_ids)[user_order],
+              "user_factors": np.ascontiguousarray(np.asarray(user_factors)[user_order], dtype=np.float32),
+              "item_ids": np.asarray(item_ids)[item_order],
+              "item_factors": np.ascontiguousarray(np.asarray(item_factors)[item_order], dtype=np.float32)}
+    for kind, (raw_ids, index_ids) in (dictionaries or {}).items():
+        arrays.update(("{0}_{1}".format(kind, name), array) for name, array in dictionary_arrays(raw_ids, index_ids).items())
+    for name in arrays:
+        np.save(os.path.join(path, name + ".npy"), arrays[name])
+    manifest = dict(manifest, version=version, created=time.strftime("%Y-%m-%d %H:%M:%S"),
+                    dictionaries=sorted(dictionaries or {}),
+                    rank=int(arrays["user_factors"].shape[1]),
+                    n_users=len(arrays["user_ids"]), n_items=len(arrays["item_ids"]), dtype="float32")
+    with open(os.path.join(path, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2, default=json_value)
+    # publish the version
+    latest_tmp = os.path.join(export_root, "LATEST.tmp")
+    with open(latest_tmp, "w") as file:
+        file.write(str(version))
+    os.replace(latest_tmp, os.path.join(export_root, "LATEST"))
+    return version
+
+
+def export_spark_model(model, export_root, manifest, dictionaries=None):
+    '''
+    This function is to export the factors of a fitted pyspark.ml.recommendation.ALSModel
+    (see export_factors). The factors are collected to the driver once.
+    Input:
+    4. dictionaries: None, or {"user": DataFrame, "item": DataFrame} of the (raw id, dense id)
+       columns, e.g. user_id and user_id_index; only the ids with factors are collected
+    '''
+    user_pdf = model.userFactors.toPandas()
+    item_pdf = model.itemFactors.toPandas()
+    collected = {}
+    for kind, factors in [("user", model.userFactors), ("item", model.itemFactors)]:
+        if dictionaries is not None and kind in dictionaries:
+            raw_col, index_col = dictionaries[kind].columns[:2]
+            pdf = dictionaries[kind].select(raw_col, index_col) \
+                .join(factors.select(factors["id"].alias(index_col)), index_col, how="left_semi").toPandas()
+            collected[kind] = (pdf[raw_col].values, pdf[index_col].values)
+    return export_factors(export_root,
+                          user_pdf["id"].values, np.stack(user_pdf["features"].values),
+                          item_pdf["id"].values, np.stack(item_pdf["features"].values),
+                          manifest, dictionaries=collected)
+
+
+class FactorModel(object):
+    '''
+    The factors of one exported version, opened as read-only memory maps. It only needs NumPy
+    and SciPy: no SparkSession and no JVM, so a recommendation takes milliseconds.
+    '''
+
+    def __init__(self, path, manifest, user_ids, user_factors, item_ids, item_factors, dictionaries=None):
+        self.path = path
+        self.manifest = manifest
+        self.user_ids = user_ids
+        self.user_factors = user_factors
+        self.item_ids = item_ids
+        self.item_factors = item_factors
+        self.item_gram = None
+        # {kind: (raw ids sorted, dense ids)}, and the same sorted by the dense ids once needed
+        self.dictionaries = dictionaries or {}
+        self.dense_dictionaries = {}
+
+    def dictionary(self, kind):
+        '''
+        This function is to get the (raw ids sorted, dense ids) of the user or item id dictionary.
+        '''
+        if kind not in self.dictionaries:
+            raise ValueError("Version {0} has no {1} id dictionary; it serves the dense ids only.".
+                             format(self.manifest.get("version"), kind))
+        return self.dictionaries[kind]
+
+    def dense_ids(self, kind, raw_ids):
+        '''
+        This function is to map raw ids (e.g. user_id) to the dense ids of the factors (user_id_index).
+        Output:
+        1. dense: the dense ids, -1 for the raw ids which are not in the dictionary
+        2. known: whether the raw id is in the dictionary
+        '''
+        raw, index = self.dictionary(kind)
+        positions, known = lookup_index(raw, np.asarray(raw_ids, dtype=raw.dtype))
+        return np.where(known, index[positions], -1), known
+
+    def raw_ids(self, kind, dense_ids):
+        '''
+        This function is to map dense ids back to the raw ids; -1 stays -1 (in the dtype of the raw ids).
+        '''
+        if kind not in self.dense_dictionaries:
+            raw, index = self.dictionary(kind)
+            order = np.argsort(index, kind="stable")
+            self.dense_dictionaries[kind] = (np.asarray(index)[order], np.asarray(raw)[order])
+        index, raw = self.dense_dictionaries[kind]
+        dense_ids = np.asarray(dense_ids)
+        positions, known = lookup_index(index, dense_ids)
+        return np.where(known & (dense_ids >= 0), raw[positions], np.array(-1).astype(raw.dtype))
+
+    def user_rows(self, users, raw=False):
+        '''
+        This function is to find the rows of the users; known is False for the users without factors.
+        With raw, the users are raw ids (user_id) mapped through the id dictionary of the export.
+        '''
+        if not raw:
+            return lookup_index(self.user_ids, np.asarray(users))
+        dense, in_dictionary = self.dense_ids("user", users)
+        rows, known = lookup_index(self.user_ids, dense)
+        return rows, known & in_dictionary
+
+    def item_rows(self, items, raw=False):
+        '''
+        This function is to find the rows of the items; known is False for the items without factors.
+        With raw, the items are raw ids (book_id) mapped through the id dictionary of the export.
+        '''
+        if not raw:
+            return lookup_index(self.item_ids, np.asarray(items))
+        dense, in_dictionary = self.dense_ids("item", items)
+        rows, known = lookup_index(self.item_ids, dense)
+        return rows, known & in_dictionary
+
+    def recommend(self, users, n=10, exclude=None, item_block_size=65536, raw=False):
+        '''
+        This function is to recommend the n items with the highest scores to every user.
+        Input:
+        1. users: a list of user ids
+        2. n: number of items per user
+        3. exclude: None, or a list of item id arrays (one per user) which are not recommended,
+           e.g. the books already read
+        4. item_block_size: number of items scored at once (see topk.blocked_top_k)
+        5. raw: whether the user and item ids (of users, exclude and the output) are the raw ids
+        Output:
+        1. known: whether the user has factors; the other users get no recommendation
+        2. items: (users x n) item ids, -1 where there are fewer than n items
+        3. scores: (users x n) scores
+        '''
+        rows, known = self.user_rows(users, raw=raw)
+        exclude_matrix = None
+        if exclude is not None:
+            if raw:
+                exclude = [None if items is None else self.dense_ids("item", items)[0] for items in exclude]
+            exclude_matrix = exclusion_matrix(self.item_ids, [items for items, is_known in zip(exclude, known) if is_known])
+        top_items, top_scores = blocked_top_k(self.user_factors[rows[known]], self.item_factors, k=n,
+                                              exclude=exclude_matrix, item_block_size=item_block_size)
+        items = np.full((len(rows), n), -1, dtype=np.int64)
+        scores = np.full((len(rows), n), -np.inf, dtype=np.float32)
+        items[known] = np.where(top_items >= 0, self.item_ids[np.maximum(top_items, 0)], -1)
+        scores[known] = top_scores
+        return known, (self.raw_ids("item", items) if raw else items), scores
+
+    def fold_in(self, histories, regParam=None, cg_steps=10):
+        '''
+        This function is to compute the factors of new users (cold start) from their interactions,
+        without retraining: every user solves the regularized least squares of ALS against the
+        fixed item factors (one half-sweep of local_als for these users only). The normal equations
+        only involve the items of the interactions, so a batch of thousands of users takes
+        milliseconds; the implicit-feedback Gram matrix of the whole catalog is computed once
+        and kept.
+        Input:
+        1. histories: a list of (item ids, ratings) pairs, one per user; the ratings are the
+           confidence weights for implicit feedback (manifest rating_col), and unknown items are ignored
+        2. regParam: the regularization parameter; the one of the manifest by default
+        3. cg_steps: the conjugate gradient steps of implicit feedback
+        Output:
+        1. (users x rank) array of factors; a user without a known item gets zeros
+           (recommend_new_users gives them no recommendation)
+        '''
+        regParam = self.manifest["regParam"] if regParam is None else regParam
+        nonnegative = self.manifest.get("nonnegative", True)
+        items = [np.asarray(user_items, dtype=self.item_ids.dtype) for user_items, _ in histories]
+        ratings = np.concatenate([np.asarray(user_ratings, dtype=np.float64) for _, user_ratings in histories] + [np.zeros(0)])
+        positions, known = lookup_index(self.item_ids, np.concatenate(items + [np.zeros(0, dtype=self.item_ids.dtype)]))
+        rows = np.repeat(np.arange(len(items)), [len(user_items) for user_items in items])
+        # only the columns of the interactions are solved against
+        columns, compact = np.unique(positions[known], return_inverse=True)
+        ratings = sp.csr_matrix((ratings[known], (rows[known], compact)), shape=(len(items), len(columns)))
+        fixed_factors = np.asarray(self.item_factors[columns], dtype=np.float64)
+        factors = np.zeros((len(items), self.item_factors.shape[1]))
+        if self.manifest.get("implicitPrefs", False):
+            if self.item_gram is None:
+                item_factors = np.asarray(self.item_factors, dtype=np.float64)
+                self.item_gram = item_factors.T.dot(item_factors)
+            return solve_implicit_factors(ratings, fixed_factors, factors, regParam,
+                                          alpha=self.manifest.get("alpha", 1.0), nonnegative=nonnegative,
+                                          cg_steps=cg_steps, YtY=self.item_gram)
+        return solve_factors(ratings, fixed_factors, factors, regParam, nonnegative)
+
+    def recommend_new_users(self, histories, n=10, exclude_seen=True, regParam=None, item_block_size=65536,
+                            raw=False):
+        '''
+        This function is to recommend the top n items to new users from their interactions (see fold_in).
+        Input:
+        1. histories: a list of (item ids, ratings) pairs, one per user
+        2. n: number of items per user
+        3. exclude_seen: whether to skip the items of the histories
+        4. regParam: the regularization parameter; the one of the manifest by default
+        5. raw: whether the item ids (of the histories and the output) are the raw ids
+        Output:
+        1. items: (users x n) item ids, -1 where there are fewer than n items; all -1 for a user
+           whose folded-in factors are zeros (e.g. without a known item)
+        2. scores: (users x n) scores, -inf where there is no item
+        '''
+        if raw:
+            histories = [(self.dense_ids("item", user_items)[0], user_ratings) for user_items, user_ratings in histories]
+        user_factors = self.fold_in(histories, regParam=regParam)
+        # zero factors (e.g. no known item) would tie all the items at score 0, so they get no recommendation
+        known = np.any(user_factors != 0, axis=1)
+        exclude = None
+        if exclude_seen:
+            exclude = exclusion_matrix(self.item_ids, [user_items for (user_items, _), is_known in zip(histories, known)
+                                                       if is_known])
+        top_items, top_scores = blocked_top_k(user_factors[known], self.item_factors, k=n, exclude=exclude,
+                                              item_block_size=item_block_size)
+        items = np.full((len(histories), n), -1, dtype=np.int64)
+        scores = np.full((len(histories), n), -np.inf, dtype=np.float32)
+        items[known] = np.where(top_items >= 0, self.item_ids[np.maximum(top_items, 0)], -1)
+        scores[known] = top_scores
+        return (self.raw_ids("item", items) if raw else items), scores
+
+
+def load_factors(export_root, version=None):
+    '''
+    This function is to open one exported version (the LATEST one by default) without Spark.
+    Output:
+    1. FactorModel
+    '''
+    if version is None:
+        version = latest_version(export_root)
+    path = version_path(export_root, version)
+    with open(os.path.join(path, "manifest.json")) as file:
+        manifest = json.load(file)
+    arrays = dict((name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r")) for name in EXPORT_ARRAYS)
+    dictionaries = dict((kind, tuple(np.load(os.path.join(path, "{0}_{1}.npy".format(kind, name)), mmap_mode="r")
+                                     for name in DICTIONARY_ARRAYS))
+                        for kind in manifest.get("dictionaries", []))
+    return FactorModel(path, manifest, arrays["user_ids"], arrays["user_factors"],
+                       arrays["item_ids"], arrays["item_factors"], dictionaries=dictionaries)
@@ -0,0 +1,149 @@
+from pyspark.sql.types import StructType, StructField, IntegerType
+from pyspark.sql.utils import AnalysisException
+import pyspark.sql.functions as F
+import argparse
+from spark_config import spark_session, add_spark_arguments
+
+# ALS only accepts user and item ids in the IntegerType range
+MAX_INDEX = 2 ** 31 - 1
+
+
+def dictionary_path(dict_path, col_name):
+    '''
+    This function is to get the path of the side table of one column.
+    '''
+    return dict_path.rstrip("/") + "/" + col_name
+
+
+def read_id_dictionary(spark, dict_path, col_name):
+    '''
+    This function is to read the id dictionary (col_name, col_name_index) of one column.
+    It returns None if the dictionary has not been created yet.
+    '''
+    try:
+        return spark.read.parquet(dictionary_path(dict_path, col_name))
+    except AnalysisException:
+        return None
+
+
+def assign_dense_ids(values, col_name, offset=0):
+    '''
+    This function is to give every distinct value a dense integer id starting from offset.
+    zipWithIndex only runs one extra job to count the rows of each partition, so
+    nothing is moved into a single partition or collected to the driver.
+    Input:
+    1. values: a one-column DataFrame of distinct values
+    2. col_name: name of the column
+    3. offset: the first id
+    '''
+    index_schema = StructType([
+        values.schema[col_name],
+        StructField(col_name + "_index", IntegerType(), False)
+    ])
+    indexer = values.rdd \
+        .map(lambda row: row[0]) \
+        .zipWithIndex() \
+        .map(lambda pair: (pair[0], int(pair[1] + offset))) \
+        .toDF(index_schema)
+    return indexer
+
+
+def update_id_dictionary(spark, data, col_name, dict_path):
+    '''
+    This function is to append the unseen values of a column to its id dictionary.
+    The ids of the existing values never change, so the indexed tables written
+    before stay valid.
+    Input:
+    1. spark: the SparkSession
+    2. data: a DataFrame which contains col_name
+    3. col_name: the column which needs dense ids, e.g. user_id or book_id
+    4. dict_path: the folder of the id dictionaries
+    Output:
+    1. the complete dictionary DataFrame
+    '''
+    dictionary = read_id_dictionary(spark, dict_path, col_name)
+    new_values = data.select(col_name).distinct()
+    offset = 0
+    if dictionary is not None:
+        new_values = new_values.join(dictionary, col_name, how="left_anti")
+        max_index = dictionary.agg(F.max(col_name + "_index")).first()[0]
+        offset = 0 if max_index is None else max_index + 1
+    # cache the new ids so that counting and writing see the same assignment
+    new_entries = assign_dense_ids(new_values, col_name, offset).cache()
+    n_new = new_entries.count()
+    if offset + n_new - 1 > MAX_INDEX:
+        new_entries.unpersist()
+        raise ValueError("The {0} dictionary would exceed the IntegerType range.".format(col_name))
+    print("Adding {0} new values to the {1} dictionary (ids from {2}).".format(n_new, col_name, offset))
+    if n_new > 0:
+        new_entries.write.parquet(dictionary_path(dict_path, col_name), mode="append")
+    new_entries.unpersist()
+    return read_id_dictionary(spark, dict_path, col_name)
+
+
+def apply_id_dictionary(data, dictionary, col_name):
+    '''
+    This function is to add the col_name_index column to the data from the dictionary.
+    It is an inner join: the rows whose value is not in the dictionary are dropped (they are
+    not counted, since that would be one more pass over the data).
+    '''
+    return data.join(dictionary, on=col_name, how="inner")
+
+
+def index_with_dictionary(spark, data, dict_path, columns=("user_id", "book_id"), update=True):
+    '''
+    This function is to add dense integer index columns (user_id_index, book_id_index)
+    to the data. The dictionaries are updated with unseen values first, unless update is False.
+    Input:
+    1. spark: the SparkSession
+    2. data
+    3. dict_path: the folder of the id dictionaries
+    4. columns: the columns to index
+    5. update: whether to append the unseen values to the dictionaries; without it, the rows of
+       the values which are not in the dictionaries yet are dropped
+    '''
+    for col_name in columns:
+        if update:
+            dictionary = update_id_dictionary(spark, data, col_name, dict_path)
+        else:
+            dictionary = read_id_dictionary(spark, dict_path, col_name)
+            if dictionary is None:
+                raise ValueError("There is no {0} dictionary in {1}; create it with id_dictionary.py first.".
+                                 format(col_name, dictionary_path(dict_path, col_name)))
+        data = apply_id_dictionary(data, dictionary, col_name)
+    return data
+
+
+def set_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from_net_id", help="Inputing the netID for reading data")
+    parser.add_argument("--to_net_id", help="Inputing the netID for saving the dictionaries")
+    parser.add_argument("--read_parquet_path", help="Specifying the path of the parquet file you want to index.")
+    parser.add_argument("--dict_path", default="id_dictionary", help="Folder name of the id dictionaries.")
+    add_spark_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+
+    ### input arguments ###
+    args = set_arguments()
+
+    # path
+    from_hdfs_path = "hdfs:///user/" + args.from_net_id + "/goodreads/"
+    to_hdfs_path = "hdfs:///user/" + args.to_net_id + "/goodreads/"
+
+    ### setting ###
+    spark = spark_session(args.profile, args.set_memory, args.cores,
+                          input_path=from_hdfs_path + "data/" + args.read_parquet_path, app_name="id_dictionary")
+
+    ### 1. read the parquet file ###
+    print("Reading the file.")
+    data = spark.read.parquet(from_hdfs_path + "data/" + args.read_parquet_path)
+
+    ### 2. add the new users and books to the dictionaries ###
+    for col_name in ["user_id", "book_id"]:
+        print("Updating the " + col_name + " dictionary.")
+        update_id_dictionary(spark, data, col_name, to_hdfs_path + "data/" + args.dict_path)
+    print("Finish updating the dictionaries.")
@@ -0,0 +1,32 @@
+import pyspark.sql.functions as F
+from pyspark.sql.functions import col
+
+CONFIDENCE_SIGNALS = ["is_read", "rating", "is_reviewed"]
+
+
+def confidence_column(weights=(1.0, 1.0, 1.0)):
+    '''
+    This function is to build the confidence weight of an interaction from the Goodreads signals:
+    weights[0] * is_read + weights[1] * rating + weights[2] * is_reviewed.
+    An interaction with a positive weight is a positive preference; the weight only tells how sure
+    we are about it, so most interactions with rating 0 still count with the confidence of is_read.
+    ALS turns it into the confidence 1 + alpha * weight. An interaction with a zero weight (e.g. a
+    book shelved but not read, neither rated nor reviewed) is not an interaction: like Spark,
+    local_als.positive_entries drops it, so the book stays unobserved for the user.
+    Input:
+    1. weights: the weights of is_read, rating and is_reviewed
+    '''
+    terms = [F.coalesce(col(signal), F.lit(0)).cast("double") * float(weight)
+             for signal, weight in zip(CONFIDENCE_SIGNALS, weights)]
+    return terms[0] + terms[1] + terms[2]
+
+
+def add_confidence(data, weights=(1.0, 1.0, 1.0), confidence="confidence"):
+    '''
+    This function is to add the confidence column for implicit-feedback ALS (implicitPrefs=True).
+    Input:
+    1. data: a DataFrame with the is_read, rating and is_reviewed columns
+    2. weights: the weights of is_read, rating and is_reviewed
+    3. confidence: the name of the new column
+    '''
+    return data.withColumn(confidence, confidence_column(weights))
@@ -0,0 +1,191 @@
+from pyspark.sql.functions import col, lit
+from functools import reduce
+import numpy as np
+import argparse
+import ast
+import time
+from id_dictionary import index_with_dictionary
+from implicit_feedback import add_confidence
+from local_als import LocalALS, lookup_index, build_rating_matrix
+from factor_export import load_factors, export_factors
+from spark_config import spark_session, add_spark_arguments
+
+
+def merge_factors(ids, factors, new_ids, nonnegative=True, seed=123):
+    '''
+    This function is to add small random factors for the new ids (as LocalALS.init_factors),
+    keeping the ids sorted. Zero factors would never move: a new user who only read new books
+    would be solved against their zero factors, and the other way around, at every sweep.
+    Output:
+    1. ids, factors: the merged ids and their factors (float64)
+    '''
+    merged_ids = np.union1d(ids, new_ids)
+    rows, known = lookup_index(np.asarray(ids), merged_ids)
+    merged = LocalALS(rank=factors.shape[1], nonnegative=nonnegative, seed=seed).init_factors(len(merged_ids))
+    merged[known] = factors[rows[known]]
+    return merged_ids, merged
+
+
+def merge_dictionary(dictionary, raw_ids, index_ids):
+    '''
+    This function is to add the (raw id, dense id) pairs of the new ids to an id dictionary of the
+    export (see factor_export.export_factors).
+    Output:
+    1. raw ids, dense ids
+    '''
+    raw, index = dictionary
+    new = ~np.isin(index_ids, index)
+    return np.concatenate([np.asarray(raw), np.asarray(raw_ids)[new]]), np.concatenate([np.asarray(index), np.asarray(index_ids)[new]])
+
+
+def refresh_factors(model, interactions, users, items, regParam, n_sweeps=2, nonnegative=True,
+                    implicitPrefs=False, alpha=1.0, cg_steps=10,
+                    user="user_id_index", item="book_id_index", rating="rating"):
+    '''
+    This function is to update an exported model with new interactions without retraining it:
+    only the factors of the given users and items are solved again (ALS half-sweeps with
+    local_als), against the fixed factors of everything else. Every sweep first solves the
+    items (so the new books get factors from the users who read them), then the users.
+    Input:
+    1. model: the output of factor_export.load_factors
+    2. interactions: a pandas DataFrame of every interaction (old and new) of the users and the items
+    3. users: the ids of the users to refresh (new users get factors too)
+    4. items: the ids of the items to refresh; at least the new items
+    5. regParam, nonnegative, implicitPrefs, alpha: the configuration of the model
+    6. n_sweeps: number of (items, users) sweeps
+    7. cg_steps: the conjugate gradient steps of implicit feedback; the new rows start from zero
+    8. user, item, rating: column names
+    Output:
+    1. user_ids, user_factors, item_ids, item_factors: the refreshed factors
+    '''
+    users, items = np.unique(users), np.unique(items)
+    user_ids, user_factors = merge_factors(model.user_ids, model.user_factors, users, nonnegative=nonnegative)
+    item_ids, item_factors = merge_factors(model.item_ids, model.item_factors, items, nonnegative=nonnegative,
+                                           seed=124)
+    user_rows, item_rows = lookup_index(user_ids, users)[0], lookup_index(item_ids, items)[0]
+    # the rows to solve against every column, so that Y'Y of implicit feedback covers the whole catalog
+    user_ratings = build_rating_matrix(interactions, user=user, item=item, rating=rating,
+                                       user_ids=users, item_ids=item_ids)[0]
+    item_ratings = build_rating_matrix(interactions, user=item, item=user, rating=rating,
+                                       user_ids=items, item_ids=user_ids)[0]
+    als = LocalALS(rank=user_factors.shape[1], regParam=regParam, nonnegative=nonnegative,
+                   implicitPrefs=implicitPrefs, alpha=alpha, cg_steps=cg_steps)
+    for _ in range(n_sweeps):
+        if len(items) > 0:
+            item_factors[item_rows] = als.solve(item_ratings, user_factors, item_factors[item_rows])
+        user_factors[user_rows] = als.solve(user_ratings, item_factors, user_factors[user_rows])
+    return user_ids, user_factors, item_ids, item_factors
+
+
+def read_interactions(spark, path, id_dict_path=None, implicit=False, confidence_weights=(1, 1, 1), update=False):
+    '''
+    This function is to read interactions with the columns of the model: the dense ids from the
+    id dictionaries, and the confidence weights for implicit feedback.
+    '''
+    data = spark.read.parquet(path)
+    if id_dict_path is not None:
+        data = index_with_dictionary(spark, data, id_dict_path, update=update)
+    if implicit:
+        data = add_confidence(data, weights=confidence_weights)
+    return data
+
+
+def set_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from_net_id", help="Inputing the netID for reading data")
+    parser.add_argument("--export_path", help="Local folder of the factor export (factor_export.py) to refresh.")
+    parser.add_argument("--delta_parquet_path", help="Specifying the path of the parquet file of the new interactions.")
+    parser.add_argument("--parquet_path", default=None, help="The interactions the model was trained on; the data version of the export by default.")
+    parser.add_argument("--id_dict_path", default=None, help="Folder name of the id dictionaries; they are updated with the new users and books.")
+    parser.add_argument("--confidence_weights", default=None, help="The weights of is_read, rating and is_reviewed in the confidence; only for the exports without them in the manifest.")
+    parser.add_argument("--n_sweeps", default="2", help="Number of ALS sweeps over the refreshed users and books.")
+    parser.add_argument("--update_items", action="store_true", help="Also refresh the books of the new interactions, not only the new books.")
+    parser.add_argument("--cg_steps", default="10", help="Conjugate gradient steps of implicit feedback.")
+    add_spark_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+
+    ### input arguments ###
+    args = set_arguments()
+
+    # path
+    from_hdfs_path = "hdfs:///user/" + args.from_net_id + "/goodreads/"
+    dict_path = None if args.id_dict_path is None else from_hdfs_path + "data/" + args.id_dict_path
+
+    ### setting ###
+    # the session is sized by the data of the model when it is given, since its scan is the largest
+    spark = spark_session(args.profile, args.set_memory, args.cores,
+                          input_path=from_hdfs_path + "data/" + (args.delta_parquet_path if args.parquet_path is None else args.parquet_path),
+                          app_name="incremental_refresh")
+    start_time = time.time()
+
+    ### 1. load the latest version ###
+    model = load_factors(args.export_path)
+    manifest = model.manifest
+    print("Refreshing version {0} ({1} users, {2} books).".format(manifest["version"], manifest["n_users"], manifest["n_items"]))
+    user_col, item_col = manifest.get("user_col", "user_id_index"), manifest.get("item_col", "book_id_index")
+    rating_col = manifest.get("rating_col", "rating")
+    implicit = manifest.get("implicitPrefs", False)
+    # the confidences are rebuilt with the weights of the training
+    weights = manifest.get("confidence_weights")
+    if weights is None and args.confidence_weights is not None:
+        weights = ast.literal_eval(args.confidence_weights)
+    if implicit and weights is None:
+        raise ValueError("The export has no confidence weights; pass the ones of the training with --confidence_weights.")
+
+    ### 2. read the new interactions ###
+    print("Reading the new interactions.")
+    delta_data = read_interactions(spark, from_hdfs_path + "data/" + args.delta_parquet_path, dict_path,
+                                   implicit, weights, update=True)
+    delta = delta_data.select(user_col, item_col, rating_col)
+    delta_pdf = delta.toPandas()
+    users = np.unique(delta_pdf[user_col].values)
+    items = np.unique(delta_pdf[item_col].values)
+    if not args.update_items:
+        items = items[~lookup_index(model.item_ids, items)[1]]
+    print("{0} new interactions of {1} users; refreshing {2} books.".format(len(delta_pdf), len(users), len(items)))
+
+    # the raw ids of the new dense ids, for the id dictionaries of the export
+    dictionaries = {}
+    if dict_path is not None:
+        for kind, index_col in [("user", user_col), ("item", item_col)]:
+            if kind in model.dictionaries:
+                raw_col = index_col[:-len("_index")]
+                pairs = delta_data.select(raw_col, index_col).distinct().toPandas()
+                dictionaries[kind] = merge_dictionary(model.dictionaries[kind], pairs[raw_col].values, pairs[index_col].values)
+
+    ### 3. collect the old interactions of the refreshed users and books ###
+    # the data of the model: its parquet file and the deltas of the earlier refreshes
+    parquet_path = manifest.get("data_version") if args.parquet_path is None else args.parquet_path
+    base_paths = [parquet_path] + manifest.get("deltas", [])
+    base = reduce(lambda left, right: left.union(right),
+                  [read_interactions(spark, from_hdfs_path + "data/" + path, dict_path, implicit, weights)
+                   .select(user_col, item_col, rating_col) for path in base_paths])
+    keys = spark.createDataFrame([(int(user),) for user in users], [user_col])
+    history = base.join(keys, user_col, how="left_semi")
+    if args.update_items and len(items) > 0:
+        item_keys = spark.createDataFrame([(int(item),) for item in items], [item_col])
+        history = history.union(base.join(item_keys, item_col, how="left_semi"))
+    # a new interaction replaces the old one of the same (user, book)
+    interactions = history.withColumn("is_new", lit(0)).union(delta.withColumn("is_new", lit(1))).toPandas() \
+        .sort_values("is_new", kind="stable") \
+        .drop_duplicates([user_col, item_col], keep="last")
+
+    ### 4. solve the refreshed factors and publish a new version ###
+    print("Solving the factors.")
+    user_ids, user_factors, item_ids, item_factors = refresh_factors(
+        model, interactions, users, items, manifest["regParam"], n_sweeps=int(args.n_sweeps),
+        nonnegative=manifest.get("nonnegative", True),
+        implicitPrefs=implicit, alpha=manifest.get("alpha", 1.0), cg_steps=int(args.cg_steps),
+        user=user_col, item=item_col, rating=rating_col)
+    refreshed = dict(manifest, base_version=manifest["version"],
+                     deltas=manifest.get("deltas", []) + [args.delta_parquet_path],
+                     refreshed_users=len(users), refreshed_items=len(items))
+    # the test metrics were measured on the base version
+    refreshed.pop("metrics", None)
+    version = export_factors(args.export_path, user_ids, user_factors, item_ids, item_factors, refreshed,
+                             dictionaries=dictionaries)
+    print("It takes {0} seconds to publish version {1}.".format(str(round(time.time() - start_time, 2)), version))
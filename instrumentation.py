@@ -0,0 +1,160 @@
+from contextlib import contextmanager, nullcontext
+import itertools
+import json
+import threading
+import time
+import urllib.request
+
+# the stage metrics of the Spark status API that are summed over the stages of a step
+STAGE_METRICS = {"inputBytes": "input_bytes",
+                 "outputBytes": "output_bytes",
+                 "shuffleReadBytes": "shuffle_read_bytes",
+                 "shuffleWriteBytes": "shuffle_write_bytes",
+                 "memoryBytesSpilled": "memory_bytes_spilled",
+                 "diskBytesSpilled": "disk_bytes_spilled"}
+
+
+class RunLog(object):
+    '''
+    A JSON-lines log of the steps of a run (read, filter, sample, split, fit, transform, evaluate,
+    save, ...). Every step runs its Spark jobs in its own job group, so afterwards the status
+    tracker gives its job and stage ids, and the status API of the Spark UI gives the metrics of
+    those stages: input and output bytes, shuffle read and write bytes, spilled bytes and the peak
+    execution memory of a task. The peak JVM memory of the executors (since the start of the
+    application) is recorded too. Without a path, nothing is recorded and the steps just run.
+    Spark is lazy: a step is charged for the jobs its actions run, so reading or filtering
+    without an action shows up in the step of the first action on its result.
+    '''
+
+    def __init__(self, spark, path=None, script=None, run_id=None):
+        self.spark = spark
+        self.path = path
+        self.script = script
+        self.run_id = time.strftime("%Y%m%d_%H%M%S") if run_id is None else run_id
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def stage(self, name, **tags):
+        '''
+        This function is to record one step (a with block): its wall time, its Spark jobs and
+        stages and their metrics. Nested steps are recorded separately, with their parent, and
+        they inherit its tags (e.g. the fit of a tuning cell carries the rank of the cell).
+        Input:
+        1. name: the name of the step, e.g. read, split, fit, evaluate
+        2. tags: extra fields of the record, e.g. rank, regParam, fold
+        '''
+        if self.path is None:
+            yield
+            return
+        sc = self.spark.sparkContext
+        group = "{0}_{1}_{2}".format(self.run_id, next(self.counter), name)
+        # job groups are local properties, so every thread (e.g. parallel tuning) has its own
+        previous = (sc.getLocalProperty("spark.jobGroup.id"), sc.getLocalProperty("spark.job.description"))
+        parents = getattr(self.local, "parents", [])
+        parent_tags = getattr(self.local, "tags", {})
+        self.local.parents = parents + [name]
+        self.local.tags = dict(parent_tags, **tags)
+        sc.setJobGroup(group, name)
+        start_time = time.time()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            wall_time = time.time() - start_time
+            sc.setLocalProperty("spark.jobGroup.id", previous[0])
+            sc.setLocalProperty("spark.job.description", previous[1])
+            self.local.parents = parents
+            self.local.tags = parent_tags
+            record = {"run_id": self.run_id, "script": self.script, "step": name,
+                      "parent": parents[-1] if parents else None,
+                      "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time)),
+                      "wall_seconds": round(wall_time, 3)}
+            record.update(parent_tags)
+            record.update(tags)
+            record.update(self.spark_metrics(group))
+            if error is not None:
+                record["error"] = error
+            self.write(record)
+
+    def run(self, name, function, **tags):
+        '''
+        This function is to run function() as one step (see stage) and return its result.
+        '''
+        with self.stage(name, **tags):
+            return function()
+
+    def status_api(self, endpoint):
+        '''
+        This function is to read one endpoint of the status API of the Spark UI; None if the UI is off.
+        '''
+        sc = self.spark.sparkContext
+        if not sc.uiWebUrl:
+            return None
+        url = "{0}/api/v1/applications/{1}/{2}".format(sc.uiWebUrl, sc.applicationId, endpoint)
+        try:
+            with urllib.request.urlopen(url, timeout=10) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def spark_metrics(self, group):
+        '''
+        This function is to collect the job ids, the stage ids and the stage metrics of a job group.
+        '''
+        tracker = self.spark.sparkContext.statusTracker()
+        job_ids = sorted(tracker.getJobIdsForGroup(group))
+        stage_ids = set()
+        for job_id in job_ids:
+            job = tracker.getJobInfo(job_id)
+            if job is not None:
+                stage_ids.update(job.stageIds)
+        metrics = {"job_ids": job_ids, "stage_ids": sorted(stage_ids)}
+        totals = dict((name, 0) for name in STAGE_METRICS.values())
+        peak_execution_memory = 0
+        for stage_id in sorted(stage_ids):
+            # the listener of the status API may still be finishing the last tasks of the stage
+            for _ in range(10):
+                attempts = self.status_api("stages/{0}".format(stage_id))
+                if not attempts or all(attempt.get("status") != "ACTIVE" for attempt in attempts):
+                    break
+                time.sleep(0.2)
+            if attempts is None:
+                return metrics
+            for attempt in attempts:
+                for key, name in STAGE_METRICS.items():
+                    totals[name] += attempt.get(key, 0)
+                # peakExecutionMemory of a stage is the sum over its tasks; the largest task is the
+                # 1.0 quantile of the task summary
+                summary = self.status_api("stages/{0}/{1}/taskSummary?quantiles=1.0".format(
+                    stage_id, attempt.get("attemptId", 0))) or {}
+                peak_execution_memory = max([peak_execution_memory] +
+                                            [int(value) for value in summary.get("peakExecutionMemory", [])])
+        metrics.update(totals)
+        metrics["peak_execution_memory"] = peak_execution_memory
+        executors = self.status_api("executors") or []
+        peaks = [executor.get("peakMemoryMetrics", {}) for executor in executors]
+        metrics["executor_peak_jvm_memory"] = max([peak.get("JVMHeapMemory", 0) + peak.get("JVMOffHeapMemory", 0)
+                                                   for peak in peaks] + [0])
+        return metrics
+
+    def write(self, record):
+        '''
+        This function is to append one record to the JSON-lines file.
+        '''
+        line = json.dumps(record, default=str)
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(line + "\n")
+
+
+def log_step(run_log, name, **tags):
+    '''
+    This function is to record a step in run_log (see RunLog.stage), or nothing if run_log is None,
+    e.g. in the functions which are also called without a run log.
+    '''
+    return nullcontext() if run_log is None else run_log.stage(name, **tags)
@@ -0,0 +1,244 @@
+from pyspark.sql.functions import col
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import argparse
+import json
+import os
+import time
+from id_dictionary import index_with_dictionary
+from split_engine import hash_bucket, local_tags
+from implicit_feedback import add_confidence
+from spark_config import spark_session, add_spark_arguments
+
+# the arrays of a store; every array is one .npy file which is opened as a memory map
+STORE_ARRAYS = ["indptr", "indices", "ratings", "user_hash", "pair_hash",
+                "csc_indptr", "csc_indices", "csc_ratings", "csc_order",
+                "user_ids", "item_ids"]
+
+
+def build_interaction_arrays(users, items, ratings, user_hash, pair_hash):
+    '''
+    This function is to build the arrays of the store from the interactions.
+    The rows are the users and the columns are the books, in the order of their dense ids;
+    the CSR is sorted by (user, book) and the CSC by (book, user).
+    Input:
+    1. users, items: the dense ids (user_id_index, book_id_index) of the interactions
+    2. ratings: the values of the interactions
+    3. user_hash, pair_hash: the hash buckets of the split (see split_engine.local_tags)
+    Output:
+    1. a dictionary of {name: array}, see STORE_ARRAYS
+    '''
+    user_ids, rows = np.unique(users, return_inverse=True)
+    item_ids, cols = np.unique(items, return_inverse=True)
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(user_ids)), out=indptr[1:])
+    # csc_order: the position in the CSR arrays of every entry of the CSC
+    csc_order = np.lexsort((rows, cols))
+    csc_indptr = np.zeros(len(item_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cols, minlength=len(item_ids)), out=csc_indptr[1:])
+    ratings = np.asarray(ratings, dtype=np.float32)[order]
+    return {"indptr": indptr,
+            "indices": cols.astype(np.int32),
+            "ratings": ratings,
+            "user_hash": np.asarray(user_hash, dtype=np.int32)[order],
+            "pair_hash": np.asarray(pair_hash, dtype=np.int32)[order],
+            "csc_indptr": csc_indptr,
+            "csc_indices": rows[csc_order].astype(np.int32),
+            "csc_ratings": ratings[csc_order],
+            "csc_order": csc_order.astype(np.int64),
+            "user_ids": user_ids,
+            "item_ids": item_ids}
+
+
+def write_interaction_store(arrays, store_path, meta):
+    '''
+    This function is to write the arrays of a store as .npy files and the metadata as meta.json.
+    Input:
+    1. arrays: the output of build_interaction_arrays
+    2. store_path: a local folder
+    3. meta: a dictionary of the metadata (source, columns, seed, ...)
+    '''
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    for name in STORE_ARRAYS:
+        np.save(os.path.join(store_path, name + ".npy"), arrays[name])
+    meta = dict(meta, n_users=len(arrays["user_ids"]), n_items=len(arrays["item_ids"]),
+                nnz=len(arrays["indices"]))
+    with open(os.path.join(store_path, "meta.json"), "w") as file:
+        json.dump(meta, file, indent=2)
+
+
+def open_interaction_store(store_path):
+    '''
+    This function is to open a store without reading it: every array is a read-only memory map,
+    so only the pages which are used are loaded, and they are shared by the processes on the machine.
+    Output:
+    1. a dictionary of {name: numpy.memmap}, plus meta
+    '''
+    store = dict((name, np.load(os.path.join(store_path, name + ".npy"), mmap_mode="r")) for name in STORE_ARRAYS)
+    with open(os.path.join(store_path, "meta.json")) as file:
+        store["meta"] = json.load(file)
+    return store
+
+
+def check_store_values(store, rating_col, confidence_weights=None):
+    '''
+    This function is to make sure that the values of a store are the ones a run trains on: the
+    same column (rating or confidence) and, for implicit feedback, the same confidence weights.
+    A store of star ratings would otherwise be fitted as confidences (or the other way around).
+    '''
+    meta = store["meta"]
+    if meta.get("rating_col") != rating_col:
+        raise ValueError("The store holds {0}, but the run trains on {1}.".format(meta.get("rating_col"), rating_col))
+    if rating_col == "confidence" and meta.get("confidence_weights") != list(confidence_weights):
+        raise ValueError("The store was built with the confidence weights {0}, but the run uses {1}.".
+                         format(meta.get("confidence_weights"), list(confidence_weights)))
+
+
+def check_store_split(store, user, item, seed):
+    '''
+    This function is to make sure that the hash buckets of a store are the ones of the split of
+    a run: the same hashed columns and the same seed. Otherwise the local backend would tune on
+    training and validation sets which overlap the test set of the Spark split.
+    '''
+    meta = store["meta"]
+    if meta.get("split_user") != user or meta.get("split_item") != item:
+        raise ValueError("The store was split on {0} and {1}, but the run splits on {2} and {3}.".
+                         format(meta.get("split_user"), meta.get("split_item"), user, item))
+    if meta.get("split_seed") != seed:
+        raise ValueError("The store was split with the seed {0}, but the run uses {1}.".format(meta.get("split_seed"), seed))
+
+
+def store_matrices(store):
+    '''
+    This function is to get the user x book CSR matrix and its transpose (the CSC as a book x user CSR)
+    on top of the memory maps, without copying them.
+    '''
+    n_users, n_items = len(store["user_ids"]), len(store["item_ids"])
+    ratings = sp.csr_matrix((store["ratings"], store["indices"], store["indptr"]),
+                            shape=(n_users, n_items), copy=False)
+    ratings_t = sp.csr_matrix((store["csc_ratings"], store["csc_indices"], store["csc_indptr"]),
+                              shape=(n_items, n_users), copy=False)
+    return ratings, ratings_t
+
+
+def masked_matrices(store, mask):
+    '''
+    This function is to get the CSR matrix and its transpose of a subset of the interactions.
+    Like build_rating_matrix, only the users and books with at least one interaction are kept,
+    so the ids match a matrix built from the same subset with Spark.
+    Input:
+    1. store: the output of open_interaction_store
+    2. mask: a boolean array in the CSR order
+    Output:
+    1. ratings, ratings_t: the CSR matrix and its transpose
+    2. user_ids, item_ids: the ids of the rows and the columns
+    '''
+    n_users, n_items = len(store["user_ids"]), len(store["item_ids"])
+    rows = np.repeat(np.arange(n_users), np.diff(store["indptr"]))
+    cols = np.asarray(store["indices"])
+    user_counts = np.bincount(rows[mask], minlength=n_users)
+    item_counts = np.bincount(cols[mask], minlength=n_items)
+    user_keep, item_keep = user_counts > 0, item_counts > 0
+    user_map = (np.cumsum(user_keep) - 1).astype(np.int32)
+    item_map = (np.cumsum(item_keep) - 1).astype(np.int32)
+    indptr = np.concatenate([[0], np.cumsum(user_counts[user_keep])])
+    ratings = sp.csr_matrix((store["ratings"][mask], item_map[cols[mask]], indptr),
+                            shape=(int(user_keep.sum()), int(item_keep.sum())))
+    # the CSC entries are already sorted by (book, user); the mask keeps that order
+    csc_mask = mask[store["csc_order"]]
+    csc_indptr = np.concatenate([[0], np.cumsum(item_counts[item_keep])])
+    ratings_t = sp.csr_matrix((store["csc_ratings"][csc_mask], user_map[store["csc_indices"][csc_mask]], csc_indptr),
+                              shape=(int(item_keep.sum()), int(user_keep.sum())))
+    return ratings, ratings_t, store["user_ids"][user_keep], store["item_ids"][item_keep]
+
+
+def store_split(store, fractions, val_group, holdout_groups, holdout=0.5,
+                user="user_id_index", item="book_id_index", rating="rating"):
+    '''
+    This function is to rebuild a training and validation split of split_engine from the store,
+    without Spark: the tags are recomputed from the stored hash buckets (split_engine.local_tags).
+    Input:
+    1. store: the output of open_interaction_store
+    2. fractions, holdout: as in split_engine.tag_interactions
+    3. val_group, holdout_groups: as in customized_split_func
+    4. user, item, rating: the column names of the validation DataFrame
+    Output:
+    1. ratings, ratings_t, user_ids, item_ids: the training set (see masked_matrices)
+    2. val_pdf: a pandas DataFrame of the validation set
+    '''
+    user_group, is_holdout = local_tags(store["user_hash"], store["pair_hash"], fractions=fractions, holdout=holdout)
+    train_mask = ~(is_holdout & np.isin(user_group, holdout_groups))
+    val_mask = is_holdout & (user_group == val_group)
+    rows = np.repeat(np.arange(len(store["user_ids"])), np.diff(store["indptr"]))
+    val_pdf = pd.DataFrame({user: store["user_ids"][rows[val_mask]],
+                            item: store["item_ids"][np.asarray(store["indices"])[val_mask]],
+                            rating: store["ratings"][val_mask]})
+    return masked_matrices(store, train_mask) + (val_pdf,)
+
+
+def set_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from_net_id", help="Inputing the netID for reading data")
+    parser.add_argument("--read_parquet_path", help="Specifying the path of the parquet file you want to store.")
+    parser.add_argument("--store_path", help="Local folder of the interaction store.")
+    parser.add_argument("--id_dict_path", default=None, help="Folder name of the id dictionaries; None if the data has the index columns.")
+    parser.add_argument("--rating_col", default="rating", help="The values of the store: rating, or confidence for implicit feedback.")
+    parser.add_argument("--confidence_weights", default="[1.0,1.0,1.0]", help="The weights of is_read, rating and is_reviewed in the confidence.")
+    parser.add_argument("--split_user", default=None, help="The user column hashed by the split of the modeling script; user_id_index with --id_dict_path (as modeling.py), user_id otherwise.")
+    parser.add_argument("--split_item", default=None, help="The item column hashed by the split of the modeling script; book_id_index with --id_dict_path (as modeling.py), book_id otherwise.")
+    parser.add_argument("--split_seed", default="123", help="The seed of the split of the modeling script.")
+    add_spark_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+
+    ### input arguments ###
+    args = set_arguments()
+
+    # path
+    from_hdfs_path = "hdfs:///user/" + args.from_net_id + "/goodreads/"
+
+    ### setting ###
+    spark = spark_session(args.profile, args.set_memory, args.cores,
+                          input_path=from_hdfs_path + "data/" + args.read_parquet_path, app_name="interaction_store")
+    split_seed = int(args.split_seed)
+    # the columns modeling.py splits on with the same --id_dict_path
+    split_user = args.split_user or ("user_id" if args.id_dict_path is None else "user_id_index")
+    split_item = args.split_item or ("book_id" if args.id_dict_path is None else "book_id_index")
+
+    ### 1. read the parquet file ###
+    print("Reading the file.")
+    start_time = time.time()
+    data = spark.read.parquet(from_hdfs_path + "data/" + args.read_parquet_path)
+    if args.id_dict_path is not None:
+        data = index_with_dictionary(spark, data, from_hdfs_path + "data/" + args.id_dict_path, update=False)
+    confidence_weights = None
+    if args.rating_col == "confidence":
+        confidence_weights = eval(args.confidence_weights)
+        data = add_confidence(data, weights=confidence_weights)
+
+    ### 2. collect the dense ids, the values and the hash buckets of the split ###
+    print("Collecting the interactions.")
+    pdf = data.select(col("user_id_index"), col("book_id_index"), col(args.rating_col),
+                      hash_bucket(col(split_user), seed=split_seed).alias("user_hash"),
+                      hash_bucket(col(split_user), col(split_item), seed=split_seed + 1).alias("pair_hash")) \
+        .toPandas()
+
+    ### 3. build and write the store ###
+    print("Writing the interaction store.")
+    arrays = build_interaction_arrays(pdf["user_id_index"].values, pdf["book_id_index"].values,
+                                      pdf[args.rating_col].values, pdf["user_hash"].values, pdf["pair_hash"].values)
+    write_interaction_store(arrays, args.store_path,
+                            meta={"source": args.read_parquet_path, "rating_col": args.rating_col,
+                                  "confidence_weights": confidence_weights,
+                                  "split_user": split_user, "split_item": split_item,
+                                  "split_seed": split_seed})
+    print("It takes {0} seconds to write {1} interactions of {2} users and {3} books.".
+          format(str(round(time.time() - start_time, 2)), len(arrays["indices"]),
+                 len(arrays["user_ids"]), len(arrays["item_ids"])))
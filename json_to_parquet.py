@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import time
+
+
+def create_arrow_schema(mapped_ids=True):
+    '''
+    This function is to create the arrow schema of the projected interaction table.
+    The flags are int32, like the IntegerType columns of csv_to_parquet.py. With mapped_ids,
+    user_id and book_id are the int32 ids of goodreads_interactions.csv (see load_id_map), so
+    the output is read by downsampling.py and the modeling scripts like the one of csv_to_parquet.py.
+    Otherwise they are kept as the strings of the json file.
+    '''
+    id_type = pa.int32() if mapped_ids else pa.string()
+    data_schema = pa.schema([
+        ("user_id", id_type),
+        ("book_id", id_type),
+        ("is_read", pa.int32()),
+        ("rating", pa.int32()),
+        ("is_reviewed", pa.int32())
+    ])
+    return data_schema
+
+
+def load_id_map(map_file):
+    '''
+    This function is to read an id map of the dataset (user_id_map.csv or book_id_map.csv: the
+    integer id of the csv file, then the id of the json file).
+    Output:
+    1. a pandas Series of the integer ids, indexed by the json ids
+    '''
+    pdf = pd.read_csv(map_file, dtype=str)
+    return pd.Series(pdf.iloc[:, 0].values.astype(np.int32), index=pd.Index(pdf.iloc[:, 1].values))
+
+
+def map_ids(values, id_map, col_name):
+    '''
+    This function is to turn the json ids of a chunk into the integer ids of the csv file.
+    '''
+    positions = id_map.index.get_indexer(values)
+    if (positions < 0).any():
+        raise ValueError("{0} values of {1} are not in its id map, e.g. {2}.".
+                         format(int((positions < 0).sum()), col_name, values[int(np.argmax(positions < 0))]))
+    return id_map.values[positions]
+
+
+def project_line(line):
+    '''
+    This function is to parse one json line and only keep the five fields we use.
+    Input:
+    1. line: one line of goodreads_interactions.json
+    Output:
+    1. a tuple of (user_id, book_id, is_read, rating, is_reviewed)
+    '''
+    d = json.loads(line)
+    if "is_reviewed" in d:
+        is_reviewed = int(d["is_reviewed"])
+    else:
+        is_reviewed = int(len(d.get("review_text_incomplete", "")) > 0)
+    return d["user_id"], d["book_id"], int(d["is_read"]), int(d["rating"]), is_reviewed
+
+
+def chunk_to_table(rows, data_schema, id_maps=None):
+    '''
+    This function is to turn a list of projected rows into an arrow table (column by column).
+    Input:
+    1. rows: a list of tuples from project_line
+    2. data_schema: the arrow schema
+    3. id_maps: None, or the (user, book) outputs of load_id_map
+    '''
+    columns = list(zip(*rows))
+    if id_maps is not None:
+        columns[0] = map_ids(np.asarray(columns[0], dtype=object), id_maps[0], "user_id")
+        columns[1] = map_ids(np.asarray(columns[1], dtype=object), id_maps[1], "book_id")
+    arrays = [pa.array(columns[i], type=data_schema.field(i).type) for i in range(len(data_schema))]
+    return pa.Table.from_arrays(arrays, schema=data_schema)
+
+
+def iter_byte_range(file_name, start, end):
+    '''
+    This function is to yield the lines which start in [start, end) of the file.
+    A line that crosses the boundary belongs to the range where it starts, so
+    consecutive ranges never read the same line twice.
+    Input:
+    1. file_name: the json file
+    2. start, end: the byte range
+    '''
+    with open(file_name, "rb") as file:
+        if start > 0:
+            # skip the partial line; it belongs to the previous range
+            file.seek(start - 1)
+            file.readline()
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                break
+            if line.strip():
+                yield line
+
+
+def convert_byte_range(file_name, parquet_file, start, end, chunk_size=1000000, compression="snappy",
+                       id_map_files=None):
+    '''
+    This function is to stream one byte range of the json file into a parquet file.
+    Every chunk of chunk_size lines is written out as one row group right away, so
+    the memory only depends on chunk_size and not on the size of the input.
+    Input:
+    1. file_name: the json file
+    2. parquet_file: the output parquet file
+    3. start, end: the byte range
+    4. chunk_size: number of lines per row group
+    5. compression: parquet compression codec
+    6. id_map_files: None, or the (user_id_map.csv, book_id_map.csv) files; every process loads them once
+    Output:
+    1. the number of rows written
+    '''
+    data_schema = create_arrow_schema(mapped_ids=id_map_files is not None)
+    id_maps = None if id_map_files is None else [load_id_map(map_file) for map_file in id_map_files]
+    n_rows = 0
+    rows = []
+    with pq.ParquetWriter(parquet_file, data_schema, compression=compression) as writer:
+        for line in iter_byte_range(file_name, start, end):
+            rows.append(project_line(line))
+            if len(rows) >= chunk_size:
+                writer.write_table(chunk_to_table(rows, data_schema, id_maps))
+                n_rows += len(rows)
+                rows = []
+        if rows:
+            writer.write_table(chunk_to_table(rows, data_schema, id_maps))
+            n_rows += len(rows)
+    return n_rows
+
+
+def split_byte_ranges(file_name, n_splits):
+    '''
+    This function is to cut the file into n_splits byte ranges of similar size.
+    '''
+    file_size = os.path.getsize(file_name)
+    step = max(1, -(-file_size // n_splits))
+    return [(start, min(start + step, file_size)) for start in range(0, file_size, step)]
+
+
+def json_to_parquet(file_name, parquet_path, n_workers=1, chunk_size=1000000, compression="snappy",
+                    id_map_files=None):
+    '''
+    This function is to convert the interaction json file into a parquet dataset.
+    Each worker of the process pool converts one byte range into its own part file.
+    Input:
+    1. file_name: the json file
+    2. parquet_path: the output folder
+    3. n_workers: size of the process pool (1 means no pool)
+    4. chunk_size: number of lines per row group
+    5. compression: parquet compression codec
+    6. id_map_files: None, or the (user_id_map.csv, book_id_map.csv) files of the dataset
+    Output:
+    1. the total number of rows written
+    '''
+    os.makedirs(parquet_path, exist_ok=True)
+    byte_ranges = split_byte_ranges(file_name, n_workers)
+    part_files = [os.path.join(parquet_path, "part-{0:05d}.parquet".format(i)) for i in range(len(byte_ranges))]
+    if n_workers == 1:
+        return sum(convert_byte_range(file_name, part_files[i], start, end, chunk_size, compression, id_map_files)
+                   for i, (start, end) in enumerate(byte_ranges))
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(convert_byte_range, file_name, part_files[i], start, end, chunk_size, compression,
+                               id_map_files)
+                   for i, (start, end) in enumerate(byte_ranges)]
+        return sum(future.result() for future in futures)
+
+
+def set_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json_path", help="Specifying the path of the json file.")
+    parser.add_argument("--parquet_path", help="Specifying the output folder of the parquet files.")
+    parser.add_argument("--n_workers", default="1", help="Number of processes; each one converts a byte range.")
+    parser.add_argument("--chunk_size", default="1000000", help="Number of lines per parquet row group.")
+    parser.add_argument("--compression", default="snappy", help="Parquet compression codec.")
+    parser.add_argument("--user_id_map", default=None, help="user_id_map.csv of the dataset; writes the integer user ids of the csv file.")
+    parser.add_argument("--book_id_map", default=None, help="book_id_map.csv of the dataset; writes the integer book ids of the csv file.")
+    args = parser.parse_args()
+    if (args.user_id_map is None) != (args.book_id_map is None):
+        parser.error("--user_id_map and --book_id_map go together.")
+    return args
+
+
+if __name__ == "__main__":
+
+    # input arguments
+    args = set_arguments()
+
+    ### 1. from json to parquet ###
+    print("Start streaming the json file to parquet.")
+    start_time = time.time()
+    n_rows = json_to_parquet(file_name=args.json_path,
+                             parquet_path=args.parquet_path,
+                             n_workers=int(args.n_workers),
+                             chunk_size=int(args.chunk_size),
+                             compression=args.compression,
+                             id_map_files=None if args.user_id_map is None else (args.user_id_map, args.book_id_map))
+    if args.user_id_map is None:
+        print("Warning! The ids are the strings of the json file; pass --user_id_map and --book_id_map for step 2.")
+    print("It takes {0} seconds to write {1} rows.".format(str(round(time.time() - start_time, 2)), n_rows))
@@ -0,0 +1,378 @@
+import numpy as np
+import scipy.sparse as sp
+
+
+def lookup_index(ids, values):
+    '''
+    This function is to find the positions of values in the sorted ids.
+    Output:
+    1. index: the positions (only meaningful where known is True)
+    2. known: whether the value is in ids
+    '''
+    if len(ids) == 0:
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    index = np.minimum(np.searchsorted(ids, values), len(ids) - 1)
+    return index, ids[index] == values
+
+
+def build_rating_matrix(data, user="user_id", item="book_id", rating="rating",
+                        user_ids=None, item_ids=None):
+    '''
+    This function is to build the user x item rating matrix (CSR) from a pandas DataFrame.
+    Input:
+    1. data: a pandas DataFrame with the user, item and rating columns
+    2. user, item, rating: column names
+    3. user_ids, item_ids: the sorted ids of the rows and the columns; created from data if None.
+       Pass the ids of the training matrix to build a matching validation matrix; the
+       interactions of unknown users or items are dropped (like coldStartStrategy="drop").
+    Output:
+    1. ratings: scipy.sparse.csr_matrix
+    2. user_ids, item_ids: the ids of the rows and the columns
+    '''
+    if user_ids is None:
+        user_ids = np.unique(data[user].values)
+    if item_ids is None:
+        item_ids = np.unique(data[item].values)
+    rows, known_user = lookup_index(user_ids, data[user].values)
+    cols, known_item = lookup_index(item_ids, data[item].values)
+    known = known_user & known_item
+    ratings = sp.csr_matrix((data[rating].values[known].astype(np.float32), (rows[known], cols[known])),
+                            shape=(len(user_ids), len(item_ids)))
+    return ratings, user_ids, item_ids
+
+
+def positive_entries(confidence):
+    '''
+    This function is to drop the entries of an implicit-feedback matrix whose confidence weight is
+    not positive. Spark's ALS gives them a zero confidence, no preference and does not count them
+    in n_u, so they are not interactions at all.
+    '''
+    if confidence.nnz == 0 or confidence.data.min() > 0:
+        return confidence
+    confidence = sp.csr_matrix(confidence, copy=True)
+    confidence.data[confidence.data < 0] = 0
+    confidence.eliminate_zeros()
+    return confidence
+
+
+def nonnegative_solve(A, b, x0, n_sweeps=10):
+    '''
+    This function is to solve min 1/2 x'Ax - b'x subject to x >= 0 by projected coordinate descent,
+    for a batch of problems at once: every coordinate update is one vectorized step over the batch.
+    Input:
+    1. A: the (n x rank x rank) normal matrices
+    2. b: the (n x rank) right-hand sides
+    3. x0: the (n x rank) starting points (e.g. the previous factors)
+    '''
+    x = np.maximum(x0, 0)
+    diag = np.diagonal(A, axis1=1, axis2=2)
+    # a zero diagonal (regParam 0 and a zero column of the fixed factors) leaves its coordinate as it is
+    curved = diag > 0
+    for _ in range(n_sweeps):
+        for j in range(b.shape[1]):
+            gradient = np.einsum("ni,ni->n", A[:, j], x) - b[:, j]
+            step = np.divide(gradient, diag[:, j], out=np.zeros_like(gradient), where=curved[:, j])
+            x[:, j] = np.maximum(0.0, x[:, j] - step)
+    return x
+
+
+def normal_equations(ratings, padded_factors, rows, length, regParam):
+    '''
+    This function is to build the normal equations of a batch of rows:
+    A_u = Y_u'Y_u + regParam * n_u * I and b_u = Y_u' r_u.
+    The Y_u of the batch are padded with zero rows to the same length, so all of the
+    products are one stacked matrix multiplication (BLAS) instead of a Python loop over rows.
+    Input:
+    1. ratings: the CSR matrix
+    2. padded_factors: the fixed factors with one extra row of zeros (the padding)
+    3. rows: the rows of the batch; every row has at most length ratings
+    4. length: the padded length
+    5. regParam: the regularization parameter
+    Output:
+    1. A: (n x rank x rank)
+    2. b: (n x rank)
+    '''
+    indptr = ratings.indptr
+    counts = indptr[rows + 1] - indptr[rows]
+    positions = indptr[rows][:, None] + np.arange(length)
+    padding = np.arange(length) >= counts[:, None]
+    positions[padding] = 0
+    columns = np.where(padding, padded_factors.shape[0] - 1, ratings.indices[positions])
+    values = np.where(padding, 0.0, ratings.data[positions])
+    Y = padded_factors[columns]
+    Y_t = Y.transpose(0, 2, 1)
+    A = np.matmul(Y_t, Y) + regParam * counts[:, None, None] * np.eye(Y.shape[2])
+    b = np.matmul(Y_t, values[:, :, None])[:, :, 0]
+    return A, b
+
+
+def solve_factors(ratings, fixed_factors, factors, regParam, nonnegative=False, max_elements=2 ** 22):
+    '''
+    This function is to update one side of the factorization (one half-sweep of ALS):
+    for every row u, solve (Y_u'Y_u + regParam * n_u * I) x_u = Y_u' r_u,
+    where Y_u are the fixed factors of the items rated by u. The regularization is
+    scaled by the number of ratings n_u, as in Spark's ALS.
+    The rows are grouped by their number of ratings (rounded up to a power of two) and solved
+    in batches: the normal equations of a batch are built together (normal_equations) and
+    solved with one batched LAPACK call (np.linalg.solve); both use the multithreaded BLAS of NumPy.
+    Input:
+    1. ratings: CSR matrix whose rows are solved
+    2. fixed_factors: the factors of the columns
+    3. factors: the current factors of the rows (updated in place, used as starting point)
+    4. regParam: the regularization parameter
+    5. nonnegative: whether to constrain the factors to be nonnegative
+    6. max_elements: the number of elements of the padded Y_u (and of the A_u) of a batch
+    '''
+    rank = fixed_factors.shape[1]
+    padded_factors = np.vstack([fixed_factors, np.zeros((1, rank))])
+    counts = np.diff(ratings.indptr)
+    rows = np.flatnonzero(counts)
+    lengths = 2 ** np.ceil(np.log2(counts[rows])).astype(np.int64)
+    for length in np.unique(lengths):
+        length_rows = rows[lengths == length]
+        batch_size = max(1, max_elements // (rank * max(length, rank)))
+        for start in range(0, len(length_rows), batch_size):
+            batch = length_rows[start:start + batch_size]
+            A, b = normal_equations(ratings, padded_factors, batch, length, regParam)
+            if nonnegative:
+                factors[batch] = nonnegative_solve(A, b, factors[batch])
+            else:
+                factors[batch] = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    return factors
+
+
+def solve_implicit_factors(confidence, fixed_factors, factors, regParam, alpha=1.0, nonnegative=False,
+                           cg_steps=3, max_elements=2 ** 24, YtY=None):
+    '''
+    This function is to update one side of an implicit-feedback factorization (one half-sweep):
+    for every row u, solve (Y'Y + Y_u'(C_u - I)Y_u + regParam * n_u * I) x_u = Y_u'C_u p_u,
+    where p_u = 1 on the observed items and C_u = 1 + alpha * confidence (Hu, Koren and Volinsky).
+    Y'Y is computed once for the whole half-sweep, and the system of every row is solved by a few
+    steps of conjugate gradient started from the current factors. A step only needs the product
+    with Y_u, so the cost of a row is linear in its number of interactions (O(n_u * rank)) instead
+    of building and factorizing a rank x rank matrix (O(n_u * rank^2 + rank^3)).
+    All of the rows of a block run their conjugate gradient together, with sparse products.
+    Input:
+    1. confidence: CSR matrix of the confidence weights of the observed interactions
+    2. fixed_factors: the factors of the columns
+    3. factors: the current factors of the rows (updated in place, used as starting point)
+    4. regParam: the regularization parameter (scaled by n_u, as in Spark's ALS)
+    5. alpha: the confidence scale
+    6. nonnegative: project the solution on x >= 0 after the conjugate gradient
+    7. cg_steps: the number of conjugate gradient steps per row
+    8. max_elements: the number of (interaction x rank) elements of a block
+    9. YtY: the Gram matrix of every column; computed from fixed_factors if None. Pass it when
+       fixed_factors only holds the columns of the interactions (e.g. the fold-in of new users)
+    '''
+    # the entries with a zero weight (e.g. shelved but not read, rated or reviewed) are not interactions
+    confidence = positive_entries(confidence)
+    rank = fixed_factors.shape[1]
+    if YtY is None:
+        YtY = fixed_factors.T.dot(fixed_factors)
+    indptr, indices = confidence.indptr, confidence.indices
+    weights = 1.0 + alpha * confidence.data.astype(np.float64)
+    n_rows = confidence.shape[0]
+    max_nnz = max(1, max_elements // rank)
+    start = 0
+    while start < n_rows:
+        end = np.searchsorted(indptr, indptr[start] + max_nnz, side="right") - 1
+        end = min(max(end, start + 1), n_rows)
+        low, high = indptr[start], indptr[end]
+        block_indptr = indptr[start:end + 1] - low
+        block_indices = indices[low:high]
+        block_weights = weights[low:high]
+        counts = np.diff(block_indptr)
+        rows = np.repeat(np.arange(end - start), counts)
+        Y = fixed_factors[block_indices]
+        regularization = regParam * counts[:, None]
+
+        def multiply(x):
+            # (Y'Y + Y_u'(C_u - I)Y_u + regParam * n_u * I) x for every row of the block
+            scaled = (block_weights - 1.0) * np.einsum("ij,ij->i", x[rows], Y)
+            sparse = sp.csr_matrix((scaled, block_indices, block_indptr), shape=(end - start, fixed_factors.shape[0]))
+            return x.dot(YtY) + sparse.dot(fixed_factors) + regularization * x
+
+        b = sp.csr_matrix((block_weights, block_indices, block_indptr),
+                          shape=(end - start, fixed_factors.shape[0])).dot(fixed_factors)
+        x = np.array(factors[start:end], dtype=np.float64)
+        residual = b - multiply(x)
+        direction = residual.copy()
+        residual_norm = np.einsum("ij,ij->i", residual, residual)
+        for _ in range(cg_steps):
+            product = multiply(direction)
+            curvature = np.einsum("ij,ij->i", direction, product)
+            step = np.divide(residual_norm, curvature, out=np.zeros_like(curvature), where=curvature > 0)
+            x += step[:, None] * direction
+            residual -= step[:, None] * product
+            new_norm = np.einsum("ij,ij->i", residual, residual)
+            beta = np.divide(new_norm, residual_norm, out=np.zeros_like(new_norm), where=residual_norm > 0)
+            direction = residual + beta[:, None] * direction
+            residual_norm = new_norm
+        if nonnegative:
+            x = np.maximum(x, 0)
+        # rows without interactions have no preference to fit
+        x[counts == 0] = 0
+        factors[start:end] = x
+        start = end
+    return factors
+
+
+def training_rmse(ratings, user_factors, item_factors):
+    '''
+    This function is to compute the RMSE of the model on the observed ratings.
+    '''
+    rows = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))
+    predictions = np.einsum("ij,ij->i", user_factors[rows], item_factors[ratings.indices])
+    return float(np.sqrt(np.mean((predictions - ratings.data) ** 2)))
+
+
+def local_predictions(model, data, user_ids, item_ids, user="user_id", item="book_id", prediction="prediction"):
+    '''
+    This function is to add the prediction column to a pandas DataFrame of (user, item) pairs.
+    Pairs with an unknown user or item are dropped, like coldStartStrategy="drop".
+    Input:
+    1. model: LocalALSModel
+    2. data: a pandas DataFrame with the user and item columns
+    3. user_ids, item_ids: the ids of the training matrix
+    '''
+    rows, known_user = lookup_index(user_ids, data[user].values)
+    cols, known_item = lookup_index(item_ids, data[item].values)
+    known = known_user & known_item
+    predictions = data[known].copy()
+    predictions[prediction] = model.predict(rows[known], cols[known]).astype(np.float32)
+    return predictions
+
+
+class LocalALSModel(object):
+    '''
+    The user and item factors of a fitted LocalALS.
+    '''
+
+    def __init__(self, user_factors, item_factors, n_iter):
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.n_iter = n_iter
+
+    def predict(self, user_index, item_index):
+        '''
+        This function is to predict the ratings of (user_index, item_index) pairs.
+        '''
+        return np.einsum("ij,ij->i", self.user_factors[user_index], self.item_factors[item_index])
+
+
+class LocalALS(object):
+    '''
+    ALS solved in process with NumPy. Unlike Spark's ALS, a fit can start
+    from given user and item factors (warm start) and stop early when the training RMSE
+    changes by less than tol between two iterations.
+    Input:
+    1. rank, regParam, maxIter, nonnegative, seed, implicitPrefs, alpha: as in pyspark.ml.recommendation.ALS
+    2. tol: relative change of the training RMSE for early stopping (None: always run maxIter)
+    3. cg_steps: the number of conjugate gradient steps per half-sweep (implicitPrefs only)
+    '''
+
+    def __init__(self, rank=10, regParam=0.1, maxIter=10, nonnegative=False, seed=123, tol=None,
+                 implicitPrefs=False, alpha=1.0, cg_steps=3):
+        self.rank = rank
+        self.regParam = regParam
+        self.maxIter = maxIter
+        self.nonnegative = nonnegative
+        self.seed = seed
+        self.tol = tol
+        self.implicitPrefs = implicitPrefs
+        self.alpha = alpha
+        self.cg_steps = cg_steps
+
+    def init_factors(self, n_rows, rng=None):
+        '''
+        This function is to create small random factors, from rng (a numpy RandomState) or from
+        a new generator of the seed.
+        '''
+        rng = np.random.RandomState(self.seed) if rng is None else rng
+        factors = rng.normal(size=(n_rows, self.rank)) / np.sqrt(self.rank)
+        if self.nonnegative:
+            factors = np.abs(factors)
+        return factors
+
+    def solve(self, ratings, fixed_factors, factors):
+        '''
+        This function is to run one half-sweep: the exact batched solves of explicit feedback,
+        or the conjugate gradient of implicit feedback.
+        '''
+        if self.implicitPrefs:
+            return solve_implicit_factors(ratings, fixed_factors, factors, self.regParam, alpha=self.alpha,
+                                          nonnegative=self.nonnegative, cg_steps=self.cg_steps)
+        return solve_factors(ratings, fixed_factors, factors, self.regParam, self.nonnegative)
+
+    def fit(self, ratings, user_factors=None, item_factors=None, ratings_t=None):
+        '''
+        This function is to fit the factors on a user x item CSR matrix.
+        Input:
+        1. ratings: scipy.sparse.csr_matrix (see build_rating_matrix); the confidence weights
+           of the interactions if implicitPrefs
+        2. user_factors, item_factors: the factors to start from (e.g. the factors of the
+           previous configuration of a sweep); random if None
+        3. ratings_t: the transpose of ratings as a CSR matrix (e.g. the CSC of an interaction store);
+           computed from ratings if None
+        Output:
+        1. LocalALSModel
+        '''
+        ratings = sp.csr_matrix(ratings)
+        if ratings_t is None:
+            ratings_t = ratings.T.tocsr()
+        # one generator for both sides, so the users and the items do not start from the same rows
+        rng = np.random.RandomState(self.seed)
+        if user_factors is None:
+            user_factors = self.init_factors(ratings.shape[0], rng)
+        else:
+            user_factors = np.array(user_factors, dtype=np.float64)
+        if item_factors is None:
+            item_factors = self.init_factors(ratings.shape[1], rng)
+        else:
+            item_factors = np.array(item_factors, dtype=np.float64)
+        if self.implicitPrefs:
+            # dropped once here rather than in every half-sweep (see positive_entries)
+            ratings, ratings_t = positive_entries(ratings), positive_entries(ratings_t)
+            # the training RMSE of implicit feedback is measured on the preferences (1 if observed)
+            targets = sp.csr_matrix((np.ones(ratings.nnz), ratings.indices, ratings.indptr), shape=ratings.shape)
+        else:
+            targets = ratings
+        previous_rmse = None
+        n_iter = 0
+        for n_iter in range(1, self.maxIter + 1):
+            self.solve(ratings, item_factors, user_factors)
+            self.solve(ratings_t, user_factors, item_factors)
+            if self.tol is not None:
+                rmse = training_rmse(targets, user_factors, item_factors)
+                if previous_rmse is not None and abs(previous_rmse - rmse) <= self.tol * previous_rmse:
+                    break
+                previous_rmse = rmse
+        return LocalALSModel(user_factors, item_factors, n_iter)
+
+
+def warm_start_sweep(ratings, rank, regParam_list, maxIter=10, tol=1e-3, nonnegative=True, seed=123,
+                     implicitPrefs=False, alpha=1.0):
+    '''
+    This function is to fit one rank for a list of regParams, starting every fit from the
+    factors of the previous regParam. The regParams are visited from the largest to the
+    smallest, so every fit starts from a smoother, nearby solution.
+    Input:
+    1. ratings: the training CSR matrix
+    2. rank: the rank of the sweep
+    3. regParam_list: a list of regulization parameters
+    4. maxIter: the maximum number of iterations of each fit
+    5. tol: relative change of the training RMSE for early stopping
+    6. implicitPrefs, alpha: implicit feedback (see LocalALS)
+    Output:
+    1. a dictionary of {regParam: LocalALSModel}
+    '''
+    models = {}
+    user_factors, item_factors = None, None
+    for regParam in sorted(regParam_list, reverse=True):
+        als = LocalALS(rank=rank, regParam=regParam, maxIter=maxIter,
+                       nonnegative=nonnegative, seed=seed, tol=tol,
+                       implicitPrefs=implicitPrefs, alpha=alpha)
+        model = als.fit(ratings, user_factors=user_factors, item_factors=item_factors)
+        user_factors, item_factors = model.user_factors, model.item_factors
+        models[regParam] = model
+    return models
@@ -1,18 +1,25 @@
 import numpy as np, pandas as pd
-import json
+import os
+import sys
+# json_to_parquet.py is in the parent folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from json_to_parquet import iter_byte_range, project_line
 
 def load_data(file_name, head = 100):
+    '''
+    This function is to read the first head lines (all of them if None) of an interaction json file,
+    keeping only user_id, book_id, is_read, rating and is_reviewed of every line (see json_to_parquet.py).
+    For the whole file, json_to_parquet.convert_byte_range streams it to parquet instead.
+    '''
     count = 0
     data = []
-    with open(file_name, "r") as file:
-        for line in file:
-            d = json.loads(line)
-            count += 1
-            data.append(d)
-            
-            # break if reaches the 100th line
-            if (head is not None) and (count > head):
-                break
+    for line in iter_byte_range(file_name, 0, os.path.getsize(file_name)):
+        data.append(project_line(line))
+        count += 1
+
+        # break if reaches the 100th line
+        if (head is not None) and (count > head):
+            break
     return data
 
 
@@ -20,12 +27,8 @@ if __name__ == "__main__":
 	path = "/Users/garyliu/Documents/NYUClasses/BigData/Project/"
 	data = load_data(path+"goodreads_interactions_poetry.json", None)
 
-	# from list of dict to list of list with user_id, book_id, is_read, rating, is_review
-	list_data = []
-	for line in data:
-	    list_data.append([line["user_id"], line["book_id"], int(line["is_read"]),
-	                      line["rating"], int(len(line["review_text_incomplete"])>0)])
-	df = pd.DataFrame(list_data, columns = ["user_id", "book_id", "is_read", "rating", "is_review"])
+	# the lines are already projected to user_id, book_id, is_read, rating, is_review
+	df = pd.DataFrame(data, columns = ["user_id", "book_id", "is_read", "rating", "is_review"])
 
 	## write to csv
 	df.to_csv("poetry_interactions.csv", index=False)
\ No newline at end of file
@@ -3,8 +3,6 @@ from pyspark.sql import SparkSession
 from pyspark.sql.window import Window
 from pyspark.sql.types import StructType, StructField, IntegerType, StringType
 from pyspark.ml.recommendation import ALS
-from pyspark.mllib.evaluation import RankingMetrics
-from pyspark.ml.evaluation import RegressionEvaluator
 from pyspark.sql.functions import monotonically_increasing_id, col, expr
 import pyspark.sql.functions as F
 from functools import reduce
@@ -15,18 +13,22 @@ import argparse
 import numpy as np
 from itertools import product
 import time
-
-def settings(memory):
-	### setting ###
-	conf = pyspark.SparkConf() \
-			.setAll([('spark.app.name', 'downsampling code'),
-					 ('spark.master', 'local'),
-					 ('spark.executor.memory', memory),
-					 ('spark.driver.memory', memory)])
-	spark = SparkSession.builder \
-			.config(conf=conf) \
-			.getOrCreate()
-	return spark
+from id_dictionary import index_with_dictionary
+from split_engine import tag_interactions, training_part, holdout_part
+from parallel_tuning import run_cells
+from instrumentation import RunLog, log_step
+from tuning_store import TuningStore, dataset_fingerprint
+from functools import partial
+from local_als import LocalALS, build_rating_matrix, warm_start_sweep, local_predictions
+from ranking_evaluator import ranking_metrics as grouped_ranking_metrics
+from ranking_evaluator import RANKING_METRICS, catalog_ranking_metrics, local_catalog_ranking_metrics
+from ranking_evaluator import local_ranking_metrics
+from regression_evaluator import regression_metrics as grouped_regression_metrics
+from regression_evaluator import local_regression_metrics
+from implicit_feedback import add_confidence
+from interaction_store import open_interaction_store, store_split, check_store_values, check_store_split
+from factor_export import export_spark_model
+from spark_config import spark_session, add_spark_arguments
 
 def create_schema():
     data_schema = StructType([
@@ -40,25 +42,22 @@ def create_schema():
     return data_schema
 
 
-def customized_split_func(data, train, val_user, user="user_id", set_seed=123):
+def customized_split_func(tagged_data, val_group, holdout_groups, columns):
 	'''
 	This function is to hold out half of the interactions per user from validation to training.
+	Both outputs are filters on the tags, so nothing is collected to the driver and no subtract is needed.
 	Output:
-	1. row_index
+	1. train_data: every interaction except the held-out interactions of holdout_groups
+	2. val_data: the held-out interactions of val_group
 	Input:
-	1. data: the whole dataframe
-	2. train: the training set dataframe which contains all columns
-	3. val_user: the validation or testing set dataframe which only contains user_id
-	4. user: name of the user columns
+	1. tagged_data: the output of split_engine.tag_interactions
+	2. val_group: the user group of the validation or testing set
+	3. holdout_groups: all of the user groups whose held-out interactions are not used for training
+	4. columns: the columns to keep
 	'''
-	# temporary validation table
-	val_data_temp = data.join(val_user, on=user, how='inner').select(data.schema.names)
-	# sampleBy: stratefied sampling; for each user_id, we extract half of the interaction
-	val_frac = dict([(uid[0], 0.5) for uid in val_user.select(user).collect()])
-	val_data = val_data_temp.sampleBy(user, val_frac, seed = set_seed)
-	# using the subtract function and putting the other 50% to the training
-	train_val_data = train.union(val_data_temp.subtract(val_data))
-	return train_val_data, val_data
+	train_data = training_part(tagged_data, holdout_groups=holdout_groups, columns=columns)
+	val_data = holdout_part(tagged_data, group=val_group, columns=columns)
+	return train_data, val_data
 
 def unionAll(*dataframes):
 	'''
@@ -67,38 +66,206 @@ def unionAll(*dataframes):
 	'''
 	return reduce(DataFrame.unionAll, dataframes)
 
-def train_val_test_split(data, user="user_id"):
+def train_val_test_split(data, user="user_id", item="book_id", seed=123):
 	'''
 	If we don't perform k-fold cross validation, we just split the dataset into three subsets.
 	'''
-	# split by the users
-	user_train_val_test_split = data.select(user).distinct().randomSplit([0.6, 0.2, 0.2], seed=123)
-	# add half of the interactions to train from validation and testing
-	train_data = data.join(
-		user_train_val_test_split[0],
-		on=user,
-		how='inner'
-		).select(data.schema.names) # user_split_sample is a 5-element list of user_id
-
-	# in the validation set, leave half of the interactions per user to the training set
+	# split by the users: group 0 (60%) train, group 1 (20%) validation, group 2 (20%) test
+	# and hold out half of the interactions of every validation and testing user
+	tagged_data = tag_interactions(data, user=user, item=item, fractions=[0.6, 0.2, 0.2], holdout=0.5, seed=seed)
+	# in the validation and test sets, leave half of the interactions per user to the training set
 	train_data, val_data = customized_split_func(
-		data=data,
-		train=train_data,
-		val_user=user_train_val_test_split[1],
-		user=user
-		)
-	# in the test set, leave half of the interactions per user to the training set
-	train_data, test_data = customized_split_func(
-		data=data,
-		train=train_data,
-		val_user=user_train_val_test_split[2],
-		user=user
+		tagged_data=tagged_data,
+		val_group=1,
+		holdout_groups=[1, 2],
+		columns=data.schema.names
 		)
+	test_data = holdout_part(tagged_data, group=2, columns=data.schema.names)
 	return train_data, val_data, test_data
 
+def fit_and_evaluate(train_data, val_data, rank, regParam, metrics, k=10, maxIter=5, seed=123,
+					 user="user_id", item="book_id", rating="rating", evaluation="pairs",
+					 implicitPrefs=False, alpha=1.0, run_log=None):
+	'''
+	This function is to fit one ALS configuration and evaluate it on the validation set.
+	It is one cell of the tuning grid; with a run_log, the fit, the transform and the evaluation
+	are recorded as separate steps.
+	Input:
+	1. train_data, val_data: training and validation sets
+	2. rank, regParam: the configuration
+	3. metrics: a list of metrics from {precisionAt, meanAveragePrecision, ndcgAt} and {rmse, mae, r2}
+	4. k: top k items for evaluation
+	5. evaluation: pairs: rank the validation items of each user (model.transform)
+				   catalog: rank the whole catalog for each user (ranking metrics only)
+	6. implicitPrefs, alpha: implicit feedback; rating is then the confidence weight
+	Output:
+	1. a dictionary of {metric: value} on the validation set
+	'''
+	# initializa, fit, transform the ALS model
+	als = ALS(rank=rank, maxIter=maxIter, regParam = regParam, seed=seed,
+			  coldStartStrategy="drop", userCol=user,
+			  itemCol=item, ratingCol=rating,
+			  implicitPrefs=implicitPrefs, alpha=alpha, nonnegative=True)
+	with log_step(run_log, "fit"):
+		model = als.fit(train_data)
+	return evaluate_model(model, train_data, val_data, metrics, k=k, user=user, item=item, rating=rating,
+						  evaluation=evaluation, run_log=run_log)
+
+def evaluate_model(model, train_data, val_data, metrics, k=10, user="user_id", item="book_id", rating="rating",
+				   evaluation="pairs", run_log=None):
+	'''
+	This function is to evaluate a fitted ALS model on a validation (or test) set.
+	Input:
+	1. model: a fitted ALSModel
+	2. train_data: the set the model was fitted on (the seen items of the catalog evaluation)
+	3. val_data: the validation or test set
+	4. metrics: a list of metrics from {precisionAt, meanAveragePrecision, ndcgAt} and {rmse, mae, r2}
+	5. evaluation: pairs or catalog (see fit_and_evaluate)
+	6. run_log: an instrumentation.RunLog recording the transform and the evaluation as two steps
+	Output:
+	1. a dictionary of {metric: value}
+	'''
+	# with the catalog evaluation, only the regression metrics use the validation pairs
+	pair_metrics = metrics if evaluation == "pairs" else [metric for metric in metrics if metric not in RANKING_METRICS]
+	metrics_result = {}
+	if pair_metrics:
+		# the predictions are computed once here, then every metric reads them from the cache
+		with log_step(run_log, "transform"):
+			val_pred = model.transform(val_data).cache()
+			val_pred.count()
+		with log_step(run_log, "evaluate", evaluation="pairs"):
+			metrics_result.update(evaluate_predictions(val_pred, pair_metrics,
+													   k=k, user=user, item=item, rating=rating))
+	if len(pair_metrics) < len(metrics):
+		with log_step(run_log, "evaluate", evaluation="catalog"):
+			metrics_result.update(catalog_ranking_metrics(model, train_data, val_data, k=k,
+														  user=user, item=item, rating=rating))
+	return dict((metric, metrics_result[metric]) for metric in metrics)
+
+def evaluate_predictions(val_pred, metrics, k=10, user="user_id", item="book_id", rating="rating"):
+	'''
+	This function is to compute several metrics from one prediction DataFrame.
+	The predictions are cached once, so the ALS model is not applied again for every metric,
+	the three regression metrics come from one aggregate, and the three ranking metrics
+	come from a single grouped pass.
+	Input:
+	1. val_pred: a DataFrame with the user, item, rating and prediction columns
+	2. metrics: a list of metrics from {precisionAt, meanAveragePrecision, ndcgAt} and {rmse, mae, r2}
+	3. k: top k items for evaluation
+	Output:
+	1. a dictionary of {metric: value}
+	'''
+	if len(metrics) == 0:
+		return {}
+	metrics_result = {}
+	val_pred = val_pred.cache()
+	if any(metric in ["rmse", "mae", "r2"] for metric in metrics):
+		# we use the regression metrics
+		metrics_result.update(top_k_regressionmetrics(
+									dataset=val_pred, k=k,
+									regression_metrics="all",
+									user=user, item=item, rating=rating,
+									prediction="prediction"))
+	if any(metric in ["precisionAt", "meanAveragePrecision", "ndcgAt"] for metric in metrics):
+		# we use the ranking metrics
+		metrics_result.update(top_k_rankingmetrics(
+									dataset=val_pred, k=k,
+									ranking_metrics="all",
+									user=user, item=item, rating=rating,
+									prediction="prediction"))
+	val_pred.unpersist()
+	return dict((metric, metrics_result[metric]) for metric in metrics)
+
+def warm_start_evaluate(train_pdf, val_pdf, rank, regParam_list, metrics, k=10, maxIter=5, tol=None,
+						seed=123, user="user_id", item="book_id", rating="rating", evaluation="pairs",
+						implicitPrefs=False, alpha=1.0, run_log=None):
+	'''
+	This function is to fit one rank for every regParam with the in-process ALS (local_als.py),
+	starting every fit from the factors of the previous regParam, and evaluate each fit.
+	Spark's ALS cannot start from given factors, so the data is collected to the driver.
+	Input:
+	1. train_pdf, val_pdf: pandas DataFrames of the training and validation sets
+	2. rank: the rank of the sweep
+	3. regParam_list: a list of regulization parameters
+	4. metrics: a list of metrics for evaluation
+	5. maxIter: the maximum number of iterations of each fit
+	6. tol: relative change of the training RMSE for early stopping
+	7. evaluation: pairs or catalog, as in fit_and_evaluate
+	8. implicitPrefs, alpha: implicit feedback, as in fit_and_evaluate
+	9. run_log: an instrumentation.RunLog recording the sweep and every evaluation as steps
+	Output:
+	1. a dictionary of {regParam: {metric: value}}
+	'''
+	with log_step(run_log, "fit"):
+		ratings, user_ids, item_ids = build_rating_matrix(train_pdf, user=user, item=item, rating=rating)
+		models = warm_start_sweep(ratings, rank, regParam_list, maxIter=maxIter, tol=tol, nonnegative=True, seed=seed,
+								  implicitPrefs=implicitPrefs, alpha=alpha)
+	print("Rank {0}: {1} iterations for {2} regParams (at most {3}).".
+		  format(rank, sum(model.n_iter for model in models.values()), len(models), len(models)*maxIter))
+	sweep_results = {}
+	for regParam, model in models.items():
+		with log_step(run_log, "evaluate", regParam=regParam):
+			sweep_results[regParam] = evaluate_local_model(model, ratings, user_ids, item_ids, val_pdf, metrics, k=k,
+														   user=user, item=item, rating=rating, evaluation=evaluation)
+	return sweep_results
+
+def evaluate_local_model(model, ratings, user_ids, item_ids, val_pdf, metrics, k=10,
+						 user="user_id", item="book_id", rating="rating", evaluation="pairs"):
+	'''
+	This function is to compute the metrics of an in-process model (local_als.py) on the driver,
+	with the pandas versions of the evaluators, so no Spark job is started.
+	Input:
+	1. model: LocalALSModel
+	2. ratings, user_ids, item_ids: the output of build_rating_matrix on the training set
+	3. val_pdf: a pandas DataFrame of the validation set
+	4. metrics: a list of metrics
+	5. k: top k items for evaluation
+	6. evaluation: pairs or catalog, as in fit_and_evaluate
+	Output:
+	1. a dictionary of {metric: value}
+	'''
+	metrics_result = {}
+	val_pred = local_predictions(model, val_pdf, user_ids, item_ids, user=user, item=item)
+	if any(metric in ["rmse", "mae", "r2"] for metric in metrics):
+		metrics_result.update(local_regression_metrics(val_pred, k=k, user=user, rating=rating))
+	if any(metric in RANKING_METRICS for metric in metrics):
+		if evaluation == "catalog":
+			metrics_result.update(local_catalog_ranking_metrics(
+				model.user_factors, model.item_factors, ratings, val_pdf, user_ids, item_ids,
+				k=k, user=user, item=item, rating=rating))
+		else:
+			metrics_result.update(local_ranking_metrics(val_pred, k=k, user=user, rating=rating))
+	return dict((metric, metrics_result[metric]) for metric in metrics)
+
+def local_fit_and_evaluate(ratings, ratings_t, user_ids, item_ids, val_pdf, rank, regParam, metrics, k=10, maxIter=5,
+						   seed=123, user="user_id", item="book_id", rating="rating", evaluation="pairs",
+						   implicitPrefs=False, alpha=1.0, run_log=None):
+	'''
+	This function is to fit one ALS configuration with the in-process ALS (local_als.py) and
+	evaluate it. It is one cell of the tuning grid of the local backend; the rating matrix is
+	built once and shared by all of the cells.
+	Input:
+	1. ratings, user_ids, item_ids: the output of build_rating_matrix on the training set
+	2. ratings_t: the transpose of ratings (from an interaction store), or None
+	3. val_pdf: a pandas DataFrame of the validation set
+	4. rank, regParam: the configuration
+	4. metrics: a list of metrics
+	Output:
+	1. a dictionary of {metric: value} on the validation set
+	'''
+	als = LocalALS(rank=rank, regParam=regParam, maxIter=maxIter, nonnegative=True, seed=seed,
+				   implicitPrefs=implicitPrefs, alpha=alpha)
+	with log_step(run_log, "fit"):
+		model = als.fit(ratings, ratings_t=ratings_t)
+	with log_step(run_log, "evaluate"):
+		return evaluate_local_model(model, ratings, user_ids, item_ids, val_pdf, metrics, k=k,
+									user=user, item=item, rating=rating, evaluation=evaluation)
+
 def tuning_als(train_data, val_data, rank_list=None, regParam_list=None,
 			   metrics=None, k=10, maxIter=5, seed=123,
-			   user="user_id", item="book_id", rating="rating"):
+			   user="user_id", item="book_id", rating="rating", parallelism=1,
+			   warm_start=False, tol=None, evaluation="pairs", selection_metric=None, backend="spark",
+			   implicitPrefs=False, alpha=1.0, local_data=None, run_log=None, tuning_store=None):
 	'''
 	This function is to run custom cross validation and metrics\
 	Input:
@@ -113,6 +280,22 @@ def tuning_als(train_data, val_data, rank_list=None, regParam_list=None,
 						{precisionAt, meanAveragePrecision, ndcgAt}
 	9. regression_metrics: the function uses the regression metrics if this is not False;
 							{rmse, mae, r2}
+	10. parallelism: number of configurations fitted at the same time (FAIR scheduler pools)
+	11. warm_start: fit the regParams of each rank from the factors of the previous regParam
+		with the in-process ALS, stopping early on tol
+	12. tol: relative change of the training RMSE for early stopping (warm_start only)
+	13. evaluation: pairs (validation items only) or catalog (whole catalog, ranking metrics only)
+	14. metrics: a metric or a list of metrics; all of them are computed from the same fits
+	15. selection_metric: the metric used to select the best configuration (the first metric by default)
+	16. backend: spark (pyspark.ml ALS) or local (the in-process ALS of local_als.py; the data
+		is collected to the driver once)
+	17. implicitPrefs, alpha: implicit-feedback ALS on the confidence weights in the rating column
+		(the local backend solves it by conjugate gradient)
+	18. local_data: the training and validation sets of the local backend from an interaction store
+		(see interaction_store.store_split); collected from the DataFrames if None
+	19. run_log: an instrumentation.RunLog recording the wall time and the Spark metrics of every cell
+	20. tuning_store: a tuning_store.TuningStore; the cells already in the store are not fitted again,
+		and every new cell is saved as soon as it finishes
 	output:
 	1. best_param_dict: a dictionary of the best configuration
 	2. tuning_table: a dictionary of all configurations
@@ -126,71 +309,107 @@ def tuning_als(train_data, val_data, rank_list=None, regParam_list=None,
 	if metrics == None:
 		print("Error! You must select a metric.")
 		return
+	if isinstance(metrics, str):
+		metrics = [metrics]
+	if selection_metric == None:
+		selection_metric = metrics[0]
+	if selection_metric not in metrics:
+		metrics = metrics + [selection_metric]
 	# tuning_table: for storing the hyperparameter and metrics
 	tuning_table = {"rank": [],
-					"regParam": [],
-					metrics: []}
+					"regParam": []}
+	for metric in metrics:
+		tuning_table[metric] = []
 
 	# a combination of all tuning hyperparameters
 	param_combination = list(product(rank_list, regParam_list))
+	# the configurations already in the tuning store are not fitted again
+	cell_results = {}
+	if tuning_store is not None:
+		for i, params in enumerate(param_combination):
+			stored = tuning_store.lookup(params[0], params[1], metrics=metrics)
+			if stored is not None:
+				cell_results[i] = stored
+		print(str(len(cell_results)) + " of " + str(len(param_combination)) + " configurations are in the tuning store.")
+	pending = [i for i in range(len(param_combination)) if i not in cell_results]
+	if warm_start:
+		# one cell per rank: the regParams of a rank are fitted one after another
+		pending_ranks = [rank for rank in rank_list if any(param_combination[i][0] == rank for i in pending)]
+		if pending_ranks:
+			train_pdf = train_data.select(user, item, rating).toPandas()
+			val_pdf = val_data.select(user, item, rating).toPandas()
+		cells = [(rank, partial(warm_start_evaluate, train_pdf, val_pdf, rank, regParam_list, metrics,
+								k=k, maxIter=maxIter, tol=tol, seed=seed, user=user, item=item, rating=rating,
+								evaluation=evaluation, implicitPrefs=implicitPrefs, alpha=alpha, run_log=run_log))
+				 for rank in pending_ranks]
+		if tuning_store is not None:
+			cells = tuning_store.store_cells(cells, lambda rank: (rank, regParam_list, 0))
+		print("Start " + str(len(cells)) + " warm-started sweeps (parallelism: " + str(parallelism) + ").")
+		sweep_results = run_cells(cells, parallelism=parallelism, run_log=run_log,
+								  cell_tags=lambda rank: {"rank": rank, "regParam": regParam_list})
+		cell_results.update((i, sweep_results[params[0]][params[1]]) for i, params in enumerate(param_combination)
+							if params[0] in sweep_results)
+	elif backend == "local":
+		# one cell per configuration; the data is collected and indexed once for all of the cells
+		if local_data is None and pending:
+			train_pdf = train_data.select(user, item, rating).toPandas()
+			val_pdf = val_data.select(user, item, rating).toPandas()
+			ratings, user_ids, item_ids = build_rating_matrix(train_pdf, user=user, item=item, rating=rating)
+			local_data = (ratings, None, user_ids, item_ids, val_pdf)
+		cells = [(i, partial(local_fit_and_evaluate, *local_data, params[0], params[1], metrics,
+							 k=k, maxIter=maxIter, seed=seed, user=user, item=item, rating=rating,
+							 evaluation=evaluation, implicitPrefs=implicitPrefs, alpha=alpha, run_log=run_log))
+				 for i, params in enumerate(param_combination) if i in pending]
+		if tuning_store is not None:
+			cells = tuning_store.store_cells(cells, lambda i: param_combination[i] + (0,))
+		print("Start " + str(len(cells)) + " in-process configurations (parallelism: " + str(parallelism) + ").")
+		cell_results.update(run_cells(cells, parallelism=parallelism, run_log=run_log,
+									  cell_tags=lambda i: dict(zip(["rank", "regParam"], param_combination[i]))))
+	else:
+		# one cell per configuration; the cells may run concurrently
+		cells = [(i, partial(fit_and_evaluate, train_data, val_data, params[0], params[1], metrics,
+							 k=k, maxIter=maxIter, seed=seed, user=user, item=item, rating=rating,
+							 evaluation=evaluation, implicitPrefs=implicitPrefs, alpha=alpha, run_log=run_log))
+				 for i, params in enumerate(param_combination) if i in pending]
+		if tuning_store is not None:
+			cells = tuning_store.store_cells(cells, lambda i: param_combination[i] + (0,))
+		print("Start " + str(len(cells)) + " configurations (parallelism: " + str(parallelism) + ").")
+		cell_results.update(run_cells(cells, parallelism=parallelism, run_log=run_log,
+									  cell_tags=lambda i: dict(zip(["rank", "regParam"], param_combination[i]))))
+	# the tuning table is assembled in the order of the grid
 	for i, params in enumerate(param_combination):
-		print("Start " + str(i+1) + " configuration.")
-		# initialize parameters, total_metrcs
-		rank, regParam = params[0], params[1]
-
-		# append rank and regParam into the tuning table
-		tuning_table["rank"].append(rank)
-		tuning_table["regParam"].append(regParam)
-
-		# initializa, fit, transform the ALS model
-		als = ALS(rank=rank, maxIter=maxIter, regParam = regParam, seed=123,
-	              coldStartStrategy="drop", userCol=user,
-	              itemCol=item, ratingCol=rating,
-	              implicitPrefs=False, nonnegative=True)
-		model = als.fit(train_data)
-		val_pred = model.transform(val_data)
-		# evaluation
-		if metrics in ["rmse", "mae", "r2"]:
-			# we use the regression metrics
-			metrics_result = top_k_regressionmetrics(
-								dataset=val_pred, k=k,
-								regression_metrics=metrics,
-								user=user, item=item, rating=rating,
-								prediction="prediction")
-		elif metrics in ["precisionAt", "meanAveragePrecision", "ndcgAt"]:
-			# we use the ranking metrics
-			metrics_result = top_k_rankingmetrics(
-								dataset=val_pred, k=k,
-								ranking_metrics=metrics,
-								user=user, item=item, rating=rating,
-								prediction="prediction")
-
-		print("Finish " + str(i+1) + " configuration.")
-		# append metrics into the tuning table
-		tuning_table[metrics].append(round(metrics_result, 4))
+		# append rank, regParam and metrics into the tuning table
+		tuning_table["rank"].append(params[0])
+		tuning_table["regParam"].append(params[1])
+		for metric in metrics:
+			tuning_table[metric].append(round(cell_results[i][metric], 4))
+	print("Finish " + str(len(cells)) + " configurations.")
 
 	# find the best hyperparamters from the average metrics of k-fold
 	best_param_dict = {}
-	if metrics in ["rmse", "mae", "r2"]:
+	# a configuration without any prediction has NaN metrics and is never selected
+	if selection_metric in ["rmse", "mae", "r2"]:
 		# we use the regression metrics (select minimum)
-		best_index = np.argmin(tuning_table[metrics])
-	elif metrics in ["precisionAt", "meanAveragePrecision", "ndcgAt"]:
+		best_index = np.nanargmin(tuning_table[selection_metric])
+	elif selection_metric in ["precisionAt", "meanAveragePrecision", "ndcgAt"]:
 		# we use the ranking metrics (select maximum)
-		best_index = np.argmax(tuning_table[metrics])
+		best_index = np.nanargmax(tuning_table[selection_metric])
 
 	# store the best configuration into the dictionary
 	best_param_dict["rank"] = tuning_table["rank"][best_index]
 	best_param_dict["regParam"] = tuning_table["regParam"][best_index]
-	best_param_dict[metrics] = tuning_table[metrics][best_index]
+	for metric in metrics:
+		best_param_dict[metric] = tuning_table[metric][best_index]
 	return best_param_dict, tuning_table
 
 def top_k_rankingmetrics(dataset=None, k=10, ranking_metrics="precisionAt", user="user_id",
  						item="book_id", rating="rating", prediction="prediction"):
 	'''
 	This function is to compute the ranking metrics from predictions.
+	The three metrics are computed together in one grouped pass (see ranking_evaluator.py).
 	Input:
 	1. k: only evaluate the performance of the top k items
-	2. ranking_metrics: precisionAt, meanAveragePrecision, ndcgAt
+	2. ranking_metrics: precisionAt, meanAveragePrecision, ndcgAt; or all for a dictionary of the three
 	3. user, item, prediction: column names; string type
 
 	refer to https://vinta.ws/code/spark-ml-cookbook-pyspark.html
@@ -198,67 +417,38 @@ def top_k_rankingmetrics(dataset=None, k=10, ranking_metrics="precisionAt", user
 	if dataset == None:
 		print("Error! Please specify a dataset.")
 		return
-	# prediction table
-	windowSpec = Window.partitionBy(user).orderBy(col(prediction).desc())
-	perUserPredictedItemsDF = dataset \
-		.select(user, item, prediction, F.rank().over(windowSpec).alias('rank')) \
-		.where('rank <= {}'.format(k)) \
-		.groupBy(user) \
-		.agg(expr('collect_list({}) as items'.format(item)))
-	# actual target table
-	windowSpec = Window.partitionBy(user).orderBy(col(rating).desc())
-	perUserActualItemsDF = dataset \
-		.select(user, item, rating, F.rank().over(windowSpec).alias('rank')) \
-		.where('rank <= {}'.format(k)) \
-		.groupBy(user) \
-		.agg(expr('collect_list({}) as items'.format(item)))
-	# join
-	perUserItemsRDD = perUserPredictedItemsDF \
-		.join(F.broadcast(perUserActualItemsDF), user, 'inner') \
-		.rdd \
-		.map(lambda row: (row[1], row[2]))
-	ranking_metrics_evaluator = RankingMetrics(perUserItemsRDD)
+	all_metrics = grouped_ranking_metrics(dataset, k=k, user=user, item=item,
+										  rating=rating, prediction=prediction)
 	# get the result of the metric
-	if ranking_metrics == "precisionAt":
-		precision_at_k = ranking_metrics_evaluator.precisionAt(k)
-		#print("precisionAt: {}".format(round(precision_at_k, 4)))
-		return precision_at_k
-	elif ranking_metrics == "meanAveragePrecision":
-		mean_avg_precision = ranking_metrics_evaluator.meanAveragePrecision(k)
-		#print("meanAveragePrecision: {}".format(round(mean_avg_precision, 4)))
-		return mean_avg_precision
-	elif ranking_metrics == "ndcgAt":
-		ndcg_at_k = ranking_metrics_evaluator.ndcgAt(k)
-		#print("meanAveragePrecision: {}".format(round(ndcg_at_k, 4)))
-		return ndcg_at_k
+	if ranking_metrics == "all":
+		return all_metrics
+	return all_metrics[ranking_metrics]
 
 def top_k_regressionmetrics(dataset=None, k=10, regression_metrics="rmse", user="user_id",
-					 item="book_id", rating="rating", prediction="prediction"):
+					 item="book_id", rating="rating", prediction="prediction", per_user=False):
 	'''
-	This function is to compute the regression metrics from predictions
+	This function is to compute the regression metrics from predictions.
+	rmse, mae and r2 come from one aggregate of sums and sums of squares, and the top k
+	predictions of every user are kept by a partial sort (see regression_evaluator.py).
 	Input:
-	1. k: only evaluate the performance of the top k items
-	2. regression_metrics: rmse, mae, r2
+	1. k: only evaluate the performance of the top k items; None for every prediction
+	2. regression_metrics: rmse, mae, r2; or all for a dictionary of the three
 	3. user, item, prediction: column names; string type
+	4. per_user: also return a DataFrame of the metrics of every user
 
 	refer to https://spark.apache.org/docs/2.2.0/ml-collaborative-filtering.html
 	'''
 	if dataset == None:
 		print("Error! Please specify a dataset.")
 		return
-	# prediction table
-	windowSpec = Window.partitionBy(user).orderBy(col(prediction).desc())
-	user_items_prediction_df = dataset \
-		.select(user, item, prediction, rating, F.rank().over(windowSpec).alias('rank')) \
-		.where('rank <= {}'.format(k))
-	# regression metrics
-	regression_metrics_evaluator = RegressionEvaluator(metricName=regression_metrics,
-													   labelCol=rating,
-                                					   predictionCol=prediction)
-	result = regression_metrics_evaluator.evaluate(user_items_prediction_df)
-	#print(result)
-	#print("{}: {}".format(regression_metrics, round(result, 4)))
-	return result # return rmse, mae, or r2
+	result = grouped_regression_metrics(dataset, k=k, user=user, rating=rating,
+										prediction=prediction, per_user=per_user)
+	all_metrics = result[0] if per_user else result
+	# get the result of the metric
+	metric_result = all_metrics if regression_metrics == "all" else all_metrics[regression_metrics]
+	if per_user:
+		return metric_result, result[1]
+	return metric_result # return rmse, mae, or r2
 
 def set_arguments():
 	parser = argparse.ArgumentParser()
@@ -267,11 +457,29 @@ def set_arguments():
 	parser.add_argument("--parquet_path", help="Specifying the path of the parquet file you want to read.")
 	parser.add_argument("--top_k", help="Only evaluating top k interations.")
 	#parser.add_argument("--k_fold_split", help="Doing k-fold cross validation.")
-	parser.add_argument("--metrics", help="The metrics for cross validation and measurement.")
+	parser.add_argument("--metrics", help="The metrics for cross validation and measurement; separate several metrics by commas.")
+	parser.add_argument("--selection_metric", default=None, help="The metric for selecting the best configuration (the first metric by default).")
 	parser.add_argument("--rank_list", help="A list of ranks for tuning.")
 	parser.add_argument("--regParam_list", help="A list of regularization parameters for tuning.")
 	parser.add_argument("--path_of_model", help="Save the fitted model with this path.")
-	parser.add_argument("--set_memory", help="Specifying the memory.")
+	parser.add_argument("--max_iter", default="5", help="The (maximum) number of ALS iterations.")
+	parser.add_argument("--warm_start", action="store_true", help="Warm-start the regParam sweep of each rank (in-process ALS).")
+	parser.add_argument("--tol", default=None, help="Stop the warm-started fits when the training RMSE changes less than tol.")
+	parser.add_argument("--evaluation", default="pairs", help="pairs: rank the held-out items; catalog: rank the whole catalog (ranking metrics).")
+	parser.add_argument("--backend", default="spark", help="spark: tune with pyspark.ml ALS; local: tune with the in-process ALS (local_als.py).")
+	parser.add_argument("--implicit_prefs", action="store_true", help="Implicit-feedback ALS on confidence weights from is_read, rating and is_reviewed.")
+	parser.add_argument("--alpha", default="1.0", help="The confidence scale of implicit feedback.")
+	parser.add_argument("--confidence_weights", default="[1.0,1.0,1.0]", help="The weights of is_read, rating and is_reviewed in the confidence.")
+	parser.add_argument("--store_path", default=None, help="Local folder of an interaction store (interaction_store.py) for the local backend.")
+	parser.add_argument("--export_path", default=None, help="Folder name (under models in the home folder) of the versioned factor export for serving.")
+	parser.add_argument("--data_version", default=None, help="The data version recorded in the factor export; the parquet path by default.")
+	parser.add_argument("--parallelism", default="1", help="Number of ALS fits running at the same time during tuning.")
+	parser.add_argument("--run_log", default=None, help="Local JSON-lines file of the wall time and the Spark metrics of every step.")
+	parser.add_argument("--tuning_store", default="tuning_store.db", help="SQLite file (under history in the home folder) of the tuning results.")
+	parser.add_argument("--recompute", action="store_true", help="Fit every cell again instead of reusing the cells in the tuning store.")
+	parser.add_argument("--split_seed", default="123", help="The seed of the split of the users and the held-out interactions.")
+	parser.add_argument("--id_dict_path", default=None, help="Folder name of the id dictionaries; trains on the dense index columns.")
+	add_spark_arguments(parser)
 	args = parser.parse_args()
 	return args
 
@@ -282,7 +490,18 @@ if __name__ == "__main__":
 
 	# initial some parameters from args
 	top_k = int(args.top_k)
-	my_metrics = args.metrics
+	my_metrics = args.metrics.split(",")
+	selection_metric = my_metrics[0] if args.selection_metric is None else args.selection_metric
+	if selection_metric not in my_metrics:
+		my_metrics.append(selection_metric)
+	if args.implicit_prefs:
+		# implicit feedback predicts preferences, so the errors against the confidence weights mean nothing
+		skipped = [metric for metric in my_metrics if metric in ["rmse", "mae", "r2"]]
+		if selection_metric in skipped:
+			raise ValueError("Implicit feedback is selected by a ranking metric, not " + selection_metric + ".")
+		if skipped:
+			print("Warning! Skipping " + ",".join(skipped) + " with implicit feedback.")
+		my_metrics = [metric for metric in my_metrics if metric not in skipped]
 	rank_list = eval(args.rank_list)
 	regParam_list = eval(args.regParam_list)
 	path_of_model = args.path_of_model
@@ -290,7 +509,13 @@ if __name__ == "__main__":
 	filename = args.parquet_path
 
 	# setting
-	spark = settings(args.set_memory)
+	parallelism = int(args.parallelism)
+	max_iter = int(args.max_iter)
+	split_seed = int(args.split_seed)
+	tol = None if args.tol is None else float(args.tol)
+	alpha = float(args.alpha)
+	# implicit feedback trains on the confidence weights instead of the ratings
+	rating_col = "confidence" if args.implicit_prefs else "rating"
 
 	# path
 	from_hdfs_path = "hdfs:///user/"+args.from_net_id+"/goodreads/"
@@ -298,15 +523,48 @@ if __name__ == "__main__":
 	to_home_path = "/home/"+args.to_net_id+"/goodreads/"
 	#hdfs_path = ""
 
+	# FAIR lets the concurrent fits of the parallel tuning share the executors
+	spark = spark_session(args.profile, args.set_memory, args.cores,
+						  input_path=from_hdfs_path+"data/"+filename,
+						  scheduler_mode="FAIR" if parallelism > 1 else "FIFO", app_name="modeling")
+	# the steps below are recorded in the run log (a no-op without --run_log)
+	run_log = RunLog(spark, args.run_log, script="modeling")
+
 	### 1. read data ###
 	print("Reading the data.")
 	data_schema = create_schema()
-	data = spark.read.schema(data_schema).parquet(from_hdfs_path+"data/"+filename)
+	data = run_log.run("read", lambda: spark.read.schema(data_schema).parquet(from_hdfs_path+"data/"+filename))
 	# data = spark.read.parquet("indexed_poetry.parquet", schema=data_schema)
+	user_col, item_col = "user_id", "book_id"
+	if args.id_dict_path is not None:
+		# reuse the dense ids from the shared dictionaries instead of re-indexing
+		data = index_with_dictionary(spark, data, from_hdfs_path+"data/"+args.id_dict_path, update=False)
+		user_col, item_col = "user_id_index", "book_id_index"
+	if args.implicit_prefs:
+		data = add_confidence(data, weights=eval(args.confidence_weights), confidence=rating_col)
 
 	### 2. split data ###
 	print("Splitting the data set.")
-	train_data, val_data, test_data = train_val_test_split(data)
+	train_data, val_data, test_data = run_log.run("split", partial(train_val_test_split, data, user=user_col,
+																   item=item_col, seed=split_seed))
+	local_data = None
+	if args.store_path is not None:
+		# the local backend rebuilds the split from the memory-mapped interaction store
+		store = open_interaction_store(args.store_path)
+		check_store_values(store, rating_col, eval(args.confidence_weights) if args.implicit_prefs else None)
+		check_store_split(store, user_col, item_col, split_seed)
+		local_data = store_split(store, fractions=[0.6, 0.2, 0.2], val_group=1, holdout_groups=[1, 2],
+								 user=user_col, item=item_col, rating=rating_col)
+
+	# the tuning results are keyed by the data, the split and the configuration (tuning_store.py)
+	fingerprint = dataset_fingerprint(spark, from_hdfs_path+"data/"+filename, id_dict_path=args.id_dict_path)
+	tuning_store = TuningStore(to_home_path+"history/"+args.tuning_store, fingerprint,
+							   split_seed=split_seed, maxIter=max_iter, run_id=run_log.run_id, recompute=args.recompute,
+							   config={"split": "train_val_test", "k": top_k, "evaluation": args.evaluation,
+									   "backend": args.backend, "warm_start": args.warm_start, "tol": tol,
+									   "implicitPrefs": args.implicit_prefs, "alpha": alpha,
+									   "confidence_weights": args.confidence_weights if args.implicit_prefs else None,
+									   "user": user_col, "item": item_col})
 
 	### 3. tuning ALS by cross validation ###
 	start_time = time.time()
@@ -318,12 +576,24 @@ if __name__ == "__main__":
 	tuning_result = tuning_als(
 		train_data=train_data, val_data=val_data,
 		rank_list=rank_list, regParam_list=regParam_list,
-		k=top_k, maxIter=5, metrics=my_metrics
+		k=top_k, maxIter=max_iter, metrics=my_metrics,
+		user=user_col, item=item_col,
+		parallelism=parallelism,
+		warm_start=args.warm_start, tol=tol,
+		evaluation=args.evaluation,
+		selection_metric=selection_metric,
+		backend=args.backend,
+		rating=rating_col,
+		implicitPrefs=args.implicit_prefs, alpha=alpha,
+		local_data=local_data,
+		run_log=run_log,
+		tuning_store=tuning_store
 	)
 
 	tuning_hist = tuning_result[1]
 	best_config = tuning_result[0]
 	best_rank, best_regParam = best_config["rank"], best_config["regParam"]
+	tuning_time = time.time() - start_time
 
 	### 4. prediction on the test set ###
 	# after find the best hyperparameters, we train on the train set again, and then make prediction on the test set
@@ -332,31 +602,22 @@ if __name__ == "__main__":
 
 	# initialize ALS estimator
 	print("Re-training on the train set and predicting on the test set.")
-	als = ALS(rank=best_rank, regParam = best_regParam, maxIter=5,
-			  seed=123, coldStartStrategy="drop", userCol="user_id",
-              itemCol="book_id", ratingCol="rating",
-              implicitPrefs=False, nonnegative=True)
+	als = ALS(rank=best_rank, regParam = best_regParam, maxIter=max_iter,
+			  seed=123, coldStartStrategy="drop", userCol=user_col,
+              itemCol=item_col, ratingCol=rating_col,
+              implicitPrefs=args.implicit_prefs, alpha=alpha, nonnegative=True)
 
-	model = als.fit(new_train_data)
+	model = run_log.run("fit", lambda: als.fit(new_train_data), rank=best_rank, regParam=best_regParam)
 	test_pred = model.transform(test_data) # predictions is a DataFrame with prediction column
-	test_pred.show(20)
-	# compute ranking metrics on the test set
-	if my_metrics in ["rmse", "mae", "r2"]:
-		test_metrics = top_k_regressionmetrics(dataset=test_pred,
-						k=top_k,
-						regression_metrics=my_metrics,
-						user="user_id",
-						item="book_id",
-						rating="rating",
-						prediction="prediction")
-	elif my_metrics in ["precisionAt", "meanAveragePrecision", "ndcgAt"]:
-		test_metrics = top_k_rankingmetrics(dataset=test_pred,
+	run_log.run("show", lambda: test_pred.show(20))
+	# compute every metric on the test set the way the configuration was selected
+	test_metrics = evaluate_model(model, new_train_data, test_data, my_metrics,
 						k=top_k,
-						ranking_metrics=my_metrics,
-						user="user_id",
-						item="book_id",
-						rating="rating",
-						prediction="prediction")
+						user=user_col,
+						item=item_col,
+						rating=rating_col,
+						evaluation=args.evaluation,
+						run_log=run_log)
 
 	end_time = time.time()
 	time_statement = "It takes {0} seconds to tune and train the model.".\
@@ -366,29 +627,32 @@ if __name__ == "__main__":
 	### 5. save the estimator (model) ###
 	# refer to https://spark.apache.org/docs/2.3.0/api/python/pyspark.ml.html#pyspark.ml.classification.LogisticRegression.save
 	print("Saving the estimator.")
-	model.write().overwrite().save(to_hdfs_path+"models/"+path_of_model)
+	run_log.run("save", lambda: model.write().overwrite().save(to_hdfs_path+"models/"+path_of_model))
+	if args.export_path is not None:
+		# the factors as memory-mappable arrays for serving without Spark (factor_export.load_factors)
+		print("Exporting the factors.")
+		# the raw ids of the dense ids, so that the export serves user_id and book_id
+		dictionaries = None
+		if args.id_dict_path is not None:
+			dictionaries = {"user": data.select("user_id", "user_id_index").distinct(),
+							"item": data.select("book_id", "book_id_index").distinct()}
+		version = export_spark_model(model, to_home_path+"models/"+args.export_path,
+									 manifest={"model_path": path_of_model,
+											   "data_version": filename if args.data_version is None else args.data_version,
+											   "id_dict_path": args.id_dict_path,
+											   "user_col": user_col, "item_col": item_col,
+											   "rating_col": rating_col,
+											   "regParam": best_regParam, "maxIter": max_iter,
+											   "implicitPrefs": args.implicit_prefs, "alpha": alpha,
+											   "confidence_weights": eval(args.confidence_weights) if args.implicit_prefs else None,
+											   "nonnegative": True,
+											   "selection_metric": selection_metric,
+											   "metrics": test_metrics},
+									 dictionaries=dictionaries)
+		print("Exported version {0} of the factors.".format(version))
 
 	# record all of the hyperparameter configurations, the best configuration, testing result
-	print("Recording the tuning history.")
-	with open(to_home_path+"history/"+"tuning_history.txt", "a+") as file:
-		write_args = (path_of_model,
-					  filename,
-				   	  str(rank_list),
-				   	  str(regParam_list),
-				   	  str(tuning_hist),
-				   	  best_rank,
-				   	  best_regParam,
-				   	  my_metrics,
-				   	  round(test_metrics, 4),
-				   	  time_statement)
-		file.write("Model Path: {0}\n" \
-				   "Data: {1}\n" \
-				   "Rank List: {2}\n" \
-				   "RegParam List: {3}\n" \
-				   "Tuning History: {4}\n" \
-				   "Best Rank: {5}; Best RegParam: {6}\n" \
-				   "Test Result ({7}): {8}\n" \
-				   "Note: {9}\n\n" \
-				   "---------" \
-				   "\n\n" \
-				   .format(*write_args))
+	print("Recording the run in the tuning store.")
+	tuning_store.save_run("modeling", path_of_model, filename, rank_list, regParam_list, tuning_hist, best_config,
+						  selection_metric, test_metrics, tuning_seconds=round(tuning_time, 2),
+						  total_seconds=round(end_time-start_time, 2))
@@ -0,0 +1,51 @@
+from pyspark.sql import SparkSession
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import itertools
+import threading
+
+
+def run_cells(cells, parallelism=1, pool_prefix="tuning", run_log=None, cell_tags=None):
+    '''
+    This function is to run the cells of a tuning grid, e.g. one (rank, regParam, fold) fit and
+    evaluation per cell. With parallelism > 1, the cells are submitted from a thread pool
+    against the same SparkSession, and each thread uses its own FAIR scheduler pool so that
+    the jobs of one fit fill the executor cores left idle by another.
+    The FAIR pools only take effect if spark.scheduler.mode is FAIR (see settings).
+    Input:
+    1. cells: a list of (key, function) pairs; function takes no argument
+    2. parallelism: the maximum number of cells running at the same time
+    3. pool_prefix: the prefix of the scheduler pool names
+    4. run_log: an instrumentation.RunLog; every cell is recorded as one cell step, the parent of
+       the fit, transform and evaluate steps the cell records with the same run_log
+    5. cell_tags: a function of the key of a cell which returns the fields of its record,
+       e.g. {rank, regParam, fold}
+    Output:
+    1. a dictionary of {key: result}, in the same order as cells whatever the finishing order
+    '''
+    if run_log is not None:
+        cells = [(key, partial(run_log.run, "cell", function, **(cell_tags(key) if cell_tags else {})))
+                 for key, function in cells]
+    if parallelism <= 1:
+        return dict((key, function()) for key, function in cells)
+    sc = SparkSession.builder.getOrCreate().sparkContext
+    # a cell runs on whichever worker thread is free, so the pool belongs to the thread:
+    # every worker takes the next slot the first time it runs a cell
+    slots = itertools.count()
+    slot_lock = threading.Lock()
+    worker = threading.local()
+
+    def run_in_pool(function):
+        if not hasattr(worker, "slot"):
+            with slot_lock:
+                worker.slot = next(slots)
+        # local properties are per thread, so every worker thread gets its own pool
+        sc.setLocalProperty("spark.scheduler.pool", "{0}_{1}".format(pool_prefix, worker.slot))
+        try:
+            return function()
+        finally:
+            sc.setLocalProperty("spark.scheduler.pool", None)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [(key, executor.submit(run_in_pool, function)) for key, function in cells]
+        return dict((key, future.result()) for key, future in futures)
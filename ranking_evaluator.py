@@ -0,0 +1,242 @@
+from pyspark.sql import SparkSession
+from pyspark.sql.types import StructType, StructField, DoubleType
+import pyspark.sql.functions as F
+from functools import partial
+import numpy as np
+import pandas as pd
+from topk import blocked_top_k, exclusion_matrix
+from local_als import lookup_index
+
+RANKING_METRICS = ["precisionAt", "meanAveragePrecision", "ndcgAt"]
+
+
+def top_k_order(values, k):
+    '''
+    This function is to get the positions of the k largest values, from the largest to the smallest.
+    argpartition finds the top k in linear time; only those k values are sorted.
+    '''
+    if len(values) > k:
+        top = np.argpartition(-values, k - 1)[:k]
+        return top[np.argsort(-values[top], kind="stable")]
+    return np.argsort(-values, kind="stable")
+
+
+def relevant_mask(ratings, k=10):
+    '''
+    This function is to find the relevant items of a user: the items whose rating ranks
+    in the top k (ties included), i.e. rating >= the k-th largest rating.
+    '''
+    n = len(ratings)
+    if n > k:
+        return ratings >= np.partition(ratings, n - k)[n - k]
+    return np.ones(n, dtype=bool)
+
+
+def list_ranking_metrics(hits, n_relevant, k=10):
+    '''
+    This function is to compute precision@k, MAP@k and NDCG@k of one predicted list.
+    The formulas follow pyspark.mllib.evaluation.RankingMetrics.
+    Input:
+    1. hits: a boolean array; whether the i-th predicted item is relevant
+    2. n_relevant: the number of relevant items
+    3. k: only evaluate the top k items
+    Output:
+    1. (precision, average precision, ndcg)
+    '''
+    if n_relevant == 0:
+        return 0.0, 0.0, 0.0
+    hits = hits[:k]
+    positions = np.arange(1, len(hits) + 1)
+    # precision@k
+    precision = hits.sum() / k
+    # MAP@k
+    average_precision = (np.cumsum(hits)[hits] / positions[hits]).sum() / min(n_relevant, k)
+    # NDCG@k
+    discounts = 1.0 / np.log(np.arange(max(len(hits), min(n_relevant, k))) + 2)
+    dcg = discounts[:len(hits)][hits].sum()
+    max_dcg = discounts[:min(n_relevant, k)].sum()
+    return precision, average_precision, dcg / max_dcg
+
+
+def user_ranking_metrics(predictions, ratings, k=10):
+    '''
+    This function is to compute precision@k, MAP@k and NDCG@k of one user.
+    The predicted list is the k items with the highest predictions; the relevant items are
+    the items whose rating ranks in the top k (ties included), as in the former
+    Window rank <= k.
+    Input:
+    1. predictions: the predictions of the items of the user (numpy array)
+    2. ratings: the ratings of the same items (numpy array)
+    3. k: only evaluate the top k items
+    Output:
+    1. (precision, average precision, ndcg)
+    '''
+    relevant = relevant_mask(ratings, k)
+    hits = relevant[top_k_order(predictions, k)]
+    return list_ranking_metrics(hits, int(relevant.sum()), k)
+
+
+def evaluate_users(pdf, k=10, user="user_id", rating="rating", prediction="prediction"):
+    '''
+    This function is to compute the ranking metrics of every user in a pandas DataFrame.
+    Input:
+    1. pdf: a pandas DataFrame with the user, rating and prediction columns
+    2. k: only evaluate the top k items
+    Output:
+    1. a pandas DataFrame with one row of precisionAt, meanAveragePrecision, ndcgAt per user
+    '''
+    pdf = pdf.sort_values(user, kind="stable")
+    users, starts = np.unique(pdf[user].values, return_index=True)
+    ends = np.append(starts[1:], len(pdf))
+    predictions = pdf[prediction].values.astype(np.float64)
+    ratings = pdf[rating].values.astype(np.float64)
+    metrics = [user_ranking_metrics(predictions[start:end], ratings[start:end], k)
+               for start, end in zip(starts, ends)]
+    return pd.DataFrame(np.array(metrics, dtype=np.float64).reshape(-1, 3), columns=RANKING_METRICS)
+
+
+def ranking_metrics(dataset, k=10, user="user_id", item="book_id", rating="rating", prediction="prediction"):
+    '''
+    This function is to compute precision@k, MAP@k and NDCG@k from a prediction DataFrame in one
+    grouped pass: the rows of each user are handed to NumPy through Arrow (applyInPandas),
+    the three metrics are computed together, and only their means come back to the driver.
+    Input:
+    1. dataset: a DataFrame with the user, item, rating and prediction columns
+    2. k: only evaluate the top k items
+    3. user, item, rating, prediction: column names
+    Output:
+    1. a dictionary of {precisionAt, meanAveragePrecision, ndcgAt}
+    '''
+    schema = StructType([StructField(name, DoubleType()) for name in RANKING_METRICS])
+    per_user = dataset \
+        .select(user, rating, prediction) \
+        .groupBy(user) \
+        .applyInPandas(partial(evaluate_users, k=k, user=user, rating=rating, prediction=prediction), schema)
+    result = per_user.agg(*[F.avg(name).alias(name) for name in RANKING_METRICS]).first()
+    # avg is null without any prediction (e.g. every user dropped by coldStartStrategy="drop")
+    return dict((name, float("nan") if result[name] is None else result[name]) for name in RANKING_METRICS)
+
+
+def evaluate_catalog_users(user_vectors, item_factors, seen, val_items, val_ratings, k=10, item_block_size=65536):
+    '''
+    This function is to compute the ranking metrics of users against the whole catalog:
+    the predicted list of a user is the top k of all items, except the items seen in training.
+    Input:
+    1. user_vectors: (n_users x rank) user factors
+    2. item_factors: (n_items x rank) item factors
+    3. seen: a (n_users x n_items) sparse matrix of the items seen in training
+    4. val_items: a list of arrays; the item positions of each user's validation interactions
+       (-1 for items without factors; they are relevant but can never be retrieved)
+    5. val_ratings: a list of arrays; the ratings of the same interactions
+    6. k: only evaluate the top k items
+    7. item_block_size: number of items scored at once
+    Output:
+    1. a (n_users x 3) array of precisionAt, meanAveragePrecision, ndcgAt
+    '''
+    top_items, _ = blocked_top_k(user_vectors, item_factors, k=k, exclude=seen, item_block_size=item_block_size)
+    metrics = np.zeros((len(val_items), 3))
+    for u in range(len(val_items)):
+        relevant = val_items[u][relevant_mask(val_ratings[u], k)]
+        hits = np.isin(top_items[u][top_items[u] >= 0], relevant[relevant >= 0])
+        metrics[u] = list_ranking_metrics(hits, len(relevant), k)
+    return metrics
+
+
+def evaluate_catalog_batches(batches, item_broadcast, k=10, item_block_size=65536):
+    '''
+    This function is to run evaluate_catalog_users on the Arrow batches of a partition (mapInPandas).
+    Every batch has the user factors (features), the validation items and ratings, and the
+    items seen in training; the item factors come from a broadcast variable.
+    '''
+    item_ids, item_factors = item_broadcast.value
+    for pdf in batches:
+        if len(pdf) == 0:
+            continue
+        user_vectors = np.stack(pdf["features"].values)
+        # the items seen in training, as a sparse (users x items) matrix of positions
+        seen = exclusion_matrix(item_ids, pdf["seen_items"])
+        val_items = []
+        for items in pdf["val_items"]:
+            positions, known = lookup_index(item_ids, np.asarray(items, dtype=item_ids.dtype))
+            val_items.append(np.where(known, positions, -1))
+        val_ratings = [np.asarray(ratings, dtype=np.float64) for ratings in pdf["val_ratings"]]
+        metrics = evaluate_catalog_users(user_vectors, item_factors, seen, val_items, val_ratings,
+                                         k=k, item_block_size=item_block_size)
+        yield pd.DataFrame(metrics, columns=RANKING_METRICS)
+
+
+def catalog_ranking_metrics(model, train_data, val_data, k=10, user="user_id", item="book_id",
+                            rating="rating", item_block_size=65536):
+    '''
+    This function is to compute precision@k, MAP@k and NDCG@k by ranking the whole book
+    catalog for every validation user, instead of only the items in the validation set.
+    The item factors are broadcast; every partition of validation users multiplies its user
+    factors with blocks of item factors and keeps the running top k per user, so the full
+    score matrix is never built. The items seen in training are excluded.
+    Input:
+    1. model: a fitted pyspark.ml.recommendation.ALSModel
+    2. train_data: the training set (for the seen items)
+    3. val_data: the validation set
+    4. k: only evaluate the top k items
+    5. user, item, rating: column names
+    6. item_block_size: number of items scored at once
+    Output:
+    1. a dictionary of {precisionAt, meanAveragePrecision, ndcgAt}
+    '''
+    spark = SparkSession.builder.getOrCreate()
+    item_pdf = model.itemFactors.toPandas().sort_values("id")
+    item_ids = item_pdf["id"].values
+    item_factors = np.stack(item_pdf["features"].values).astype(np.float32)
+    item_broadcast = spark.sparkContext.broadcast((item_ids, item_factors))
+    val_lists = val_data.groupBy(user).agg(F.collect_list(item).alias("val_items"),
+                                           F.collect_list(rating).alias("val_ratings"))
+    seen_lists = train_data.groupBy(user).agg(F.collect_list(item).alias("seen_items"))
+    # users without factors are dropped, like coldStartStrategy="drop"
+    users = val_lists \
+        .join(model.userFactors.withColumnRenamed("id", user), user, how="inner") \
+        .join(seen_lists, user, how="left")
+    schema = StructType([StructField(name, DoubleType()) for name in RANKING_METRICS])
+    per_user = users.mapInPandas(partial(evaluate_catalog_batches, item_broadcast=item_broadcast,
+                                         k=k, item_block_size=item_block_size), schema)
+    result = per_user.agg(*[F.avg(name).alias(name) for name in RANKING_METRICS]).first()
+    item_broadcast.unpersist()
+    return dict((name, float("nan") if result[name] is None else result[name]) for name in RANKING_METRICS)
+
+
+def local_catalog_ranking_metrics(user_factors, item_factors, train_ratings, val_pdf, user_ids, item_ids,
+                                  k=10, user="user_id", item="book_id", rating="rating", item_block_size=65536):
+    '''
+    This function is to compute the whole-catalog ranking metrics of an in-process model (local_als.py).
+    Input:
+    1. user_factors, item_factors: the factors; their rows follow user_ids and item_ids
+    2. train_ratings: the training CSR matrix (the seen items are excluded)
+    3. val_pdf: a pandas DataFrame of the validation set
+    4. user_ids, item_ids: the ids of the rows and the columns of train_ratings
+    5. k: only evaluate the top k items
+    Output:
+    1. a dictionary of {precisionAt, meanAveragePrecision, ndcgAt}
+    '''
+    rows, known_user = lookup_index(user_ids, val_pdf[user].values)
+    # users without factors are dropped, like coldStartStrategy="drop"
+    val_pdf = val_pdf[known_user].assign(user_row=rows[known_user]).sort_values("user_row", kind="stable")
+    positions, known_item = lookup_index(item_ids, val_pdf[item].values)
+    positions = np.where(known_item, positions, -1)
+    user_rows, starts = np.unique(val_pdf["user_row"].values, return_index=True)
+    ends = np.append(starts[1:], len(val_pdf))
+    ratings = val_pdf[rating].values.astype(np.float64)
+    metrics = evaluate_catalog_users(user_factors[user_rows], item_factors, train_ratings[user_rows],
+                                     [positions[start:end] for start, end in zip(starts, ends)],
+                                     [ratings[start:end] for start, end in zip(starts, ends)],
+                                     k=k, item_block_size=item_block_size)
+    return dict((name, float(metrics[:, i].mean()) if len(metrics) else float("nan")) for i, name in enumerate(RANKING_METRICS))
+
+
+def local_ranking_metrics(pdf, k=10, user="user_id", rating="rating", prediction="prediction"):
+    '''
+    This function is to compute precision@k, MAP@k and NDCG@k of the predictions of an in-process
+    model (a pandas DataFrame), without going through Spark.
+    Output:
+    1. a dictionary of {precisionAt, meanAveragePrecision, ndcgAt}
+    '''
+    per_user = evaluate_users(pdf, k=k, user=user, rating=rating, prediction=prediction)
+    return dict((name, float(per_user[name].mean()) if len(per_user) else float("nan")) for name in RANKING_METRICS)
@@ -0,0 +1,133 @@
+from pyspark.sql import SparkSession
+from pyspark.sql.types import StructType, StructField, IntegerType, FloatType, ArrayType
+from pyspark.ml.recommendation import ALSModel
+import pyspark.sql.functions as F
+from functools import partial
+import numpy as np
+import pandas as pd
+import argparse
+import time
+from id_dictionary import index_with_dictionary
+from topk import blocked_top_k, exclusion_matrix
+from spark_config import spark_session, add_spark_arguments
+
+
+def recommend_batches(batches, item_broadcast, n=10, user="user_id_index", item_block_size=65536):
+    '''
+    This function is to recommend the top n items to the users of the Arrow batches of a partition
+    (mapInPandas). Every batch has the user factors (features) and the items already seen; the
+    item factors come from a broadcast variable. The scores are computed one block of items at a
+    time and only the running top n of every user is kept (topk.blocked_top_k), so the user x item
+    cross join is never built.
+    '''
+    item_ids, item_factors = item_broadcast.value
+    for pdf in batches:
+        if len(pdf) == 0:
+            continue
+        user_vectors = np.stack(pdf["features"].values)
+        seen = exclusion_matrix(item_ids, pdf["seen_items"]) if "seen_items" in pdf else None
+        top_items, top_scores = blocked_top_k(user_vectors, item_factors, k=n, exclude=seen,
+                                              item_block_size=item_block_size)
+        found = top_items >= 0
+        items = item_ids[np.maximum(top_items, 0)]
+        yield pd.DataFrame({user: pdf[user].values,
+                            "recommendations": [row[mask].tolist() for row, mask in zip(items, found)],
+                            "scores": [row[mask].tolist() for row, mask in zip(top_scores, found)]})
+
+
+def recommend_for_users(model, n=10, seen_data=None, users=None, user="user_id_index", item="book_id_index",
+                        item_block_size=65536):
+    '''
+    This function is to recommend the top n items to every user of a fitted ALS model.
+    Input:
+    1. model: a fitted pyspark.ml.recommendation.ALSModel
+    2. n: number of items per user
+    3. seen_data: the interactions (user, item) whose items are not recommended, e.g. the
+       books already read; None to keep every item
+    4. users: a DataFrame with the user column; None for every user of the model
+    5. user, item: column names
+    6. item_block_size: number of items scored at once
+    Output:
+    1. a DataFrame of (user, recommendations, scores), sorted by score within each user
+    '''
+    spark = SparkSession.builder.getOrCreate()
+    item_pdf = model.itemFactors.toPandas().sort_values("id")
+    item_ids = item_pdf["id"].values
+    item_factors = np.stack(item_pdf["features"].values).astype(np.float32)
+    item_broadcast = spark.sparkContext.broadcast((item_ids, item_factors))
+    user_factors = model.userFactors.withColumnRenamed("id", user)
+    if users is not None:
+        # users without factors are dropped, like coldStartStrategy="drop"
+        user_factors = user_factors.join(users.select(user).distinct(), user, how="inner")
+    if seen_data is not None:
+        # the seen items of every user are grouped next to its factors (a sort-merge join)
+        seen_lists = seen_data.groupBy(user).agg(F.collect_list(item).alias("seen_items"))
+        user_factors = user_factors.join(seen_lists, user, how="left")
+    schema = StructType([StructField(user, IntegerType()),
+                         StructField("recommendations", ArrayType(IntegerType())),
+                         StructField("scores", ArrayType(FloatType()))])
+    return user_factors.mapInPandas(partial(recommend_batches, item_broadcast=item_broadcast, n=n, user=user,
+                                            item_block_size=item_block_size), schema)
+
+
+def set_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from_net_id", help="Inputing the netID for reading the model and the data")
+    parser.add_argument("--to_net_id", help="Inputing the netID for writing the recommendations")
+    parser.add_argument("--path_of_model", help="The path (under models) of the model saved by modeling.py or modeling_cv.py.")
+    parser.add_argument("--write_parquet_path", help="Specifying the path of the parquet file of the recommendations.")
+    parser.add_argument("--top_n", default="10", help="Number of books recommended to every user.")
+    parser.add_argument("--seen_parquet_path", default=None, help="The interactions whose books are not recommended again, e.g. the books already read.")
+    parser.add_argument("--id_dict_path", default=None, help="Folder name of the id dictionaries; adds the dense index columns to the interactions.")
+    parser.add_argument("--users_parquet_path", default=None, help="A parquet file with the users to recommend to; every user of the model by default.")
+    parser.add_argument("--user_list", default=None, help="A list of users to recommend to, e.g. [1,2,3].")
+    parser.add_argument("--user_col", default="user_id_index", help="The user column of the model.")
+    parser.add_argument("--item_col", default="book_id_index", help="The item column of the model.")
+    parser.add_argument("--item_block_size", default="65536", help="Number of books scored at once.")
+    add_spark_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+
+    ### input arguments ###
+    args = set_arguments()
+
+    # path
+    from_hdfs_path = "hdfs:///user/" + args.from_net_id + "/goodreads/"
+    to_hdfs_path = "hdfs:///user/" + args.to_net_id + "/goodreads/"
+
+    ### setting ###
+    spark = spark_session(args.profile, args.set_memory, args.cores,
+                          input_path=None if args.seen_parquet_path is None else from_hdfs_path + "data/" + args.seen_parquet_path,
+                          app_name="recommend")
+
+    ### 1. load the model and the users ###
+    print("Loading the model.")
+    start_time = time.time()
+    model = ALSModel.load(from_hdfs_path + "models/" + args.path_of_model)
+    users = None
+    if args.users_parquet_path is not None:
+        users = spark.read.parquet(from_hdfs_path + "data/" + args.users_parquet_path)
+    elif args.user_list is not None:
+        users = spark.createDataFrame([(int(user),) for user in eval(args.user_list)], [args.user_col])
+    seen_data = None
+    if args.seen_parquet_path is not None:
+        seen_data = spark.read.parquet(from_hdfs_path + "data/" + args.seen_parquet_path)
+        if args.id_dict_path is not None:
+            seen_data = index_with_dictionary(spark, seen_data, from_hdfs_path + "data/" + args.id_dict_path, update=False)
+        seen_data = seen_data.select(args.user_col, args.item_col)
+
+    ### 2. recommend and write ###
+    print("Recommending the top {0} books.".format(args.top_n))
+    recommendations = recommend_for_users(model, n=int(args.top_n), seen_data=seen_data, users=users,
+                                          user=args.user_col, item=args.item_col,
+                                          item_block_size=int(args.item_block_size))
+    recommendations.write.mode("overwrite").parquet(to_hdfs_path + "data/" + args.write_parquet_path)
+    elapsed = time.time() - start_time
+
+    ### 3. throughput ###
+    n_users = spark.read.parquet(to_hdfs_path + "data/" + args.write_parquet_path).count()
+    print("It takes {0} seconds to recommend to {1} users ({2} users per second).".
+          format(str(round(elapsed, 2)), n_users, str(round(n_users / max(elapsed, 1e-9), 1))))
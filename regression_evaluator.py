@@ -0,0 +1,124 @@
+from pyspark.sql.types import StructType, StructField, DoubleType, LongType
+import pyspark.sql.functions as F
+from functools import partial
+import numpy as np
+import pandas as pd
+
+REGRESSION_METRICS = ["rmse", "mae", "r2"]
+SUM_COLUMNS = ["n", "sse", "sae", "sum_rating", "sum_rating2"]
+
+
+def top_k_mask(predictions, k=10):
+    '''
+    This function is to find the k items with the highest predictions of a user (ties included),
+    i.e. prediction >= the k-th largest prediction, as the former Window rank <= k.
+    np.partition only places the k-th value; the predictions are not sorted.
+    '''
+    n = len(predictions)
+    if n > k:
+        return predictions >= np.partition(predictions, n - k)[n - k]
+    return np.ones(n, dtype=bool)
+
+
+def top_k_sums(pdf, k=10, user="user_id", rating="rating", prediction="prediction"):
+    '''
+    This function is to compute the sums of one user (applyInPandas): the number of predictions,
+    the sum of squared errors, the sum of absolute errors, and the sum and the sum of squares of
+    the ratings, on the top k predictions of the user.
+    '''
+    predictions = pdf[prediction].values.astype(np.float64)
+    ratings = pdf[rating].values.astype(np.float64)
+    keep = top_k_mask(predictions, k)
+    errors = predictions[keep] - ratings[keep]
+    ratings = ratings[keep]
+    return pd.DataFrame({user: pdf[user].values[:1],
+                         "n": [len(errors)],
+                         "sse": [errors.dot(errors)],
+                         "sae": [np.abs(errors).sum()],
+                         "sum_rating": [ratings.sum()],
+                         "sum_rating2": [ratings.dot(ratings)]})
+
+
+def metrics_from_sums(n, sse, sae, sum_rating, sum_rating2):
+    '''
+    This function is to compute rmse, mae and r2 from the sums.
+    r2 = 1 - sse / sst, where sst = sum(rating^2) - sum(rating)^2 / n, as RegressionEvaluator.
+    '''
+    if n == 0:
+        return dict((name, float("nan")) for name in REGRESSION_METRICS)
+    sst = sum_rating2 - sum_rating * sum_rating / n
+    return {"rmse": float(np.sqrt(sse / n)),
+            "mae": float(sae / n),
+            "r2": float(1 - sse / sst) if sst > 0 else float("nan")}
+
+
+def regression_metrics(dataset, k=None, user="user_id", rating="rating", prediction="prediction", per_user=False):
+    '''
+    This function is to compute rmse, mae and r2 in one aggregate of sums and sums of squares,
+    instead of one RegressionEvaluator job per metric.
+    Without k, the sums are a plain aggregate (no shuffle of the rows, no sort). With k, the
+    rows of every user are reduced to the sums of the top k predictions by a partial sort
+    (np.partition) inside the group, instead of a Window rank over a full sort; only one row
+    per user is aggregated afterwards.
+    Input:
+    1. dataset: a DataFrame with the user, rating and prediction columns
+    2. k: only evaluate the top k predictions of every user; None to evaluate every prediction
+    3. user, rating, prediction: column names
+    4. per_user: also return the metrics of every user
+    Output:
+    1. a dictionary of {rmse, mae, r2}
+    2. (per_user only) a DataFrame of user, n, rmse, mae, r2; it is cached
+    '''
+    errors = F.col(prediction) - F.col(rating)
+    sums = dataset.select(user,
+                          F.lit(1).cast(LongType()).alias("n"),
+                          (errors * errors).cast(DoubleType()).alias("sse"),
+                          F.abs(errors).cast(DoubleType()).alias("sae"),
+                          F.col(rating).cast(DoubleType()).alias("sum_rating"),
+                          (F.col(rating) * F.col(rating)).cast(DoubleType()).alias("sum_rating2"))
+    if k is not None:
+        schema = StructType([dataset.schema[user], StructField("n", LongType())] +
+                            [StructField(name, DoubleType()) for name in SUM_COLUMNS[1:]])
+        sums = dataset \
+            .select(user, rating, prediction) \
+            .groupBy(user) \
+            .applyInPandas(partial(top_k_sums, k=k, user=user, rating=rating, prediction=prediction), schema)
+    elif per_user:
+        sums = sums.groupBy(user).agg(*[F.sum(name).alias(name) for name in SUM_COLUMNS])
+    if per_user:
+        sums = sums.cache()
+    total = sums.agg(*[F.sum(name).alias(name) for name in SUM_COLUMNS]).first()
+    result = metrics_from_sums(*[total[name] or 0 for name in SUM_COLUMNS])
+    if not per_user:
+        return result
+    sst = F.col("sum_rating2") - F.col("sum_rating") * F.col("sum_rating") / F.col("n")
+    user_metrics = sums.select(user, "n",
+                               F.sqrt(F.col("sse") / F.col("n")).alias("rmse"),
+                               (F.col("sae") / F.col("n")).alias("mae"),
+                               F.when(sst > 0, 1 - F.col("sse") / sst).alias("r2"))
+    return result, user_metrics
+
+
+def local_regression_metrics(pdf, k=None, user="user_id", rating="rating", prediction="prediction"):
+    '''
+    This function is to compute rmse, mae and r2 of the predictions of an in-process model
+    (a pandas DataFrame), without going through Spark.
+    Input:
+    1. pdf: a pandas DataFrame with the user, rating and prediction columns
+    2. k: only evaluate the top k predictions of every user; None to evaluate every prediction
+    Output:
+    1. a dictionary of {rmse, mae, r2}
+    '''
+    predictions = pdf[prediction].values.astype(np.float64)
+    ratings = pdf[rating].values.astype(np.float64)
+    if k is not None:
+        order = np.argsort(pdf[user].values, kind="stable")
+        predictions, ratings = predictions[order], ratings[order]
+        _, starts = np.unique(pdf[user].values[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        keep = np.concatenate([top_k_mask(predictions[start:end], k) for start, end in zip(starts, ends)] +
+                              [np.zeros(0, dtype=bool)])
+        predictions, ratings = predictions[keep], ratings[keep]
+    errors = predictions - ratings
+    return metrics_from_sums(len(errors), errors.dot(errors), np.abs(errors).sum(),
+                             ratings.sum(), ratings.dot(ratings))
@@ -0,0 +1,161 @@
+import pyspark
+from pyspark.sql import SparkSession
+import math
+import os
+import subprocess
+
+MB = 1024 ** 2
+
+# named profiles of the Spark session; memory, cores and the input size refine them
+PROFILES = {
+    # a few cores of a laptop or a login node, for the 1% subsets and local tests
+    "local-small": {"master": "local[2]", "memory": "4g", "max_broadcast": 64 * MB, "max_off_heap": 1024 * MB},
+    # every core of one machine
+    "local-all-cores": {"master": "local[*]", "memory": "16g", "max_broadcast": 256 * MB, "max_off_heap": 8192 * MB},
+    # spark-submit on the cluster: the master and the executors come from spark-submit
+    "cluster": {"master": None, "memory": "8g", "max_broadcast": 512 * MB, "max_off_heap": 4096 * MB},
+}
+
+# bytes of input per shuffle partition (parquet grows a few times in a shuffle)
+PARTITION_BYTES = 64 * MB
+MAX_SHUFFLE_PARTITIONS = 4000
+
+
+def add_spark_arguments(parser):
+    '''
+    This function is to add the session arguments shared by every script to an argparse parser.
+    '''
+    parser.add_argument("--profile", default="local-small", help="Spark profile: " + ", ".join(sorted(PROFILES)) + ".")
+    parser.add_argument("--set_memory", default=None, help="Specifying the memory; the memory of the profile by default.")
+    parser.add_argument("--cores", default=None, help="Number of local cores; * uses every core. Overrides the master of the profile.")
+    return parser
+
+
+def input_bytes(path):
+    '''
+    This function is to detect the size (bytes) of the input before the session starts:
+    hdfs dfs -du for HDFS paths, the file sizes for local paths. None if it cannot be detected.
+    '''
+    if path is None:
+        return None
+    if path.startswith("hdfs:"):
+        try:
+            output = subprocess.check_output(["hdfs", "dfs", "-du", "-s", path], stderr=subprocess.DEVNULL)
+            return int(output.split()[0])
+        except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+            return None
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names)
+    return None
+
+
+def path_bytes(spark, path):
+    '''
+    This function is to get the total size (bytes) of the files under the path through the hadoop file system.
+    '''
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    fs = hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    return fs.getContentSummary(hadoop_path).getLength()
+
+
+def shuffle_partitions(n_bytes, parallelism):
+    '''
+    This function is to size spark.sql.shuffle.partitions: about PARTITION_BYTES of input per
+    partition, and at least two partitions per core. AQE coalesces the ones that end up small.
+    '''
+    if n_bytes is None:
+        return max(2 * parallelism, 1)
+    return int(min(max(math.ceil(n_bytes / float(PARTITION_BYTES)), 2 * parallelism), MAX_SHUFFLE_PARTITIONS))
+
+
+def broadcast_threshold(n_bytes, profile):
+    '''
+    This function is to size spark.sql.autoBroadcastJoinThreshold: the small sides of the joins
+    (dictionaries, user counts, sampled users) grow with the input, so allow about 5% of it,
+    between Spark's default 10MB and the limit of the profile.
+    '''
+    if n_bytes is None:
+        return 10 * MB
+    return int(min(max(n_bytes // 20, 10 * MB), profile["max_broadcast"]))
+
+
+def off_heap_size(n_bytes, profile):
+    '''
+    This function is to size spark.memory.offHeap.size for caching and shuffling the input:
+    about twice the input, between 512MB and the limit of the profile.
+    '''
+    if n_bytes is None:
+        return 512 * MB
+    return int(min(max(2 * n_bytes, 512 * MB), profile["max_off_heap"]))
+
+
+def spark_session(profile="local-small", memory=None, cores=None, input_path=None,
+                  scheduler_mode="FIFO", app_name="goodreads"):
+    '''
+    This function is to create the Spark session of a script from a named profile (PROFILES).
+    Kryo serialization, adaptive query execution and Arrow are enabled; the shuffle partitions,
+    the broadcast threshold and the off-heap memory are sized from the input, and the effective
+    configuration is printed.
+    Input:
+    1. profile: local-small, local-all-cores or cluster
+    2. memory: the driver and executor memory; the one of the profile if None
+    3. cores: number of local cores ("*" for every core); the master of the profile if None
+    4. input_path: the main input of the script, used to size the session; None to keep the defaults
+    5. scheduler_mode: FIFO, or FAIR for concurrent jobs (parallel tuning)
+    6. app_name: the name of the application
+    Output:
+    1. spark: SparkSession
+    '''
+    if profile not in PROFILES:
+        raise ValueError("Unknown profile " + profile + "; use one of " + ", ".join(sorted(PROFILES)) + ".")
+    config = PROFILES[profile]
+    memory = config["memory"] if memory is None else memory
+    n_bytes = input_bytes(input_path)
+    pairs = [('spark.app.name', app_name),
+             ('spark.executor.memory', memory),
+             ('spark.driver.memory', memory),
+             ('spark.scheduler.mode', scheduler_mode),
+             ('spark.serializer', 'org.apache.spark.serializer.KryoSerializer'),
+             ('spark.kryoserializer.buffer.max', '512m'),
+             ('spark.sql.adaptive.enabled', 'true'),
+             ('spark.sql.adaptive.coalescePartitions.enabled', 'true'),
+             ('spark.sql.adaptive.skewJoin.enabled', 'true'),
+             ('spark.sql.execution.arrow.pyspark.enabled', 'true'),
+             ('spark.memory.offHeap.enabled', 'true'),
+             ('spark.memory.offHeap.size', str(off_heap_size(n_bytes, config)))]
+    master = config["master"] if cores is None else ("local" if cores == "1" else "local[" + cores + "]")
+    if master is not None:
+        pairs.append(('spark.master', master))
+    conf = pyspark.SparkConf().setAll(pairs)
+    spark = SparkSession.builder \
+        .config(conf=conf) \
+        .getOrCreate()
+    if n_bytes is None and input_path is not None:
+        # e.g. no hdfs command on this machine: measure through the session instead
+        try:
+            n_bytes = path_bytes(spark, input_path)
+        except Exception:
+            n_bytes = None
+    # the SQL settings can still change once the session runs
+    parallelism = spark.sparkContext.defaultParallelism
+    spark.conf.set("spark.sql.shuffle.partitions", str(shuffle_partitions(n_bytes, parallelism)))
+    spark.conf.set("spark.sql.autoBroadcastJoinThreshold", str(broadcast_threshold(n_bytes, config)))
+    spark.conf.set("spark.sql.adaptive.advisoryPartitionSizeInBytes", str(PARTITION_BYTES))
+    log_config(spark, profile, n_bytes)
+    return spark
+
+
+def log_config(spark, profile, n_bytes):
+    '''
+    This function is to print the effective configuration of the session.
+    '''
+    keys = ["spark.master", "spark.app.name", "spark.driver.memory", "spark.executor.memory",
+            "spark.scheduler.mode", "spark.serializer", "spark.sql.adaptive.enabled",
+            "spark.memory.offHeap.size", "spark.sql.shuffle.partitions", "spark.sql.autoBroadcastJoinThreshold"]
+    print("Spark profile {0}; input size {1}; default parallelism {2}.".format(
+        profile, "unknown" if n_bytes is None else str(n_bytes) + " bytes", spark.sparkContext.defaultParallelism))
+    for key in keys:
+        print("    {0} = {1}".format(key, spark.conf.get(key, None)))
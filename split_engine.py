@@ -0,0 +1,122 @@
+from pyspark.sql.window import Window
+from pyspark.sql.functions import col, lit
+import pyspark.sql.functions as F
+import numpy as np
+
+# resolution of the hash split: a key falls into one of HASH_BUCKETS buckets
+HASH_BUCKETS = 1000000
+
+
+def hash_bucket(*cols, seed=123):
+    '''
+    This function is to map one or more columns to a stable bucket in [0, HASH_BUCKETS).
+    '''
+    return F.pmod(F.xxhash64(*cols, lit(seed)), lit(HASH_BUCKETS))
+
+
+def hash_fraction(*cols, seed=123):
+    '''
+    This function is to map one or more columns to a stable number in [0, 1).
+    '''
+    return hash_bucket(*cols, seed=seed) / HASH_BUCKETS
+
+
+def user_group_column(user="user_id", fractions=(0.6, 0.2, 0.2), seed=123):
+    '''
+    This function is to assign every user to a group (0, 1, 2, ...) by the hash of the user,
+    e.g. fractions=(0.6, 0.2, 0.2) gives about 60% of the users to group 0 (train),
+    20% to group 1 (validation) and 20% to group 2 (test).
+    Input:
+    1. user: the user column
+    2. fractions: the fraction of the users in each group
+    3. seed: the seed of the hash
+    '''
+    fractions = [float(fraction) / sum(fractions) for fraction in fractions]
+    user_hash = hash_fraction(col(user), seed=seed)
+    group = lit(len(fractions) - 1)
+    # build the chain from the last boundary so the first matching boundary wins
+    boundary = 1.0
+    for i in reversed(range(len(fractions) - 1)):
+        boundary -= fractions[i + 1]
+        group = F.when(user_hash < boundary, lit(i)).otherwise(group)
+    return group
+
+
+def tag_interactions(data, user="user_id", item="book_id", fractions=(0.6, 0.2, 0.2),
+                     holdout=0.5, seed=123, method="hash"):
+    '''
+    This function is to tag every interaction with its user group and whether it is held out.
+    For the validation and test users, the held-out interactions are evaluated and the other
+    interactions go to the training set. Everything is done in one distributed pass; nothing
+    is collected to the driver.
+    Input:
+    1. data: the whole dataframe
+    2. user, item: the user and item columns
+    3. fractions: the fraction of the users in each group
+    4. holdout: the fraction of the interactions per user which is held out
+    5. seed: the seed of the split
+    6. method: hash: hash of (user, item); no shuffle, about holdout of the interactions per user
+               row_number: rank the interactions of each user by the hash; exactly
+                           round(holdout * n) interactions per user, but one shuffle by user
+    Output:
+    1. data with two more columns: user_group (int) and is_holdout (boolean)
+    '''
+    tagged_data = data.withColumn("user_group", user_group_column(user, fractions, seed))
+    if method == "hash":
+        tagged_data = tagged_data.withColumn("is_holdout", hash_fraction(col(user), col(item), seed=seed + 1) < holdout)
+    elif method == "row_number":
+        window = Window.partitionBy(user).orderBy(F.xxhash64(col(user), col(item), lit(seed + 1)))
+        tagged_data = tagged_data \
+            .withColumn("is_holdout",
+                        F.row_number().over(window) <=
+                        F.round(F.count(lit(1)).over(Window.partitionBy(user)) * holdout))
+    return tagged_data
+
+
+def local_tags(user_hash, pair_hash, fractions=(0.6, 0.2, 0.2), holdout=0.5):
+    '''
+    This function is to compute the same tags as tag_interactions (method="hash") with NumPy,
+    from the hash buckets of the user and of the (user, item) pair (see interaction_store.py).
+    The boundaries are computed in the same order as user_group_column, so the groups match.
+    Input:
+    1. user_hash: hash_bucket(user, seed=seed) of every interaction
+    2. pair_hash: hash_bucket(user, item, seed=seed + 1) of every interaction
+    3. fractions: the fraction of the users in each group
+    4. holdout: the fraction of the interactions per user which is held out
+    Output:
+    1. user_group: the group of every interaction
+    2. is_holdout: whether the interaction is held out
+    '''
+    fractions = [float(fraction) / sum(fractions) for fraction in fractions]
+    user_fraction = np.asarray(user_hash) / HASH_BUCKETS
+    user_group = np.full(len(user_fraction), len(fractions) - 1, dtype=np.int8)
+    boundary = 1.0
+    for i in reversed(range(len(fractions) - 1)):
+        boundary -= fractions[i + 1]
+        user_group[user_fraction < boundary] = i
+    is_holdout = np.asarray(pair_hash) / HASH_BUCKETS < holdout
+    return user_group, is_holdout
+
+
+def training_part(tagged_data, holdout_groups, columns):
+    '''
+    This function is to get the training set from the tagged data: every interaction
+    except the held-out interactions of the holdout_groups.
+    Input:
+    1. tagged_data: the output of tag_interactions
+    2. holdout_groups: a list of groups which are evaluated (e.g. validation and test)
+    3. columns: the columns to keep
+    '''
+    evaluated = col("is_holdout") & col("user_group").isin(list(holdout_groups))
+    return tagged_data.where(~evaluated).select(columns)
+
+
+def holdout_part(tagged_data, group, columns):
+    '''
+    This function is to get the held-out interactions of one user group.
+    Input:
+    1. tagged_data: the output of tag_interactions
+    2. group: the user group (e.g. validation or test)
+    3. columns: the columns to keep
+    '''
+    return tagged_data.where(col("is_holdout") & (col("user_group") == group)).select(columns)
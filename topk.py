@@ -0,0 +1,105 @@
+import numpy as np
+import scipy.sparse as sp
+from local_als import lookup_index
+
+# the largest (users x items) block of scores: 2**24 float32 scores are 64 MiB, and the
+# int64 positions of argpartition another 128 MiB, per Python worker
+MAX_BLOCK_SCORES = 2 ** 24
+
+
+def merge_top_k(top_scores, top_items, scores, items, k):
+    '''
+    This function is to merge the running top k of every row with the scores of a new block.
+    Each row keeps at most k (score, item) pairs, like a bounded heap per user, but all rows
+    are updated at once with argpartition.
+    Input:
+    1. top_scores, top_items: the running top k (n x k'), k' <= k
+    2. scores: the scores of the new block (n x m); it is overwritten
+    3. items: the item positions of the columns of the block (m,)
+    4. k: the size of the top k
+    '''
+    if scores.shape[1] > k:
+        # negated in place, so no temporary of the size of the block is made
+        np.negative(scores, out=scores)
+        block_top = np.argpartition(scores, k - 1, axis=1)[:, :k]
+        scores = -np.take_along_axis(scores, block_top, axis=1)
+        block_items = items[block_top]
+    else:
+        block_items = np.broadcast_to(items, scores.shape)
+    scores = np.concatenate([top_scores, scores], axis=1)
+    block_items = np.concatenate([top_items, block_items], axis=1)
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        block_items = np.take_along_axis(block_items, keep, axis=1)
+    return scores, block_items
+
+
+def blocked_top_k(user_factors, item_factors, k=10, exclude=None, item_block_size=65536, user_block_size=None,
+                  max_block_scores=MAX_BLOCK_SCORES):
+    '''
+    This function is to find the k items with the highest score (dot product) for every user
+    without building the full user x item score matrix: the scores are computed one
+    (user block x item block) at a time with a BLAS matrix product, and only the running top k
+    of every user is kept.
+    Input:
+    1. user_factors: (n_users x rank) array
+    2. item_factors: (n_items x rank) array
+    3. k: number of items per user
+    4. exclude: a (n_users x n_items) scipy sparse matrix of the items to skip (e.g. the
+       items seen in training); None to keep every item
+    5. item_block_size, user_block_size: the block sizes; the memory is about
+       user_block_size x item_block_size scores
+    6. max_block_scores: the memory budget of a block; user_block_size (by default as many
+       users as fit) and item_block_size are reduced so that their product stays below it
+    Output:
+    1. top_items: (n_users x k) item positions sorted by score (-1 if there are fewer than k items)
+    2. top_scores: (n_users x k) scores
+    '''
+    user_factors = np.ascontiguousarray(user_factors, dtype=np.float32)
+    item_factors = np.ascontiguousarray(item_factors, dtype=np.float32)
+    n_users, n_items = user_factors.shape[0], item_factors.shape[0]
+    item_block_size = max(1, min(item_block_size, max_block_scores))
+    max_users = max(1, max_block_scores // item_block_size)
+    user_block_size = max_users if user_block_size is None else max(1, min(user_block_size, max_users))
+    if exclude is not None:
+        exclude = sp.csr_matrix(exclude)
+    top_items = np.full((n_users, k), -1, dtype=np.int64)
+    top_scores = np.full((n_users, k), -np.inf, dtype=np.float32)
+    for user_start in range(0, n_users, user_block_size):
+        user_end = min(user_start + user_block_size, n_users)
+        block_scores = np.full((user_end - user_start, 0), -np.inf, dtype=np.float32)
+        block_items = np.zeros((user_end - user_start, 0), dtype=np.int64)
+        if exclude is not None:
+            user_exclude = exclude[user_start:user_end].tocsc()
+        for item_start in range(0, n_items, item_block_size):
+            item_end = min(item_start + item_block_size, n_items)
+            scores = user_factors[user_start:user_end].dot(item_factors[item_start:item_end].T)
+            if exclude is not None:
+                skipped = user_exclude[:, item_start:item_end].tocoo()
+                scores[skipped.row, skipped.col] = -np.inf
+            block_scores, block_items = merge_top_k(block_scores, block_items, scores,
+                                                    np.arange(item_start, item_end), k)
+        # sort the top k of every user by score
+        order = np.argsort(-block_scores, axis=1, kind="stable")
+        block_scores = np.take_along_axis(block_scores, order, axis=1)
+        block_items = np.take_along_axis(block_items, order, axis=1)
+        block_items[np.isneginf(block_scores)] = -1
+        top_scores[user_start:user_end, :block_scores.shape[1]] = block_scores
+        top_items[user_start:user_end, :block_items.shape[1]] = block_items
+    return top_items, top_scores
+
+
+def exclusion_matrix(item_ids, item_lists):
+    '''
+    This function is to turn a list of item id arrays (one per user, e.g. the books already read)
+    into the sparse (users x items) matrix of item positions taken by blocked_top_k.
+    Input:
+    1. item_ids: the sorted ids of the item factors
+    2. item_lists: a list of item id arrays (None for no item); the unknown items are ignored
+    '''
+    items = [np.asarray([] if user_items is None else user_items, dtype=item_ids.dtype) for user_items in item_lists]
+    positions, known = lookup_index(item_ids, np.concatenate(items + [np.zeros(0, dtype=item_ids.dtype)]))
+    rows = np.repeat(np.arange(len(items)), [len(user_items) for user_items in items])
+    return sp.csr_matrix((np.ones(int(known.sum()), dtype=np.int8), (rows[known], positions[known])),
+                         shape=(len(items), len(item_ids)))
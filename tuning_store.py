@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from functools import partial
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import pandas as pd
+
+# one row per (data, split, fold, configuration) fit of the tuning grid
+CELL_TABLE = '''CREATE TABLE IF NOT EXISTS cells (
+    fingerprint TEXT, split_seed INTEGER, fold INTEGER, rank INTEGER, regParam REAL, maxIter INTEGER,
+    config TEXT, metrics TEXT, wall_seconds REAL, run_id TEXT, created TEXT,
+    PRIMARY KEY (fingerprint, split_seed, fold, rank, regParam, maxIter, config))'''
+# one row per run of modeling.py or modeling_cv.py (formerly tuning_history.txt)
+RUN_TABLE = '''CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT, script TEXT, model_path TEXT, data TEXT, fingerprint TEXT, split_seed INTEGER,
+    maxIter INTEGER, config TEXT, rank_list TEXT, regParam_list TEXT, tuning_table TEXT,
+    best_rank INTEGER, best_regParam REAL, selection_metric TEXT, test_metrics TEXT,
+    tuning_seconds REAL, total_seconds REAL, created TEXT)'''
+
+
+def dataset_fingerprint(spark, path, **settings):
+    '''
+    This function is to identify the data of a run without reading it: a hash of the names, sizes
+    and modification times of the files under the path (through the hadoop file system), and of
+    the settings that change the rows the models see (e.g. the id dictionaries, implicit feedback).
+    Input:
+    1. spark: the spark session
+    2. path: the parquet path of the data
+    3. settings: keyword arguments hashed with the files
+    Output:
+    1. a hexadecimal string
+    '''
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    fs = hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    root = fs.makeQualified(hadoop_path).toString()
+    files = []
+    iterator = fs.listFiles(hadoop_path, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        name = status.getPath().toString()[len(root):]
+        # _SUCCESS and the hidden files of the writers are not data
+        if not name.rsplit("/", 1)[-1].startswith(("_", ".")):
+            files.append((name, status.getLen(), status.getModificationTime()))
+    content = json.dumps({"files": sorted(files), "settings": settings}, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class TuningStore(object):
+    '''
+    A SQLite file of the tuning results. Every fitted cell of the grid is written as soon as it
+    finishes, keyed by the dataset fingerprint, the split seed, the fold, rank, regParam, maxIter
+    and the rest of the configuration (metric k, evaluation, backend, implicit feedback, ...), with
+    its metrics and wall time. tuning_als looks the cells up before fitting, so an interrupted or
+    extended sweep only fits the missing cells. The runs table keeps the best configuration and
+    the test metrics of every run.
+    '''
+
+    def __init__(self, path, fingerprint, split_seed=123, maxIter=5, config=None, run_id=None, recompute=False):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.split_seed = split_seed
+        self.maxIter = maxIter
+        self.config = json.dumps(config or {}, sort_keys=True, default=str)
+        self.run_id = time.strftime("%Y%m%d_%H%M%S") if run_id is None else run_id
+        self.recompute = recompute
+        self.lock = threading.Lock()
+        with self.connect() as connection:
+            connection.execute(CELL_TABLE)
+            connection.execute(RUN_TABLE)
+
+    @contextmanager
+    def connect(self):
+        # a connection per call, since the cells may finish in the threads of parallel_tuning
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def lookup(self, rank, regParam, fold=0, metrics=None):
+        '''
+        This function is to get the stored metrics of a cell; None if the cell (or one of the
+        metrics) has not been computed yet, or with recompute.
+        '''
+        if self.recompute:
+            return None
+        with self.lock, self.connect() as connection:
+            row = connection.execute("SELECT metrics FROM cells WHERE fingerprint=? AND split_seed=? AND fold=? "
+                                     "AND rank=? AND regParam=? AND maxIter=? AND config=?",
+                                     (self.fingerprint, self.split_seed, fold, rank, regParam, self.maxIter,
+                                      self.config)).fetchone()
+        if row is None:
+            return None
+        stored = json.loads(row[0])
+        if metrics is not None and any(metric not in stored for metric in metrics):
+            return None
+        return stored
+
+    def save(self, rank, regParam, fold, metrics, wall_seconds):
+        '''
+        This function is to write (or replace) the metrics and the wall time of a cell.
+        '''
+        with self.lock, self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO cells VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                               (self.fingerprint, self.split_seed, fold, rank, regParam, self.maxIter, self.config,
+                                json.dumps(metrics, default=float), wall_seconds, self.run_id,
+                                time.strftime("%Y-%m-%d %H:%M:%S")))
+
+    def run_cell(self, function, rank, regParam, fold=0):
+        '''
+        This function is to run one cell of the grid and save its result. With a list of regParams
+        (a warm-started sweep), function returns {regParam: metrics} and every regParam is saved
+        with the wall time of the whole sweep.
+        '''
+        start_time = time.time()
+        result = function()
+        wall_seconds = round(time.time() - start_time, 3)
+        for value, metrics in (result.items() if isinstance(regParam, list) else [(regParam, result)]):
+            self.save(rank, value, fold, metrics, wall_seconds)
+        return result
+
+    def store_cells(self, cells, cell_key):
+        '''
+        This function is to wrap the cells of parallel_tuning.run_cells so that each one is saved
+        when it finishes.
+        Input:
+        1. cells: a list of (key, function) pairs
+        2. cell_key: a function of the key of a cell which returns its (rank, regParam, fold)
+        '''
+        return [(key, partial(self.run_cell, function, *cell_key(key))) for key, function in cells]
+
+    def save_run(self, script, model_path, data, rank_list, regParam_list, tuning_table, best_config,
+                 selection_metric, test_metrics, tuning_seconds=None, total_seconds=None):
+        '''
+        This function is to record a run: its grid, its tuning table, the best configuration and
+        the test metrics.
+        '''
+        with self.lock, self.connect() as connection:
+            connection.execute("INSERT INTO runs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                               (self.run_id, script, model_path, data, self.fingerprint, self.split_seed,
+                                self.maxIter, self.config, json.dumps(rank_list), json.dumps(regParam_list),
+                                json.dumps(tuning_table, default=float), best_config["rank"],
+                                best_config["regParam"], selection_metric, json.dumps(test_metrics, default=float),
+                                tuning_seconds, total_seconds, time.strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def read_results(path, table="cells"):
+    '''
+    This function is to read a table of the store as a pandas DataFrame; the metrics of the
+    cells are expanded into one column per metric.
+    '''
+    connection = sqlite3.connect(path)
+    try:
+        pdf = pd.read_sql_query("SELECT * FROM " + table, connection)
+    finally:
+        connection.close()
+    if table == "cells" and len(pdf) > 0:
+        metrics = pd.DataFrame([json.loads(value) for value in pdf["metrics"]], index=pdf.index)
+        pdf = pd.concat([pdf.drop(columns="metrics"), metrics], axis=1)
+    return pdf